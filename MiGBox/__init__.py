@@ -19,6 +19,6 @@
 __version__ = 0.6
 __author__ = 'Benjamin Ertl'
 
-import sync, sftp, fs, gui, common, cli, mount
+import metrics, sync, sftp, fs, gui, common, cli, mount
 
-__all__ = [ 'sync', 'sftp', 'fs', 'gui', 'common', 'cli', 'mount'  ]
+__all__ = [ 'metrics', 'sync', 'sftp', 'fs', 'gui', 'common', 'cli', 'mount'  ]
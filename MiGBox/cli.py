@@ -36,18 +36,40 @@ MiGBox comes with ABSOLUTELY NO WARRANTY. This is free software,
 and you are welcome to redistribute it under certain conditions.
 
 type 'start'   to start synchronizing
+type 'plan'    to show the work of a complete synchronization
 type 'stop'    to stop synchronizing
+type 'limit network|disk KIB' to limit the KiB per second, 0 for unlimited
+type 'limit operations N' to limit the file operations per second
 type 'mount'   to mount the configured sftp location
 type 'unmount' to unmount the configured sftp location
 type 'exit'    to exit
 """.format(__version__, __author__)
 
+def plan(mode, source, destination, sftp_host, sftp_port,
+         hostkey, userkey, logfile=None, loglevel='INFO', execute=False, workers=1,
+         verbose=False, network_rate=None, disk_rate=None, operations_rate=None, **kargs):
+    """
+    Print the sync plan and its estimated cost without synchronizing,
+    or execute it with C{workers} threads if C{execute} is set.
+    """
+
+    return syncd.plan(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
+                      logfile=logfile, loglevel=loglevel, execute=execute, workers=workers,
+                      verbose=verbose, network_rate=network_rate, disk_rate=disk_rate,
+                      operations_rate=operations_rate)
+
 def run(mode, source, destination, sftp_host, sftp_port,
-        hostkey, userkey, mountpath, logfile=None, loglevel='INFO'):
+        hostkey, userkey, mountpath, logfile=None, loglevel='INFO',
+        metrics_host=None, metrics_port=None, workers=1, network_rate=None, disk_rate=None,
+        operations_rate=None):
 
     event = threading.Event()    
     thread = threading.Thread(target=syncd.run, args=(mode, source, destination,
-                 sftp_host, sftp_port, hostkey, userkey, logfile, loglevel, event))
+                 sftp_host, sftp_port, hostkey, userkey),
+                 kwargs={'logfile': logfile, 'loglevel': loglevel, 'stopsync': event,
+                         'metrics_host': metrics_host, 'metrics_port': metrics_port,
+                         'workers': workers, 'network_rate': network_rate,
+                         'disk_rate': disk_rate, 'operations_rate': operations_rate})
 
     print header
     running = True
@@ -57,6 +79,24 @@ def run(mode, source, destination, sftp_host, sftp_port,
         if in_ == 'start':
             event.clear()
             thread.start()
+        if in_ == 'plan':
+            if thread.isAlive():
+                print "Stop synchronizing first."
+            else:
+                plan(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
+                     logfile=logfile, loglevel=loglevel, network_rate=network_rate,
+                     disk_rate=disk_rate, operations_rate=operations_rate)
+        if in_.startswith('limit'):
+            try:
+                _, resource, rate = in_.split()
+                rate = str(int(rate))
+                network_rate, disk_rate, operations_rate = {
+                    'network': (rate, disk_rate, operations_rate),
+                    'disk': (network_rate, rate, operations_rate),
+                    'operations': (network_rate, disk_rate, rate)}[resource]
+                syncd.set_limits(network_rate, disk_rate, operations_rate)
+            except (ValueError, KeyError):
+                print "Usage: limit network|disk KIB, limit operations N"
         if in_ == 'stop':
             event.set()
             thread.join()
@@ -63,6 +63,13 @@ userkey =
 hostkey =
 [Mount]
 mountpath =
+[Metrics]
+metrics_host =
+metrics_port =
+[Throttle]
+network_rate =
+disk_rate =
+operations_rate =
 """
 
 # default server.cfg configuration file
@@ -73,12 +80,19 @@ rootpath =
 host =
 port =
 backlog =
+max_connections =
+[Workers]
+workers =
+processes =
 [Logging]
 logfile =
 loglevel =
 [KeyAuth]
 hostkey =
 userkey =
+[Metrics]
+metrics_host =
+metrics_port =
 """
 
 def write_config(configfile, values, server=False):
@@ -23,13 +23,38 @@ Provides a wrapper for uniform file system access with os and sftp via paramiko.
 
 import os
 import stat
+import errno
+import json
 import shutil
+import hashlib
 import posixpath
 
 from Queue import Empty
-from watchdog.observers.polling import PollingObserver as Observer
-from MiGBox.sync import EventQueue, EventHandler
-from MiGBox.sync.delta import blockchecksums, delta, patch
+from MiGBox.sync import EventQueue, EventHandler, Observer
+from MiGBox.metrics import timed
+from MiGBox import throttle
+from MiGBox.sync.delta import blockchecksums, delta, patch, sparse_write, sparse_copy, \
+                              sparse_end, ALGORITHM
+
+# suffix of partially transferred files and their checkpoints
+PARTIAL = ".part"
+CHECKPOINT = ".part.chk"
+
+# read/write size for transfers and bytes between two checkpoints
+CHUNKSIZE = 262144
+CHECKPOINT_SIZE = 4194304
+
+# how often an interrupted transfer is resumed before giving up
+TRANSFER_RETRIES = 3
+
+def _copy(src_path, dst_path, throttle=None):
+    # copy the data and mode of a file like shutil.copy, keeping its holes,
+    # throttle is called with the bytes read and written of every part
+    with open(src_path, 'rb') as fsrc:
+        with open(dst_path, 'wb') as fdst:
+            if sparse_copy(fsrc, fdst, 0, os.fstat(fsrc.fileno()).st_size, throttle):
+                sparse_end(fdst)
+    shutil.copymode(src_path, dst_path)
 
 class FileSystem(object):
     """
@@ -77,6 +102,7 @@ class FileSystem(object):
 
         raise NotImplementedError
 
+    @timed('listdir')
     def listdir(self, path):
         """
         Return a list of files within a given folder.
@@ -89,8 +115,10 @@ class FileSystem(object):
 
         if not self.instance:
             raise NotImplementedError
+        self.operation()
         return self.instance.listdir(path)
 
+    @timed('stat')
     def stat(self, path):
         """
         Return a stat object for a path.
@@ -101,8 +129,30 @@ class FileSystem(object):
 
         if not self.instance:
             raise NotImplementedError
+        self.operation()
         return self.instance.stat(path)
 
+    def throttle(self, n):
+        """
+        Wait until C{n} bytes may be read or written on this file system,
+        see L{MiGBox.throttle}. Local file systems wait for the disk limit,
+        the requests of L{MiGBox.sftp.SFTPClient} for the network limit.
+
+        @param n: number of bytes.
+        @type n: int
+        """
+
+        pass
+
+    def operation(self):
+        """
+        Wait until an operation, e.g. a stat or a rename, may be done on
+        this file system, see L{MiGBox.throttle.operations}. The requests
+        of L{MiGBox.sftp.SFTPClient} wait for it themselves.
+        """
+
+        pass
+
     def mkdir(self, path, mode=511):
         """
         Create a new directory with the given attributes.
@@ -115,6 +165,7 @@ class FileSystem(object):
 
         if not self.instance:
             raise NotImplementedError
+        self.operation()
         return self.instance.mkdir(path, mode)
 
     def mkdirs(self, path, mode=511):
@@ -139,6 +190,7 @@ class FileSystem(object):
 
         if not self.instance:
             raise NotImplementedError
+        self.operation()
         return self.instance.rmdir(path)
 
     def remove(self, path):
@@ -151,6 +203,7 @@ class FileSystem(object):
 
         if not self.instance:
             raise NotImplementedError
+        self.operation()
         return self.instance.remove(path)
 
     def rename(self, src, dst):
@@ -165,8 +218,10 @@ class FileSystem(object):
 
         if not self.instance:
             raise NotImplementedError
+        self.operation()
         return self.instance.rename(src, dst)
 
+    @timed('copy')
     def copy(self, src, src_path, dst, dst_path):
         """
         Copy a file from L{FileSystem} to L{FileSystem},
@@ -190,22 +245,194 @@ class FileSystem(object):
 
         if isinstance(src, SFTPFileSystem):
             try:
-                src.get(src_path, dst_path)
+                self.transfer(src, src_path, dst, dst_path)
             except IOError:
                 dst.mkdirs(os.path.dirname(dst_path))
-                src.get(src_path, dst_path)
+                self.transfer(src, src_path, dst, dst_path)
         elif isinstance(dst, SFTPFileSystem):
             try:
-                dst.put(src_path, dst_path)
+                self.transfer(src, src_path, dst, dst_path)
             except IOError:
                 dst.mkdirs(posixpath.dirname(dst_path))
-                dst.put(src_path, dst_path)
+                self.transfer(src, src_path, dst, dst_path)
         else:
+            # local file systems share the disk limit
             try:
-                shutil.copy(src_path, dst_path)
+                _copy(src_path, dst_path, src.throttle)
             except IOError:
                 dst.mkdirs(os.path.dirname(dst_path))
-                shutil.copy(src_path, dst_path)
+                _copy(src_path, dst_path, src.throttle)
+
+    def transfer(self, src, src_path, dst, dst_path):
+        """
+        Copy a file from C{src_path} to C{dst_path} in chunks,
+        resuming a previously interrupted transfer.
+
+        The data is written to C{dst_path} + L{PARTIAL} and renamed when
+        complete. Every L{CHECKPOINT_SIZE} bytes the offset, the source's
+        size and mtime and the md5 of the transferred prefix are recorded
+        in C{dst_path} + L{CHECKPOINT}. A transfer continues from the
+        recorded offset, if the source is unchanged and the prefix of the
+        partial file still has the recorded md5. The partial file of an
+        upload is hashed by the server, see L{digest}, servers that can
+        not do that restart uploads from the beginning.
+
+        If the transfer is interrupted, it is resumed up to
+        L{TRANSFER_RETRIES} times before the error is raised.
+
+        @param src: source.
+        @type src: L{FileSystem}
+        @param src_path: source path to copy from.
+        @type src_path: str
+        @param dst: destination.
+        @type dst: L{FileSystem}
+        @param dst_path: destination to copy to.
+        @type dst_path: str
+        """
+
+        for attempt in xrange(TRANSFER_RETRIES):
+            try:
+                return self._transfer(src, src_path, dst, dst_path)
+            except Exception as e:
+                # missing paths are handled by the caller, anything else is
+                # most likely a lost connection and the checkpoint is kept
+                if getattr(e, 'errno', None) in (errno.ENOENT, errno.ENOTDIR, errno.EACCES) or \
+                   attempt == TRANSFER_RETRIES - 1:
+                    raise
+
+    def _transfer(self, src, src_path, dst, dst_path):
+        part = dst_path + PARTIAL
+        chk = dst_path + CHECKPOINT
+        st = src.stat(src_path)
+        offset, md5 = self._resume(src, src_path, dst, part, chk, st)
+        with dst.chunk_writer(part, offset) as fdst:
+            checkpoint = offset + CHECKPOINT_SIZE
+            skipped = False
+            for data in src.read_chunks(src_path, offset, st.st_size):
+                src.throttle(len(data))
+                dst.throttle(len(data))
+                # chunks of zeros are left as holes
+                skipped = sparse_write(fdst, data)
+                md5.update(data)
+                offset += len(data)
+                if offset >= checkpoint:
+                    if skipped:
+                        # the partial file has to reach the offset to be resumed
+                        sparse_end(fdst)
+                        skipped = False
+                    fdst.flush()
+                    with dst.open(chk, 'wb') as f:
+                        f.write(json.dumps({"size": st.st_size, "mtime": st.st_mtime,
+                                            "offset": offset, "md5": md5.hexdigest()}))
+                    checkpoint = offset + CHECKPOINT_SIZE
+            if skipped:
+                sparse_end(fdst)
+        try:
+            dst.remove(dst_path)
+        except (IOError, OSError):
+            pass
+        dst.rename(part, dst_path)
+        try:
+            dst.remove(chk)
+        except (IOError, OSError):
+            pass
+
+    def _resume(self, src, src_path, dst, part, chk, st):
+        # return offset and md5 of the verified prefix of a partial transfer
+        md5 = hashlib.md5()
+        try:
+            with dst.open(chk, 'rb') as f:
+                checkpoint = json.loads(f.read())
+            offset = checkpoint["offset"]
+            if checkpoint["size"] != st.st_size or checkpoint["mtime"] != st.st_mtime or \
+               dst.stat(part).st_size < offset:
+                return 0, md5
+            # the md5 of the transfer continues from the prefix on the local side
+            local, path = (dst, part) if isinstance(dst, OSFileSystem) else (src, src_path)
+            with local.open(path, 'rb') as f:
+                n = offset
+                while n > 0:
+                    data = f.read(min(CHUNKSIZE, n))
+                    if not data:
+                        break
+                    md5.update(data)
+                    n -= len(data)
+            if n or md5.hexdigest() != checkpoint["md5"]:
+                return 0, hashlib.md5()
+            # the partial file of an upload is verified where it is
+            if local is src and dst.digest(part, offset) != checkpoint["md5"]:
+                return 0, hashlib.md5()
+            return offset, md5
+        except (IOError, OSError, ValueError, KeyError):
+            return 0, hashlib.md5()
+
+    def digest(self, path, length):
+        """
+        Compute the md5 of the first C{length} bytes of a file.
+
+        @param path: path to the file.
+        @type path: str
+        @param length: number of bytes.
+        @type length: int
+        @return: hex digest.
+        @rtype: str
+        """
+
+        md5 = hashlib.md5()
+        with self.open(path, 'rb') as f:
+            while length > 0:
+                data = f.read(min(CHUNKSIZE, length))
+                if not data:
+                    raise IOError(errno.EIO, "File shorter than {0} bytes".format(length))
+                self.throttle(len(data))
+                md5.update(data)
+                length -= len(data)
+        return md5.hexdigest()
+
+    def read_chunks(self, path, offset, size):
+        """
+        Read a file from C{offset} to C{size} in chunks.
+
+        @param path: path to the file.
+        @type path: str
+        @param offset: offset to start reading.
+        @type offset: int
+        @param size: size of the file.
+        @type size: int
+        @return: generator of data chunks.
+        @rtype: generator
+        """
+
+        with self.open(path, 'rb') as f:
+            f.seek(offset)
+            if hasattr(f, 'prefetch'):
+                f.prefetch(size)
+            data = f.read(CHUNKSIZE)
+            while data:
+                yield data
+                data = f.read(CHUNKSIZE)
+
+    def chunk_writer(self, path, offset):
+        """
+        Open a file for writing chunks from C{offset}.
+
+        The file is created or truncated if C{offset} is 0.
+
+        @param path: path to the file.
+        @type path: str
+        @param offset: offset to start writing.
+        @type offset: int
+        @return: a new file object.
+        @rtype: file object
+        """
+
+        f = self.open(path, 'r+b' if offset else 'wb')
+        if offset:
+            # the source size is unchanged, the rest is overwritten
+            f.seek(offset)
+        if hasattr(f, 'set_pipelined'):
+            f.set_pipelined(True)
+        return f
 
     def open(self, path, mode='rb', buffering=None):
         """
@@ -224,12 +451,15 @@ class FileSystem(object):
 
         raise NotImplementedError
 
-    def blockchecksums(self, path):
+    def blockchecksums(self, path, strong=True):
         """
         Compute block checksums for a given file.
 
         @param path: path to the file.
         @type path: str
+        @param strong: compute strong checksums of the blocks, else
+                       the checksums can only be compared.
+        @type strong: bool
         @return: hashtable of block checksums, see L{MiGBox.sync.delta}
         @rtype: dict
         """
@@ -277,6 +507,9 @@ class OSFileSystem(FileSystem):
     def __init__(self, instance=os, root='.'):
         FileSystem.__init__(self, instance)
         self.root = os.path.normpath(root)
+        # strong checksum algorithm, set to the one of the other
+        # file system to compare block checksums
+        self.algorithm = ALGORITHM
         self.eventQueue = EventQueue()
         self.eventHandler = EventHandler(self.eventQueue)
         self.observer = Observer()
@@ -293,22 +526,38 @@ class OSFileSystem(FileSystem):
             return path
 
     def open(self, path, mode='rb', buffering=None):
+        self.operation()
         return open(path, mode)
 
     def mkdirs(self, path, mode=511):
+        self.operation()
         return os.makedirs(path, mode)
 
-    def blockchecksums(self, path):
-        return blockchecksums(path) 
+    def throttle(self, n):
+        # each part read or written is an operation of the disk
+        self.operation()
+        throttle.disk.consume(n)
+
+    def operation(self):
+        throttle.operations.consume(1)
+
+    @timed('checksum')
+    def blockchecksums(self, path, strong=True):
+        # the disk limit is waited for while the file is read
+        return blockchecksums(path, algorithm=self.algorithm, strong=strong,
+                              throttle=self.throttle)
 
+    @timed('delta')
     def delta(self, path, checksums):
-        return delta(path, checksums)
+        return delta(path, checksums, throttle=self.throttle)
 
+    @timed('patch')
     def patch(self, path, delta):
-        patched = patch(path, delta)
+        patched = patch(path, delta, throttle=self.throttle)
         self.instance.remove(path)
         return self.instance.rename(patched, path)
 
+    @timed('poll')
     def poll(self):
         r = []
         while True:
@@ -349,20 +598,37 @@ class SFTPFileSystem(FileSystem):
             except IOError:
                 continue
 
-    def blockchecksums(self, path):
-        return self.instance.checksums(path)
+    @timed('checksum')
+    def blockchecksums(self, path, strong=True):
+        return self.instance.checksums(path, strong)
 
+    def digest(self, path, length):
+        return self.instance.digest(path, length)
+
+    @timed('delta')
     def delta(self, path, chksums):
         return self.instance.delta(path, chksums)
 
+    @timed('patch')
     def patch(self, path, delta):
         return self.instance.patch(path, delta)
 
+    def read_chunks(self, path, offset, size):
+        if self.instance.codec:
+            return self.instance.read_chunks(path, offset, size)
+        return FileSystem.read_chunks(self, path, offset, size)
+
+    def chunk_writer(self, path, offset):
+        if self.instance.codec:
+            return self.instance.chunk_writer(path, offset)
+        return FileSystem.chunk_writer(self, path, offset)
+
     def get(self, src, dst):
         return self.instance.get(src, dst)
 
     def put(self, src, dst):
         return self.instance.put(src, dst)
 
+    @timed('poll')
     def poll(self):
         return self.instance.poll()
@@ -32,6 +32,7 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 from MiGBox.common import about, write_config, read_config, get_vars, print_vars
+from MiGBox.log import LogTail, to_html
 from MiGBox.sync import syncd
 from MiGBox.mount import mount, unmount
 from MiGBox.sftp import SFTPClient
@@ -41,6 +42,8 @@ _vars = {}
 _key_pass = ''
 _otp_user = ''
 _otp_pass = ''
+# records kept in the log view, older ones are discarded
+LOG_LINES = 5000
 
 class SyncThread(QThread):
     """
@@ -211,12 +214,42 @@ class _OptionsUi(QDialog):
         mountBoxLayout.addWidget(self.mountPathButton, 0, 2)
         mountGroupBox.setLayout(mountBoxLayout)
 
+        # limits in KiB and operations per second, applied to a running synchronization
+        networkLabel = QLabel("Network (KiB/s)")
+        self.networkEdit = QSpinBox()
+        self.networkEdit.setRange(0, 10485760)
+        self.networkEdit.setSpecialValueText("unlimited")
+        self.networkEdit.setValue(int(_vars["Throttle"]["network_rate"] or 0))
+
+        diskLabel = QLabel("Disk (KiB/s)")
+        self.diskEdit = QSpinBox()
+        self.diskEdit.setRange(0, 10485760)
+        self.diskEdit.setSpecialValueText("unlimited")
+        self.diskEdit.setValue(int(_vars["Throttle"]["disk_rate"] or 0))
+
+        operationsLabel = QLabel("Operations (1/s)")
+        self.operationsEdit = QSpinBox()
+        self.operationsEdit.setRange(0, 1000000)
+        self.operationsEdit.setSpecialValueText("unlimited")
+        self.operationsEdit.setValue(int(_vars["Throttle"]["operations_rate"] or 0))
+
+        throttleGroupBox = QGroupBox("Limits")
+        throttleBoxLayout = QGridLayout()
+        throttleBoxLayout.addWidget(networkLabel, 0, 0)
+        throttleBoxLayout.addWidget(self.networkEdit, 0, 1)
+        throttleBoxLayout.addWidget(diskLabel, 1, 0)
+        throttleBoxLayout.addWidget(self.diskEdit, 1, 1)
+        throttleBoxLayout.addWidget(operationsLabel, 2, 0)
+        throttleBoxLayout.addWidget(self.operationsEdit, 2, 1)
+        throttleGroupBox.setLayout(throttleBoxLayout)
+
         buttonBox = QDialogButtonBox(QDialogButtonBox.Ok|QDialogButtonBox.Cancel)
 
         layout = QVBoxLayout()
         layout.addWidget(serverGroupBox)
         layout.addWidget(clientGroupBox)
         layout.addWidget(mountGroupBox)
+        layout.addWidget(throttleGroupBox)
         layout.addWidget(buttonBox)
         self.setLayout(layout)
 
@@ -237,6 +270,11 @@ class _OptionsUi(QDialog):
         _vars["KeyAuth"]["userkey"] = str(self.prvKeyPathEdit.text())
         _vars["KeyAuth"]["hostkey"] = str(self.pubKeyPathEdit.text())
         _vars["Mount"]["mountpath"] = str(self.mountEdit.text())
+        _vars["Throttle"]["network_rate"] = str(self.networkEdit.value())
+        _vars["Throttle"]["disk_rate"] = str(self.diskEdit.value())
+        _vars["Throttle"]["operations_rate"] = str(self.operationsEdit.value())
+        syncd.set_limits(_vars["Throttle"]["network_rate"], _vars["Throttle"]["disk_rate"],
+                         _vars["Throttle"]["operations_rate"])
         global _otp_user
         global _otp_pass
         _otp_user = str(self.usernameEdit.text())
@@ -290,12 +328,13 @@ class AppUi(QMainWindow):
 
         if not os.path.isfile(_vars["Logging"]["logfile"]):
             _vars["Logging"]["logfile"] = logfile
-        with open(_vars["Logging"]["logfile"], 'wb') as f:
-            f.write("New log file ...<br />")
+        # new log file, the appended records are rendered by _refreshViews
+        open(_vars["Logging"]["logfile"], 'wb').close()
+        self.logTail = LogTail(_vars["Logging"]["logfile"])
  
         self.logBrowser = QTextBrowser()
         self.logBrowser.setLineWrapMode(QTextEdit.NoWrap)
-        self.logBrowser.setSource(QUrl.fromLocalFile(_vars["Logging"]["logfile"]))
+        self.logBrowser.document().setMaximumBlockCount(LOG_LINES)
 
         self.logPathButton = QPushButton("Path")
         self.logPathButton.setToolTip("Set path to log file")
@@ -450,13 +489,24 @@ class AppUi(QMainWindow):
         event.accept()
 
     def _refreshViews(self):
-        self.logBrowser.reload()
-        self.logBrowser.moveCursor(QTextCursor.End)
-        self.logBrowser.ensureCursorVisible() 
-        self.srcTreeView.setModel(self.srcFsModel)
-        self.srcTreeView.setRootIndex(self.srcFsModel.index(_vars["Sync"]["source"]))
-        self.dstTreeView.setModel(self.dstFsModel)
-        self.dstTreeView.setRootIndex(self.dstFsModel.index(_vars["Sync"]["destination"]))
+        # append only the new records, the document drops the oldest lines
+        entries, reset = self.logTail.read()
+        if reset:
+            self.logBrowser.clear()
+        for entry in entries[-LOG_LINES:]:
+            self.logBrowser.append(to_html(entry))
+        if entries:
+            self.logBrowser.moveCursor(QTextCursor.End)
+            self.logBrowser.ensureCursorVisible() 
+        # the models watch the shown directories and update changed paths
+        # themselves, only a changed root is set again
+        self._setRoot(self.srcTreeView, self.srcFsModel, _vars["Sync"]["source"])
+        self._setRoot(self.dstTreeView, self.dstFsModel, _vars["Sync"]["destination"])
+
+    def _setRoot(self, view, model, path):
+        if QDir(model.rootPath()) != QDir(path):
+            model.setRootPath(path)
+            view.setRootIndex(model.index(path))
 
     def _syncError(self, message):
         msgBox = QMessageBox(self)
@@ -622,7 +672,8 @@ class AppUi(QMainWindow):
                                            _vars["Logging"]["logfile"])
         if path:
             _vars["Logging"]["logfile"] = str(QDir.toNativeSeparators(path))
-            self.logBrowser.setSource(QUrl.fromLocalFile(_vars["Logging"]["logfile"]))
+            self.logTail = LogTail(_vars["Logging"]["logfile"])
+            self._refreshViews()
 
 
     def _setSrcPath(self):
@@ -0,0 +1,364 @@
+# MiGBox logging module
+#
+# Copyright (C) 2013 Benjamin Ertl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+MiGBox logging module.
+Provides a non-blocking logging pipeline writing structured records.
+
+The loggers of the synchronization put their records into a bounded
+queue, a listener thread formats them as JSON lines and writes them to
+a rotating log file. The GUI reads the appended records with L{LogTail}
+and renders them with L{to_html}.
+
+Structured fields are passed as C{extra} and written with the record::
+
+    logger.info("SYNC %s ==> %s", src, dst, extra={'action': 'sync_to'})
+"""
+
+import os
+import sys
+import cgi
+import json
+import time
+import logging
+import threading
+
+from Queue import Queue, Full
+from logging.handlers import RotatingFileHandler
+
+# maximum number of records waiting to be written
+QUEUE_SIZE = 10000
+# debug records per second, further ones are suppressed
+DEBUG_RATE = 100
+# size of a log file before it is rotated and number of rotated files kept
+LOG_SIZE = 10485760
+LOG_BACKUPS = 3
+# bytes read from the end of a log file when tailing it from the start
+TAIL_SIZE = 1048576
+
+# attributes of every record, others are structured fields
+_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | \
+              set(('message', 'asctime'))
+
+def fields(record):
+    """
+    Return the structured fields of a record.
+
+    @param record: log record.
+    @type record: L{logging.LogRecord}
+    @return: fields by their names.
+    @rtype: dict
+    """
+
+    return dict((key, value) for key, value in record.__dict__.items()
+                if key not in _ATTRIBUTES)
+
+class JSONFormatter(logging.Formatter):
+    """
+    This class formats records as JSON objects with the time, level,
+    logger, message and the structured fields of the record.
+    """
+
+    def format(self, record):
+        entry = fields(record)
+        entry.update({'time': record.created, 'level': record.levelname,
+                      'logger': record.name, 'message': record.getMessage()})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """
+    This class limits the records up to a level, e.g. debug records,
+    to a rate per second.
+
+    The first record passed after suppressed ones gets their number as
+    C{suppressed} field.
+    """
+
+    def __init__(self, rate=DEBUG_RATE, level=logging.DEBUG):
+        """
+        Create a new filter.
+
+        @param rate: records per second, also the burst allowed.
+        @type rate: int
+        @param level: highest level that is limited.
+        @type level: int
+        """
+
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.level = level
+        self.tokens = float(rate)
+        self.last = time.time()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            if record.levelno <= self.level:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens < 1:
+                    self.suppressed += 1
+                    return False
+                self.tokens -= 1
+            if self.suppressed:
+                record.suppressed = self.suppressed
+                self.suppressed = 0
+        return True
+
+class QueueHandler(logging.Handler):
+    """
+    This class puts records into a queue without blocking.
+
+    Records are dropped if the queue is full, the next queued record
+    gets their number as C{dropped} field.
+    """
+
+    def __init__(self, queue):
+        """
+        Create a new queue handler.
+
+        @param queue: queue of the records, see L{QueueListener}.
+        @type queue: L{Queue.Queue}
+        """
+
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Merge the message and arguments of a record and format its
+        exception, as the record is handled in another thread.
+
+        @param record: log record.
+        @type record: L{logging.LogRecord}
+        @return: the prepared record.
+        @rtype: L{logging.LogRecord}
+        """
+
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if self.dropped:
+                record.dropped = self.dropped
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """
+    This class passes the records of a queue to handlers in its own thread.
+    """
+
+    def __init__(self, queue, *handlers):
+        """
+        Create a new listener.
+
+        @param queue: queue of the records.
+        @type queue: L{Queue.Queue}
+        @param handlers: handlers writing the records.
+        @type handlers: L{logging.Handler}
+        """
+
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        """
+        Start handling the records.
+        """
+
+        self.thread = threading.Thread(target=self._run, name="Logging")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Handle the queued records and stop.
+        """
+
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+def setup(logfile=None, loglevel='INFO', loggers=("sync", "event")):
+    """
+    Log the records of C{loggers} through a queue to C{logfile} as
+    JSON lines, or to stderr if no log file is given.
+
+    The log file is rotated at L{LOG_SIZE}, debug records are limited to
+    L{DEBUG_RATE} per second. Handlers of an earlier setup are removed.
+
+    @param logfile: path to the log file.
+    @type logfile: str
+    @param loglevel: log level, usually 'INFO' or 'DEBUG'.
+    @type loglevel: str
+    @param loggers: names of the loggers.
+    @type loggers: tuple
+    @return: the started listener, to be stopped at the end.
+    @rtype: L{QueueListener}
+    """
+
+    level = getattr(logging, loglevel or 'INFO')
+    if logfile:
+        handler = RotatingFileHandler(logfile, maxBytes=LOG_SIZE, backupCount=LOG_BACKUPS)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter())
+    queue = Queue(QUEUE_SIZE)
+    queue_handler = QueueHandler(queue)
+    queue_handler.addFilter(RateLimitFilter())
+    for name in loggers:
+        logger = logging.getLogger(name)
+        for old in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+            logger.removeHandler(old)
+        logger.setLevel(level)
+        logger.addHandler(queue_handler)
+    listener = QueueListener(queue, handler)
+    listener.start()
+    return listener
+
+def parse(line):
+    """
+    Return the record of a line of a log file.
+
+    @param line: JSON line written by L{JSONFormatter}.
+    @type line: str
+    @return: the record as dictionary, None if the line is no record.
+    @rtype: dict
+    """
+
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) else None
+
+def to_html(entry):
+    """
+    Render a record as a line of the GUI's log view.
+
+    @param entry: record as dictionary, see L{parse}.
+    @type entry: dict
+    @return: HTML line, without line break.
+    @rtype: str
+    """
+
+    text = "{0}: {1} {2}".format(entry.get('level', ''),
+                                 time.strftime("%Y-%m-%d %H:%M:%S",
+                                               time.localtime(entry.get('time', 0))),
+                                 cgi.escape(entry.get('message', '')))
+    for key, what in (('suppressed', 'debug records suppressed'),
+                      ('dropped', 'records dropped')):
+        if entry.get(key):
+            text += " <i>({0} {1})</i>".format(entry[key], what)
+    if entry.get('level') in ('WARNING', 'ERROR', 'CRITICAL'):
+        text = '<font color="red">{0}</font>'.format(text)
+    return text
+
+class LogTail(object):
+    """
+    This class reads the records appended to a log file since the last
+    read.
+
+    If the file was rotated or truncated in the meantime, it is read
+    again from the start, but not more than its last L{TAIL_SIZE} bytes.
+    """
+
+    def __init__(self, path, tail_size=TAIL_SIZE):
+        """
+        Create a new tail of a log file.
+
+        @param path: path to the log file.
+        @type path: str
+        @param tail_size: bytes read from the end of the file at the start.
+        @type tail_size: int
+        """
+
+        self.path = path
+        self.tail_size = tail_size
+        self.offset = 0
+        # identity of the file read, changes when it is rotated
+        self.ident = None
+        # incomplete last line
+        self.rest = ''
+        # the tail starts in a line, which is skipped
+        self.skip = False
+
+    def read(self):
+        """
+        Read the records appended since the last read.
+
+        @return: tuple as (list of records, reset), reset is True if the
+            file is read from the start and earlier records are obsolete.
+        @rtype: tuple
+        """
+
+        try:
+            with open(self.path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                reset = (st.st_dev, st.st_ino) != self.ident or st.st_size < self.offset
+                if reset:
+                    self.ident = (st.st_dev, st.st_ino)
+                    self.offset = max(0, st.st_size - self.tail_size)
+                    self.rest = ''
+                    self.skip = self.offset > 0
+                f.seek(self.offset)
+                data = f.read()
+        except (IOError, OSError):
+            return [], False
+        # the file may have grown since the stat
+        self.offset += len(data)
+        if self.skip:
+            if '\n' in data:
+                data = data[data.find('\n') + 1:]
+                self.skip = False
+            else:
+                data = ''
+        lines = (self.rest + data).split('\n')
+        self.rest = lines.pop()
+        return [entry for entry in (parse(line) for line in lines) if entry], reset
@@ -0,0 +1,499 @@
+# MiGBox metrics module
+#
+# Copyright (C) 2013 Benjamin Ertl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+MiGBox metrics module.
+Provides counters, gauges and latency histograms of the synchronization,
+kept in a registry per process.
+
+All metrics are defined here, the modules they are measured in update them::
+
+    with OPERATION_SECONDS.time(('stat', 'OSFileSystem')):
+        os.stat(path)
+
+The metrics can be served over HTTP in the Prometheus text format, see
+L{serve}.
+"""
+
+import time
+import threading
+import functools
+
+from bisect import bisect_left
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# upper bounds of the latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+class Metric(object):
+    """
+    This class is the base of all metrics.
+
+    A metric has a value for each combination of its label values,
+    e.g. the operation and the file system of a latency.
+    """
+
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        """
+        Create a new metric.
+
+        @param name: name of the metric.
+        @type name: str
+        @param doc: description of the metric.
+        @type doc: str
+        @param labels: names of the labels.
+        @type labels: tuple
+        """
+
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("{0} expects labels {1}, got {2}".format(self.name, self.labels,
+                                                                      labels))
+        return tuple(str(label) for label in labels)
+
+    def _value(self, value):
+        # copy of a value, taken with the lock held
+        return value
+
+    def samples(self):
+        """
+        Return the values of all label values.
+
+        @return: list of tuples as (label values, value).
+        @rtype: list
+        """
+
+        with self.lock:
+            return sorted((key, self._value(value)) for key, value in self.values.items())
+
+    def get(self, labels=()):
+        """
+        Return the value of C{labels}.
+
+        @param labels: label values.
+        @type labels: tuple
+        @return: value, None if not measured yet.
+        """
+
+        key = self._key(labels)
+        with self.lock:
+            value = self.values.get(key)
+            return None if value is None else self._value(value)
+
+    def clear(self):
+        """
+        Forget all values.
+        """
+
+        with self.lock:
+            self.values.clear()
+
+class Counter(Metric):
+    """
+    This class counts events or amounts, like requests or bytes.
+    """
+
+    kind = 'counter'
+
+    def inc(self, labels=(), value=1):
+        """
+        Increase the counter of C{labels} by C{value}.
+
+        @param labels: label values.
+        @type labels: tuple
+        @param value: amount, not negative.
+        @type value: int or float
+        """
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+    """
+    This class holds a current value, like the depth of a queue.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        """
+        Set the gauge of C{labels} to C{value}.
+
+        @param value: value.
+        @type value: int or float
+        @param labels: label values.
+        @type labels: tuple
+        """
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, labels=(), value=1):
+        """
+        Increase the gauge of C{labels} by C{value}.
+
+        @param labels: label values.
+        @type labels: tuple
+        @param value: amount, negative to decrease it.
+        @type value: int or float
+        """
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, labels=(), value=1):
+        """
+        Decrease the gauge of C{labels} by C{value}.
+        """
+
+        self.inc(labels, -value)
+
+class _Timer(object):
+    # context manager observing its duration in a histogram
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.histogram.observe(time.time() - self.start, self.labels)
+
+class Histogram(Metric):
+    """
+    This class counts observations, like latencies, in buckets.
+
+    The value of each label values is a dictionary of the number of
+    observations up to each bucket bound, as C{'buckets'}, their number
+    and their sum.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        """
+        Create a new histogram.
+
+        @param buckets: sorted upper bounds of the buckets.
+        @type buckets: tuple
+        """
+
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """
+        Add an observation of C{labels}.
+
+        @param value: observed value.
+        @type value: int or float
+        @param labels: label values.
+        @type labels: tuple
+        """
+
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one more bucket for observations above all bounds
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def time(self, labels=()):
+        """
+        Return a context manager observing its duration.
+
+        @param labels: label values.
+        @type labels: tuple
+        @return: context manager.
+        """
+
+        return _Timer(self, labels)
+
+    def _value(self, value):
+        buckets, n = [], 0
+        for count in value[0][:-1]:
+            n += count
+            buckets.append(n)
+        return {'buckets': zip(self.buckets, buckets), 'count': value[1], 'sum': value[2]}
+
+class Registry(object):
+    """
+    This class keeps the metrics of a process by their names.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric to the registry.
+
+        @param metric: metric with a name not registered yet.
+        @type metric: L{Metric}
+        @return: the metric.
+        @rtype: L{Metric}
+        """
+
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError("metric {0} already registered".format(metric.name))
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        """
+        Register a new L{Counter}, see L{Metric.__init__}.
+        """
+
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        """
+        Register a new L{Gauge}, see L{Metric.__init__}.
+        """
+
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=BUCKETS):
+        """
+        Register a new L{Histogram}, see L{Histogram.__init__}.
+        """
+
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def collect(self):
+        """
+        Return all metrics sorted by their names.
+
+        @return: list of metrics.
+        @rtype: list
+        """
+
+        with self.lock:
+            return [self.metrics[name] for name in sorted(self.metrics)]
+
+    def snapshot(self):
+        """
+        Return the values of all metrics.
+
+        @return: dictionary as C{{name: {label values: value}}}.
+        @rtype: dict
+        """
+
+        return dict((metric.name, dict(metric.samples())) for metric in self.collect())
+
+    def clear(self):
+        """
+        Forget the values of all metrics.
+        """
+
+        for metric in self.collect():
+            metric.clear()
+
+# registry of the process
+registry = Registry()
+
+OPERATION_SECONDS = registry.histogram(
+    "migbox_operation_seconds", "Duration of file system operations.",
+    ("operation", "filesystem"))
+OPERATION_ERRORS = registry.counter(
+    "migbox_operation_errors_total", "File system operations that raised an error.",
+    ("operation", "filesystem"))
+BYTES_SENT = registry.counter(
+    "migbox_sftp_sent_bytes_total", "Bytes of SFTP packets sent.", ("side",))
+BYTES_RECEIVED = registry.counter(
+    "migbox_sftp_received_bytes_total", "Bytes of SFTP packets received.", ("side",))
+CACHE_REQUESTS = registry.counter(
+    "migbox_cache_requests_total", "Requests of the signature cache by result.", ("result",))
+EVENT_QUEUE_DEPTH = registry.gauge(
+    "migbox_event_queue_depth", "Events waiting to be synchronized.")
+EVENT_LAG = registry.histogram(
+    "migbox_event_lag_seconds", "Time from the arrival of an event until it is synchronized.")
+SCAN_SECONDS = registry.histogram(
+    "migbox_observer_scan_seconds", "Duration of the observer's scans of a tree.")
+SESSIONS = registry.gauge(
+    "migbox_server_sessions", "Active sessions of the server.")
+REQUEST_SECONDS = registry.histogram(
+    "migbox_server_request_seconds", "Duration of the server's requests by command.",
+    ("command",))
+PENDING_REQUESTS = registry.gauge(
+    "migbox_server_pending_requests", "Requests waiting for or running in the worker pool.")
+CACHE_BYTES = registry.gauge(
+    "migbox_cache_bytes", "Size of the values in the signature cache.")
+THROTTLE_SECONDS = registry.counter(
+    "migbox_throttle_wait_seconds_total", "Time waited for the network, disk and operations limits.",
+    ("resource", "priority"))
+
+def timed(operation):
+    """
+    Decorate a method of a file system to observe its duration in
+    L{OPERATION_SECONDS} and count its errors in L{OPERATION_ERRORS}.
+
+    The file system is labeled by the name of its class.
+
+    @param operation: name of the operation.
+    @type operation: str
+    @return: decorator.
+    @rtype: function
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *largs, **kwargs):
+            labels = (operation, type(self).__name__)
+            start = time.time()
+            try:
+                return func(self, *largs, **kwargs)
+            except Exception:
+                OPERATION_ERRORS.inc(labels)
+                raise
+            finally:
+                OPERATION_SECONDS.observe(time.time() - start, labels)
+        return wrapper
+    return decorator
+
+# content type of the text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _sample(name, labels, value):
+    if not labels:
+        return "{0} {1}".format(name, _number(value))
+    labels = ",".join('{0}="{1}"'.format(label, value.replace('\\', r'\\').replace('"', r'\"')
+                                                    .replace('\n', r'\n'))
+                      for label, value in labels)
+    return "{0}{{{1}}} {2}".format(name, labels, _number(value))
+
+def expose(registry=registry):
+    """
+    Return the metrics of C{registry} in the Prometheus text format.
+
+    @param registry: registry of the metrics.
+    @type registry: L{Registry}
+    @return: text.
+    @rtype: str
+    """
+
+    lines = []
+    for metric in registry.collect():
+        lines.append("# HELP {0} {1}".format(metric.name, metric.doc))
+        lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+        for key, value in metric.samples():
+            labels = zip(metric.labels, key)
+            if metric.kind != 'histogram':
+                lines.append(_sample(metric.name, labels, value))
+                continue
+            for bound, count in value['buckets']:
+                lines.append(_sample(metric.name + "_bucket", labels + [('le', _number(bound))],
+                                     count))
+            lines.append(_sample(metric.name + "_bucket", labels + [('le', "+Inf")],
+                                 value['count']))
+            lines.append(_sample(metric.name + "_sum", labels, value['sum']))
+            lines.append(_sample(metric.name + "_count", labels, value['count']))
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # answers GET /metrics with the metrics of the server's registry
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = expose(self.server.registry)
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *largs):
+        # scrapes are not logged
+        pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """
+    This class serves the metrics of a registry over HTTP.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, registry=registry):
+        """
+        Create a new metrics server.
+
+        @param address: tuple as (host, port) to listen on.
+        @type address: tuple
+        @param registry: registry of the metrics.
+        @type registry: L{Registry}
+        """
+
+        HTTPServer.__init__(self, address, _MetricsHandler)
+        self.registry = registry
+
+    def stop(self):
+        """
+        Stop serving and close the socket.
+        """
+
+        self.shutdown()
+        self.server_close()
+
+def serve(host, port, registry=registry):
+    """
+    Serve the metrics of C{registry} at C{http://host:port/metrics} in
+    a daemon thread.
+
+    @param host: host name or ip address, usually localhost.
+    @type host: str
+    @param port: port number, 0 for any free port.
+    @type port: int
+    @param registry: registry of the metrics.
+    @type registry: L{Registry}
+    @return: the running server, see L{MetricsServer.stop}.
+    @rtype: L{MetricsServer}
+    """
+
+    server = MetricsServer((host, int(port)), registry)
+    thread = threading.Thread(target=server.serve_forever, name="Metrics")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -19,13 +19,16 @@
 __version__ = 0.6
 __author__ = 'Benjamin Ertl'
 
-from client import SFTPClient
-from server import Server, SFTPServer
+from client import SFTPClient, ResilientSFTPClient
+from server import Server, SFTPServer, Request, RequestHook
 from server_interface import SFTPServerInterface
 from common import CMD_BLOCKCHK, CMD_DELTA, CMD_PATCH, CMD_OTP, CMD_POLL
 
 __all__ = [ 'SFTPClient',
+            'ResilientSFTPClient',
             'Server',
             'SFTPServer',
+            'Request',
+            'RequestHook',
             'SFTPHandle',
             'SFTPServerInterface' ]
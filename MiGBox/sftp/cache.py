@@ -0,0 +1,134 @@
+# SFTP server cache module
+#
+# Copyright (C) 2013 Benjamin Ertl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+SFTP server cache module.
+Provides a cache for block checksums and deltas shared by all server sessions.
+"""
+
+import os
+import threading
+
+from collections import OrderedDict
+from MiGBox.metrics import CACHE_REQUESTS, CACHE_BYTES
+
+# maximum size of all cached values in bytes
+CACHE_SIZE = 67108864
+
+class SignatureCache(object):
+    """
+    This class caches the results of expensive file computations, like
+    block checksums and deltas, for all sessions of the server.
+
+    Entries are keyed by the file identity (path, inode, size, mtime)
+    and further arguments of the computation, so a modified file never
+    returns a stale entry. The least recently used entries are evicted
+    if the cached values exceed the maximum size.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        """
+        Create a new cache.
+
+        @param maxsize: maximum size of all cached values in bytes.
+        @type maxsize: int
+        """
+
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, path, compute, *largs):
+        """
+        Return the cached value for C{path} or compute it.
+
+        Concurrent requests for the same entry wait for the first one
+        to compute it, instead of computing it again.
+
+        @param path: path of the file.
+        @type path: str
+        @param compute: function without arguments returning the value.
+        @type compute: function
+        @param largs: further key parts, e.g. kind of computation.
+        @type largs: hashable
+        @return: value.
+        @rtype: str
+        """
+
+        st = os.stat(path)
+        key = (path, st.st_ino, st.st_size, st.st_mtime) + largs
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    # move to the end, most recently used
+                    value = self.entries.pop(key)
+                    self.entries[key] = value
+                    self.hits += 1
+                    CACHE_REQUESTS.inc(('hit',))
+                    return value
+                event = self.pending.get(key)
+                if not event:
+                    self.misses += 1
+                    CACHE_REQUESTS.inc(('miss',))
+                    event = self.pending[key] = threading.Event()
+                    break
+            event.wait()
+            if key not in self.entries:
+                # computation failed or file changed, compute it here
+                with self.lock:
+                    self.misses += 1
+                CACHE_REQUESTS.inc(('miss',))
+                break
+        try:
+            value = compute()
+            st = os.stat(path)
+            if key[1:4] == (st.st_ino, st.st_size, st.st_mtime):
+                self._put(key, value)
+            return value
+        finally:
+            with self.lock:
+                if self.pending.get(key) is event:
+                    del self.pending[key]
+            event.set()
+
+    def _put(self, key, value):
+        with self.lock:
+            if len(value) > self.maxsize:
+                return
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.maxsize:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+            CACHE_BYTES.set(self.size)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            CACHE_BYTES.set(0)
@@ -22,12 +22,31 @@ Provides a SFTP client to use as an abstract file system.
 """
 
 import os
+import time
+import errno
 import socket
 import json
+import threading
 import paramiko
 
+from collections import deque
+from paramiko.message import Message
+from paramiko.sftp import CMD_STATUS
 from watchdog.events import *
-from MiGBox.sftp.common import CMD_BLOCKCHK, CMD_DELTA, CMD_PATCH, CMD_OTP, CMD_POLL
+from MiGBox.sftp.common import CMD_BLOCKCHK, CMD_DELTA, CMD_PATCH, CMD_OTP, CMD_POLL, \
+                               CMD_HELLO, CMD_READ_Z, CMD_WRITE_Z, CMD_DIGEST, CODEC_ORDER, \
+                               compress, decompress, compress_delta, decompress_delta
+from MiGBox.sync.delta import ALGORITHM_ORDER, encode_signature, decode_signature
+from MiGBox.metrics import BYTES_SENT, BYTES_RECEIVED
+from MiGBox import throttle
+
+# size of compressed chunk requests and number of requests in flight
+CHUNKSIZE = 262144
+WINDOW = 8
+
+# requests that may have been executed when the connection dropped and
+# change the result if repeated, e.g. a patch applied twice
+_NOT_REPEATED = ('patch', 'rename', 'posix_rename', 'remove', 'unlink', 'rmdir')
 
 class SFTPClient(paramiko.SFTPClient):
     """
@@ -38,10 +57,95 @@ class SFTPClient(paramiko.SFTPClient):
     are forwarded to the C{server} representation aquired from the C{paramiko}
     C{transport}. Therefore, the C{connect} class method can be called with
     authentication information.
+
+    The client can be used by several threads at once. One thread at a
+    time reads the responses and hands the ones of the others over.
     """
 
+    def __init__(self, sock):
+        paramiko.SFTPClient.__init__(self, sock)
+        # arguments of connect, used to reconnect
+        self.connect_args = None
+        # cursor of the last polled server event and id of its journal,
+        # None until the first poll
+        self.cursor = 0
+        self.journal = None
+        # events have been lost, a full resync is needed
+        self.resync = False
+        # compression codec negotiated with the server
+        self.codec = None
+        # strong checksum algorithm negotiated with the server
+        self.algorithm = 'md5'
+        # packets of several threads are not interleaved
+        self._send_lock = threading.Lock()
+        # responses of synchronous requests read by another thread
+        self._responses = {}
+        self._reading = False
+        self._response_cond = threading.Condition()
+
+    def _async_request(self, fileobj, t, *arg):
+        # the data of a request is throttled before the lock of the
+        # client is taken, a waiting thread does not block the others
+        throttle.operations.consume(1)
+        throttle.network.consume(sum(len(a) for a in arg if isinstance(a, str)))
+        with self._send_lock:
+            return paramiko.SFTPClient._async_request(self, fileobj, t, *arg)
+
+    def _read_response(self, waitfor=None):
+        while True:
+            with self._response_cond:
+                while self._reading and waitfor not in self._responses:
+                    self._response_cond.wait()
+                    if waitfor is None:
+                        # just waiting for any response
+                        return None, None
+                if waitfor in self._responses:
+                    t, msg, size = self._responses.pop(waitfor)
+                    break
+                self._reading = True
+            try:
+                t, data = self._read_packet()
+            except EOFError as e:
+                raise paramiko.SSHException('Server connection dropped: %s' % str(e))
+            finally:
+                with self._response_cond:
+                    self._reading = False
+                    self._response_cond.notify_all()
+            msg = Message(data)
+            num = msg.get_int()
+            size = len(data)
+            with self._lock:
+                fileobj = self._expecting.pop(num, None)
+            if num == waitfor:
+                break
+            if fileobj is type(None):
+                # a synchronous request of another thread
+                with self._response_cond:
+                    self._responses[num] = (t, msg, size)
+                    self._response_cond.notify_all()
+            elif fileobj is not None:
+                throttle.network.consume(size)
+                fileobj._async_response(t, msg, num)
+            if waitfor is None:
+                return None, None
+        # received bytes are throttled by the thread they are for
+        throttle.network.consume(size)
+        if t == CMD_STATUS:
+            self._convert_status(msg)
+        return t, msg
+
+    def _write_all(self, out):
+        paramiko.SFTPClient._write_all(self, out)
+        BYTES_SENT.inc(('client',), len(out))
+
+    def _read_all(self, n):
+        data = paramiko.SFTPClient._read_all(self, n)
+        BYTES_RECEIVED.inc(('client',), len(data))
+        return data
+
     @classmethod
-    def connect(cls, host, port, hostkey, userkey, keypass=None, username=None, password=None):
+    def connect(cls, host, port, hostkey, userkey, keypass=None, username=None, password=None,
+                compression=True):
         """
         Create a new SFTP client and connect to C{host}.
 
@@ -64,6 +168,8 @@ class SFTPClient(paramiko.SFTPClient):
         @type username: str
         @param password: the user's password (optional).
         @type password: str
+        @param compression: negotiate compression with the server.
+        @type compression: bool
         @return: L{SFTPClient} or None.
         @rtype: L{SFTPClient}
         """
@@ -95,23 +201,59 @@ class SFTPClient(paramiko.SFTPClient):
         if chan is None:
             return None
         chan.invoke_subsystem('sftp')
-        return cls(chan)
+        client = cls(chan)
+        client.connect_args = (host, port, hostkey, userkey, keypass, username, password,
+                               compression)
+        if compression:
+            client.hello()
+        return client
+
+    def hello(self):
+        """
+        Negotiate the compression codec and strong checksum algorithm
+        with the server.
+
+        Servers without MiGBox extensions reject the request, then
+        nothing is compressed. Older servers support md5 checksums only.
+        """
+
+        try:
+            t, msg = self._request(CMD_HELLO, json.dumps({"compression": CODEC_ORDER,
+                                                          "checksums": ALGORITHM_ORDER}))
+            features = json.loads(msg.get_string())
+        except (IOError, ValueError):
+            features = {}
+        self.codec = str(features.get("compression", "")) or None
+        self.algorithm = str(features.get("checksums", "md5"))
 
-    def checksums(self, path):
+    def is_active(self):
+        """
+        Return True if the channel and transport of this client are alive.
+
+        @return: transport is alive.
+        @rtype: bool
+        """
+
+        chan = self.get_channel()
+        return not chan.closed and chan.get_transport().is_active()
+
+    def checksums(self, path, strong=True):
         """
         Send a request to the server to compute block checksums of
-        a given file.
+        a given file, with the negotiated strong checksum algorithm.
 
         @param path: path to the file.
         @type path: str
+        @param strong: compute strong checksums of the blocks.
+        @type strong: bool
         @return: block checksums of the file as a hashtable.
         @rtype: dict
         """
 
         path = self._adjust_cwd(path)
-        t, msg = self._request(CMD_BLOCKCHK, path)
+        t, msg = self._request(CMD_BLOCKCHK, path, self.algorithm, int(not strong))
         j = msg.get_string()
-        bs = json.loads(j)
+        bs = decode_signature(j)
         return bs
 
     def delta(self, path, checksums):
@@ -128,9 +270,9 @@ class SFTPClient(paramiko.SFTPClient):
         """
 
         path = self._adjust_cwd(path)
-        t, msg = self._request(CMD_DELTA, path, json.dumps(checksums))
+        t, msg = self._request(CMD_DELTA, path, encode_signature(checksums), self.codec or '')
         j = msg.get_string()
-        d = json.loads(j)
+        d = decompress_delta(json.loads(j))
         return d
 
     def patch(self, path, delta):
@@ -145,7 +287,74 @@ class SFTPClient(paramiko.SFTPClient):
         """
 
         path = self._adjust_cwd(path)
-        self._request(CMD_PATCH, path, json.dumps(delta))
+        self._request(CMD_PATCH, path, json.dumps(compress_delta(delta, self.codec)))
+
+    def digest(self, path, length):
+        """
+        Send a request to the server to compute the md5 of the first
+        C{length} bytes of a given file.
+
+        Servers without this extension reject the request with an IOError.
+
+        @param path: path to the file.
+        @type path: str
+        @param length: number of bytes.
+        @type length: int
+        @return: hex digest.
+        @rtype: str
+        """
+
+        path = self._adjust_cwd(path)
+        t, msg = self._request(CMD_DIGEST, path, long(length))
+        return msg.get_string()
+
+    def read_chunks(self, path, offset, size):
+        """
+        Read a file from C{offset} to C{size} in compressed chunks.
+
+        Up to L{WINDOW} requests are in flight to hide the latency.
+
+        @param path: path to the file.
+        @type path: str
+        @param offset: offset to start reading.
+        @type offset: int
+        @param size: size of the file.
+        @type size: int
+        @return: generator of data chunks.
+        @rtype: generator
+        """
+
+        path = self._adjust_cwd(path)
+        responses = _Responses(self)
+        pending = deque()
+        while offset < size or pending:
+            while offset < size and len(pending) < WINDOW:
+                pending.append(self._async_request(responses, CMD_READ_Z, path, long(offset),
+                                                   CHUNKSIZE, self.codec or ''))
+                offset += CHUNKSIZE
+            msg = responses.wait(pending.popleft())
+            data = decompress(msg.get_string(), msg.get_string())
+            if not data:
+                break
+            yield data
+
+    def chunk_writer(self, path, offset):
+        """
+        Return a writer for a file from C{offset} in compressed chunks.
+
+        The file is created or truncated if C{offset} is 0.
+
+        @param path: path to the file.
+        @type path: str
+        @param offset: offset to start writing.
+        @type offset: int
+        @return: file like object with C{write}, C{seek}, C{flush} and C{close}.
+        @rtype: L{_ChunkWriter}
+        """
+
+        if not offset:
+            self.open(path, 'wb').close()
+        return _ChunkWriter(self, self._adjust_cwd(path), offset)
 
     def onetimepass(self):
         """
@@ -162,19 +371,30 @@ class SFTPClient(paramiko.SFTPClient):
     def poll(self):
         """
         Request file system events on the server.
+
+        Sends the cursor and journal id of the last poll, so that a new
+        session continues with the events the old session did not see.
+        Sets C{resync} if the server could not provide all of them.
+
+        @return: list of events.
+        @rtype: list
         """
 
-        try:
-            #print "send poll"
-            t, msg = self._request(CMD_POLL)
-            #print "received poll"
-            j = msg.get_string()
-            events = json.loads(j)
-            events = map(self._deserialize_event, events)
-            return events
-        except Exception as e:
-            print e.args
-            return []
+        #print "send poll"
+        t, msg = self._request(CMD_POLL, long(self.cursor), self.journal or '')
+        #print "received poll"
+        j = msg.get_string()
+        r = json.loads(j)
+        if not r["complete"]:
+            self.resync = True
+        self.cursor = r["cursor"]
+        # servers without journal ids treat every poll as a new client's
+        self.journal = r.get("journal")
+        events = map(self._deserialize_event, r["events"])
+        for event, e in zip(events, r["events"]):
+            # servers before the size was sent schedule all events as small
+            event.size = e.get("size", 0)
+        return events
 
     def _deserialize_event(self, event):
         type_ = event["event_type"]
@@ -199,3 +419,159 @@ class SFTPClient(paramiko.SFTPClient):
                 return DirMovedEvent(event["src_path"], event["dst_path"])
             else:
                 return FileMovedEvent(event["src_path"], event["dst_path"])
+
+class _Responses(object):
+    """
+    Collects responses of pipelined requests, see L{SFTPClient.read_chunks}.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.msgs = {}
+
+    def _async_response(self, t, msg, num):
+        self.msgs[num] = (t, msg)
+
+    def wait(self, num):
+        while num not in self.msgs:
+            self.client._read_response()
+        t, msg = self.msgs.pop(num)
+        if t == CMD_STATUS:
+            # raises IOError on failure
+            self.client._convert_status(msg)
+        return msg
+
+class _ChunkWriter(object):
+    """
+    Writes compressed chunks with pipelined requests, see L{SFTPClient.chunk_writer}.
+    """
+
+    def __init__(self, client, path, offset):
+        self.client = client
+        self.path = path
+        self.offset = offset
+        self.responses = _Responses(client)
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is None:
+            self.close()
+
+    def write(self, data):
+        codec, payload = compress(data, self.client.codec)
+        self.pending.append(self.client._async_request(self.responses, CMD_WRITE_Z, self.path,
+                                                       long(self.offset), codec, payload))
+        self.offset += len(data)
+        while len(self.pending) > WINDOW:
+            self.responses.wait(self.pending.popleft())
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # skipped ranges are left as holes by the server
+        self.offset = offset + (self.offset if whence == os.SEEK_CUR else 0)
+
+    def flush(self):
+        while self.pending:
+            self.responses.wait(self.pending.popleft())
+
+    def close(self):
+        self.flush()
+
+class ResilientSFTPClient(object):
+    """
+    Wrapper for a L{SFTPClient} that reconnects if the transport dropped.
+
+    All requests are forwarded to the wrapped client. If a request fails
+    and the transport is no longer active, a new client is connected with
+    the same arguments, waiting with exponential backoff between attempts,
+    and the request is repeated once. The event cursor is handed over to
+    the new client, so polling resumes where it stopped.
+
+    Requests that change the files in a way that must not be repeated,
+    like patches, renames and removes, raise an C{IOError} after the
+    reconnect instead and set C{resync}, so that the files are planned
+    again.
+    """
+
+    def __init__(self, client, retries=5, backoff=1, max_backoff=60):
+        """
+        Create a new wrapper for C{client}.
+
+        @param client: connected client, see L{SFTPClient.connect}.
+        @type client: L{SFTPClient}
+        @param retries: number of connection attempts per reconnect.
+        @type retries: int
+        @param backoff: seconds to wait after the first failed attempt.
+        @type backoff: float
+        @param max_backoff: maximum seconds to wait between attempts.
+        @type max_backoff: float
+        """
+
+        self.client = client
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+        def request(*largs, **kwargs):
+            return self._call(name, *largs, **kwargs)
+        return request
+
+    def _call(self, name, *largs, **kwargs):
+        try:
+            return getattr(self.client, name)(*largs, **kwargs)
+        except Exception:
+            if self.client.is_active():
+                raise
+        self.reconnect()
+        if name in _NOT_REPEATED:
+            self.client.resync = True
+            raise IOError(errno.EIO, "Connection dropped, {0} not repeated".format(name))
+        return getattr(self.client, name)(*largs, **kwargs)
+
+    def reconnect(self):
+        """
+        Replace the wrapped client with a newly connected one, unless
+        another thread already did.
+
+        Raises L{paramiko.SSHException} if all attempts failed.
+        """
+
+        with self.lock:
+            if not self.client.is_active():
+                self._reconnect()
+
+    def _reconnect(self):
+        delay = self.backoff
+        for attempt in xrange(self.retries):
+            try:
+                client = self.client.connect(*self.client.connect_args)
+            except (socket.error, EOFError, paramiko.SSHException):
+                client = None
+            if client:
+                client.cursor = self.client.cursor
+                client.journal = self.client.journal
+                client.resync = self.client.resync
+                try:
+                    self.client.close()
+                except Exception:
+                    pass
+                self.client = client
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+        raise paramiko.SSHException("Reconnect failed.")
+
+    @property
+    def resync(self):
+        return self.client.resync
+
+    @resync.setter
+    def resync(self, value):
+        self.client.resync = value
@@ -21,8 +21,161 @@ SFTP common module.
 Provides common constants and functions for client and server.
 """
 
+import zlib
+import base64
+
+from MiGBox.sync.delta import COPY, LITERAL, ZERO, BLOCKSIZE
+
+try:
+    from lz4.block import compress as lz4_compress, decompress as lz4_decompress
+except ImportError:
+    try:
+        from lz4 import compress as lz4_compress, decompress as lz4_decompress
+    except ImportError:
+        lz4_compress = lz4_decompress = None
+
 CMD_BLOCKCHK = 205
 CMD_DELTA = 206
 CMD_PATCH = 207
 CMD_OTP = 208
 CMD_POLL = 209
+CMD_HELLO = 210
+CMD_READ_Z = 211
+CMD_WRITE_Z = 212
+CMD_DIGEST = 213
+
+# names of the extension commands, e.g. for metrics
+CMD_NAMES = {CMD_BLOCKCHK: 'blockchecksums', CMD_DELTA: 'delta', CMD_PATCH: 'patch',
+             CMD_OTP: 'otp', CMD_POLL: 'poll', CMD_HELLO: 'hello', CMD_READ_Z: 'read_z',
+             CMD_WRITE_Z: 'write_z', CMD_DIGEST: 'digest'}
+
+# zlib compression level
+ZLIB_LEVEL = 6
+# data is compressed only if a sample of this size shrinks below the ratio
+SAMPLE_SIZE = 4096
+SAMPLE_RATIO = 0.9
+
+CODECS = {'zlib': (lambda data: zlib.compress(data, ZLIB_LEVEL), zlib.decompress)}
+if lz4_compress:
+    CODECS['lz4'] = (lz4_compress, lz4_decompress)
+
+# available codecs, fastest first
+CODEC_ORDER = [codec for codec in ('lz4', 'zlib') if codec in CODECS]
+
+def negotiate(offered):
+    """
+    Choose the first codec of C{offered} that is available here.
+
+    @param offered: codec names in order of preference.
+    @type offered: list
+    @return: codec name or empty string for no compression.
+    @rtype: str
+    """
+
+    for codec in offered:
+        if codec in CODECS:
+            return str(codec)
+    return ''
+
+def compressible(data):
+    """
+    Guess if C{data} is worth compressing by compressing a sample.
+
+    Already compressed data (archives, images, video) is detected
+    and bypassed this way.
+
+    @param data: data.
+    @type data: str
+    @return: True if C{data} should be compressed.
+    @rtype: bool
+    """
+
+    sample = data[:SAMPLE_SIZE]
+    if len(sample) < 64:
+        return False
+    return len(zlib.compress(sample, 1)) < SAMPLE_RATIO * len(sample)
+
+def compress(data, codec):
+    """
+    Compress C{data} with C{codec}, if it is compressible.
+
+    @param data: data.
+    @type data: str
+    @param codec: codec name or empty string/None for no compression.
+    @type codec: str
+    @return: tuple as (codec used or empty string, data).
+    @rtype: tuple
+    """
+
+    if codec and compressible(data):
+        payload = CODECS[codec][0](data)
+        if len(payload) < len(data):
+            return codec, payload
+    return '', data
+
+def decompress(codec, data):
+    """
+    Decompress C{data} compressed with C{codec}.
+
+    @param codec: codec name or empty string for uncompressed data.
+    @type codec: str
+    @param data: data.
+    @type data: str
+    @return: data.
+    @rtype: str
+    """
+
+    if codec:
+        return CODECS[codec][1](data)
+    return data
+
+def compress_delta(delta, codec):
+    """
+    Encode a delta for the transfer as json, with compressed literal data.
+
+    Literals are sent as (LITERAL, base64 data, codec used).
+
+    @param delta: delta, see L{MiGBox.sync.delta.delta}.
+    @type delta: list
+    @param codec: codec name or empty string/None for no compression.
+    @type codec: str
+    @return: delta.
+    @rtype: list
+    """
+
+    result = []
+    for instruction in delta:
+        if instruction[0] == LITERAL:
+            used, payload = compress(instruction[1], codec)
+            result.append((LITERAL, base64.b64encode(payload), used))
+        else:
+            result.append(instruction)
+    return result
+
+def decompress_delta(delta):
+    """
+    Revert L{compress_delta}.
+
+    Deltas of older versions as list of (offset, base64 data[, codec])
+    and (offset, '') for single blocks to copy are converted.
+
+    @param delta: delta with compressed literals.
+    @type delta: list
+    @return: delta.
+    @rtype: list
+    """
+
+    result = []
+    for entry in delta:
+        if entry[0] == LITERAL:
+            result.append((LITERAL, decompress(str(entry[2]), base64.b64decode(entry[1]))))
+        elif entry[0] == COPY:
+            result.append((COPY, int(entry[1]), int(entry[2])))
+        elif entry[0] == ZERO:
+            result.append((ZERO, int(entry[1])))
+        elif entry[1]:
+            codec = str(entry[2]) if len(entry) > 2 else ''
+            result.append((LITERAL, decompress(codec, base64.b64decode(entry[1]))))
+        else:
+            result.append((COPY, int(entry[0]), BLOCKSIZE))
+    return result
@@ -0,0 +1,321 @@
+# SFTP server profiler module
+#
+# Copyright (C) 2013 Benjamin Ertl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+SFTP server profiler module.
+Provides a sampling profiler of the requests the server is handling.
+"""
+
+import os
+import sys
+import time
+import marshal
+import threading
+import multiprocessing
+
+from Queue import Empty
+from collections import defaultdict, namedtuple
+
+# seconds between two samples
+INTERVAL = 0.005
+# seconds to wait for the samples of a pool process
+PROCESS_TIMEOUT = 1
+
+# function of a frame sampled in another process
+_Code = namedtuple('_Code', 'co_filename co_firstlineno co_name')
+
+class SamplingProfiler(object):
+    """
+    This class samples the stacks of all threads that are handling a
+    request, while it is running.
+
+    A thread handles a request if its stack has a frame of one of the
+    request functions, e.g. L{MiGBox.sftp.server.SFTPServer._process}.
+    The function maps that frame to the name of the request, e.g. the
+    command, which becomes the root of the sampled stack. Stacks of
+    idle threads are not sampled, so the samples show where the time
+    of the requests is spent.
+
+    The samples are written as collapsed stacks for flamegraph.pl and
+    as a pstats file, like the ones of cProfile, with sampled times and
+    sample counts as call counts.
+
+    Work of a request that is done in the processes of a pool only shows
+    as waiting for the pool here. The processes are sampled as well with
+    a L{PoolProfiler}, their samples are added when the profiler stops.
+    """
+
+    def __init__(self, requests, interval=INTERVAL, processes=None):
+        """
+        Create a new profiler.
+
+        @param requests: functions of the frames of requests by their code
+                         objects, each returning the request name of a frame.
+        @type requests: dict
+        @param interval: seconds between two samples.
+        @type interval: float
+        @param processes: profiler of the processes of a pool.
+        @type processes: L{PoolProfiler}
+        """
+
+        self.requests = requests
+        self.interval = interval
+        self.processes = processes
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.started = None
+        self.thread = None
+        self.running = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        """
+        Profiler is running.
+        """
+
+        return self.running.isSet()
+
+    def start(self):
+        """
+        Forget earlier samples and start sampling.
+        """
+
+        with self.lock:
+            if self.active:
+                return
+            self.stacks = defaultdict(int)
+            self.samples = 0
+            self.started = time.time()
+            self.running.set()
+            self.thread = threading.Thread(target=self._run, name="Profiler")
+            self.thread.daemon = True
+            self.thread.start()
+            if self.processes:
+                self.processes.start()
+
+    def stop(self):
+        """
+        Stop sampling, the samples are kept until the next start.
+        """
+
+        with self.lock:
+            if not self.active:
+                return
+            self.running.clear()
+            self.thread.join()
+            self.thread = None
+            if self.processes:
+                for name, stack, count in self.processes.stop():
+                    self.stacks[(name,) + tuple(_Code(*code) for code in stack)] += count
+
+    def export(self):
+        """
+        Return the samples with the functions as tuples, e.g. to send
+        them to another process.
+
+        @return: list of tuples as (request name, stack, count), the stack
+                 as tuple of (filename, first line, function name).
+        @rtype: list
+        """
+
+        return [(stack[0], tuple((code.co_filename, code.co_firstlineno, code.co_name)
+                                 for code in stack[1:]), count)
+                for stack, count in self.stacks.items()]
+
+    def _run(self):
+        ident = threading.current_thread().ident
+        while self.running.isSet():
+            for thread, frame in sys._current_frames().items():
+                if thread != ident:
+                    self._sample(frame)
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def _sample(self, frame):
+        # frames from the innermost to the request frame
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            name = self.requests.get(frame.f_code)
+            if name:
+                try:
+                    name = name(frame)
+                except Exception:
+                    name = frame.f_code.co_name
+                self.stacks[(name,) + tuple(reversed(stack))] += 1
+                return
+            frame = frame.f_back
+
+    def collapsed(self):
+        """
+        Return the samples as collapsed stacks.
+
+        Each line is a stack from the request to the sampled function
+        separated by semicolons and the number of samples, the format of
+        flamegraph.pl.
+
+        @return: collapsed stacks.
+        @rtype: str
+        """
+
+        lines = []
+        for stack, count in sorted(self.stacks.items()):
+            frames = [stack[0]] + ["{0} ({1}:{2})".format(code.co_name,
+                                                         os.path.basename(code.co_filename),
+                                                         code.co_firstlineno)
+                                   for code in stack[1:]]
+            lines.append("{0} {1}".format(";".join(frames), count))
+        return "".join(line + "\n" for line in lines)
+
+    def stats(self):
+        """
+        Return the samples as pstats dictionary, see L{pstats.Stats}.
+
+        Times are the sampled seconds, call counts the number of samples.
+
+        @return: dictionary as C{{function: (cc, nc, tt, ct, callers)}}.
+        @rtype: dict
+        """
+
+        stats = {}
+        for stack, count in self.stacks.items():
+            t = count * self.interval
+            functions = [("~", 0, "<request {0}>".format(stack[0]))] + \
+                        [(code.co_filename, code.co_firstlineno, code.co_name)
+                         for code in stack[1:]]
+            seen = set()
+            for i, function in enumerate(functions):
+                cc, nc, tt, ct, callers = stats.get(function, (0, 0, 0.0, 0.0, {}))
+                if function not in seen:
+                    # recursive calls count once in the cumulative time
+                    cc, nc, ct = cc + count, nc + count, ct + t
+                    seen.add(function)
+                if i == len(functions) - 1:
+                    tt += t
+                if i:
+                    caller = functions[i - 1]
+                    c = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c[0] + count, c[1] + count,
+                                       c[2] + (t if i == len(functions) - 1 else 0), c[3] + t)
+                stats[function] = (cc, nc, tt, ct, callers)
+        return stats
+
+    def dump(self, path):
+        """
+        Write the samples to C{path}.prof as pstats file and to
+        C{path}.folded as collapsed stacks.
+
+        @param path: path of the files without their suffixes.
+        @type path: str
+        @return: paths of the written files.
+        @rtype: tuple
+        """
+
+        with open(path + ".prof", 'wb') as f:
+            marshal.dump(self.stats(), f)
+        with open(path + ".folded", 'w') as f:
+            f.write(self.collapsed())
+        return path + ".prof", path + ".folded"
+
+class PoolProfiler(object):
+    """
+    This class samples the processes of a L{multiprocessing.Pool} for
+    a L{SamplingProfiler}.
+
+    The pool has to be created with L{profile_process} as initializer
+    and L{initargs} as its arguments, then every process samples itself
+    while the profiler is running and sends its samples when it stops::
+
+        processes = PoolProfiler({_patch: 'patch'})
+        pool = Pool(4, profile_process, processes.initargs)
+        profiler = SamplingProfiler(requests, processes=processes)
+    """
+
+    def __init__(self, requests, interval=INTERVAL):
+        """
+        Create a new pool profiler.
+
+        @param requests: request names by the functions run in the pool,
+                         the functions have to be defined at module level.
+        @type requests: dict
+        @param interval: seconds between two samples.
+        @type interval: float
+        """
+
+        self.running = multiprocessing.Event()
+        self.results = multiprocessing.Queue()
+        # samples of earlier runs that came too late are dropped
+        self.run = multiprocessing.Value('i', 0)
+        self.workers = multiprocessing.Value('i', 0)
+        self.initargs = (requests, interval, self.running, self.results, self.run, self.workers)
+
+    def start(self):
+        """
+        Start sampling in the processes.
+        """
+
+        with self.run.get_lock():
+            self.run.value += 1
+        self.running.set()
+
+    def stop(self):
+        """
+        Stop sampling and collect the samples of the processes.
+
+        @return: samples, see L{SamplingProfiler.export}.
+        @rtype: list
+        """
+
+        self.running.clear()
+        samples = []
+        for i in xrange(self.workers.value):
+            try:
+                run, found = self.results.get(timeout=PROCESS_TIMEOUT)
+            except Empty:
+                break
+            if run == self.run.value:
+                samples.extend(found)
+        return samples
+
+def profile_process(requests, interval, running, results, run, workers):
+    """
+    Initializer of the processes of a pool sampled by a L{PoolProfiler},
+    with the arguments in L{PoolProfiler.initargs}.
+
+    Starts a thread in the process, that samples it while the pool
+    profiler is running and puts the samples into its queue.
+    """
+
+    with workers.get_lock():
+        workers.value += 1
+    profiler = SamplingProfiler(dict((func.__code__, lambda frame, name=name: name)
+                                     for func, name in requests.items()), interval)
+
+    def sample():
+        while True:
+            running.wait()
+            current = run.value
+            profiler.start()
+            while running.is_set():
+                time.sleep(0.05)
+            profiler.stop()
+            results.put((current, profiler.export()))
+    thread = threading.Thread(target=sample, name="Profiler")
+    thread.daemon = True
+    thread.start()
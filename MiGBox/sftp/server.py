@@ -33,6 +33,7 @@ MiGBox comes with ABSOLUTELY NO WARRANTY. This is free software,
 and you are welcome to redistribute it under certain conditions.
 
 type 'license' to show license information
+type 'profile' to start or stop profiling the requests
 type 'exit' to shutdown the server
 """.format(__version__, __author__)
 
@@ -42,15 +43,37 @@ import time
 import threading
 import socket
 import select
+import struct
 import base64
 import paramiko
 
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+
+from paramiko.common import WARNING
+from paramiko.message import Message
+from paramiko.sftp import CMD_NAMES as SFTP_CMD_NAMES, CMD_VERSION, CMD_OPEN, CMD_OPENDIR, \
+                         CMD_STAT, CMD_LSTAT, CMD_SETSTAT, CMD_REMOVE, CMD_MKDIR, CMD_RMDIR, \
+                         CMD_REALPATH, CMD_RENAME, CMD_READLINK, CMD_SYMLINK
 from Crypto.Hash import MD5
-from watchdog.observers.polling import PollingObserver as Observer
-from MiGBox.sync import EventQueue, EventHandler
-from MiGBox.sftp.common  import CMD_BLOCKCHK, CMD_DELTA, CMD_PATCH, CMD_OTP, CMD_POLL
+from MiGBox.sync import EventJournal, EventHandler, Observer
+from MiGBox.sftp.common  import CMD_BLOCKCHK, CMD_DELTA, CMD_PATCH, CMD_OTP, CMD_POLL, \
+                                CMD_HELLO, CMD_READ_Z, CMD_WRITE_Z, CMD_DIGEST, CMD_NAMES
 from MiGBox.common import about
-from MiGBox.sftp.server_interface import SFTPServerInterface
+from MiGBox.sftp.server_interface import SFTPServerInterface, _patch
+from MiGBox.sync.delta import _range_checksums, _range_delta
+from MiGBox.sftp.cache import SignatureCache
+from MiGBox.sftp.profiler import SamplingProfiler, PoolProfiler, profile_process
+from MiGBox.metrics import BYTES_SENT, BYTES_RECEIVED, SESSIONS, REQUEST_SECONDS, \
+                           PENDING_REQUESTS, serve
+
+# default maximum number of concurrent connections
+MAX_CONNECTIONS = 512
+
+# requests whose first field is a path
+_PATH_COMMANDS = (CMD_OPEN, CMD_OPENDIR, CMD_STAT, CMD_LSTAT, CMD_SETSTAT, CMD_REMOVE, CMD_MKDIR,
+                  CMD_RMDIR, CMD_REALPATH, CMD_RENAME, CMD_READLINK, CMD_SYMLINK, CMD_BLOCKCHK,
+                  CMD_DELTA, CMD_PATCH, CMD_READ_Z, CMD_WRITE_Z, CMD_DIGEST)
 
 class Server(paramiko.ServerInterface):
     """
@@ -59,7 +82,7 @@ class Server(paramiko.ServerInterface):
     It handles the public key authentication.
     """
 
-    def __init__(self, root, userkey, salt):
+    def __init__(self, root, userkey, salt, journal, cache, pool, processes=None, hooks=()):
         """
         Create a new server that handles the public key authentication.
 
@@ -67,17 +90,28 @@ class Server(paramiko.ServerInterface):
         @type root: str
         @param userkey: path to the user's public key.
         @type userkey: str
+        @param journal: event journal shared by all sessions.
+        @type journal: L{MiGBox.sync.EventJournal}
+        @param cache: checksum and delta cache shared by all sessions.
+        @type cache: L{MiGBox.sftp.cache.SignatureCache}
+        @param pool: worker pool for checksums, deltas and patches.
+        @type pool: L{multiprocessing.pool.ThreadPool}
+        @param processes: process pool doing the computations for the
+                          workers, or None to compute in the workers.
+        @type processes: L{multiprocessing.Pool}
+        @param hooks: hooks called around each request of the sessions.
+        @type hooks: list of L{RequestHook}
         """
 
         super(Server, self).__init__()
         self.root = root
         self.userkey = userkey
         self.salt = salt
-        self.eventQueue = EventQueue()
-        self.eventHandler = EventHandler(self.eventQueue)
-        self.observer = Observer()
-        self.observer.schedule(self.eventHandler, path=self.root, recursive=True)
-        self.observer.start()
+        self.journal = journal
+        self.cache = cache
+        self.pool = pool
+        self.processes = processes
+        self.hooks = hooks
 
     def check_channel_request(self, kind, chanid):
         """
@@ -130,13 +164,147 @@ class Server(paramiko.ServerInterface):
 
         return 'publickey,password'
 
+def _command_name(t):
+    # name of a request type for the metrics
+    return CMD_NAMES.get(t) or SFTP_CMD_NAMES.get(t) or str(t)
+
+class Request(object):
+    """
+    This class describes a request of a session for the L{RequestHook}s.
+
+    @ivar number: request number of the session.
+    @ivar t: request type.
+    @ivar command: name of the request type, e.g. 'delta' or 'open'.
+    @ivar path: path of the request, None for requests on handles.
+    @ivar size: size of the request in bytes.
+    @ivar start: time the request was received.
+    @ivar response_size: size of the response in bytes, set when answered.
+    @ivar duration: seconds until the response was sent, set when answered.
+    """
+
+    def __init__(self, number, t, msg):
+        self.number = number
+        self.t = t
+        self.command = _command_name(t)
+        data = msg.asbytes()
+        self.size = len(data)
+        self.path = Message(data).get_string() if t in _PATH_COMMANDS else None
+        self.start = time.time()
+        self.response_size = None
+        self.duration = None
+
+class RequestHook(object):
+    """
+    This class is the base of hooks around the requests of the server.
+
+    L{before} is called when a request is received, L{after} when its
+    response is sent, possibly from a worker thread. Hooks must not
+    block, exceptions are logged and otherwise ignored.
+    """
+
+    def before(self, request):
+        """
+        Called before the request is processed.
+
+        @param request: the request.
+        @type request: L{Request}
+        """
+
+        pass
+
+    def after(self, request):
+        """
+        Called after the response was sent.
+
+        @param request: the request with its response size and duration.
+        @type request: L{Request}
+        """
+
+        pass
+
+class MetricsHook(RequestHook):
+    """
+    This hook observes the duration of the requests in
+    L{MiGBox.metrics.REQUEST_SECONDS}.
+    """
+
+    def after(self, request):
+        REQUEST_SECONDS.observe(request.duration, (request.command,))
+
+def _call(func, *largs):
+    # run func in a worker, exceptions are returned as they can not be raised
+    try:
+        return True, func(*largs)
+    except Exception as e:
+        return False, str(e)
+
 class SFTPServer(paramiko.SFTPServer):
     """
     This class inherits from L{paramiko.SFTPServer}.
 
     It is required here to overwrite/extend the paramiko.SFTPServer. 
+
+    Checksums, deltas and patches are computed by the server's worker pool
+    and answered when done, while the session keeps processing other
+    requests. Responses may thus be sent from other threads.
     """
 
+    def __init__(self, *largs, **kwargs):
+        paramiko.SFTPServer.__init__(self, *largs, **kwargs)
+        self.send_lock = threading.Lock()
+        # requests waiting for their response by request numbers
+        self.requests = {}
+
+    def _send_packet(self, t, packet):
+        data = packet.asbytes() if isinstance(packet, Message) else packet
+        with self.send_lock:
+            paramiko.SFTPServer._send_packet(self, t, data)
+        if t != CMD_VERSION and len(data) >= 4:
+            # responses start with the number of their request
+            request = self.requests.pop(struct.unpack('>I', data[:4])[0], None)
+            if request:
+                request.response_size = len(data)
+                request.duration = time.time() - request.start
+                self._hook('after', request)
+
+    def _hook(self, name, request):
+        for hook in self.get_server().hooks:
+            try:
+                getattr(hook, name)(request)
+            except Exception as e:
+                self._log(WARNING, "request hook failed: {0}".format(e))
+
+    def _write_all(self, out):
+        paramiko.SFTPServer._write_all(self, out)
+        BYTES_SENT.inc(('server',), len(out))
+
+    def _read_all(self, n):
+        data = paramiko.SFTPServer._read_all(self, n)
+        BYTES_RECEIVED.inc(('server',), len(data))
+        return data
+
+    def _dispatch(self, request_number, t, func, *largs):
+        """
+        Run C{func} with C{largs} in the worker pool and send the result
+        as response to the request.
+        """
+
+        def respond(result):
+            PENDING_REQUESTS.dec()
+            ok, resp = result
+            try:
+                if not ok:
+                    self._send_status(request_number, paramiko.SFTP_FAILURE, resp)
+                elif isinstance(resp, int):
+                    self._send_status(request_number, resp)
+                else:
+                    self._response(request_number, t, resp)
+            except Exception:
+                # session ended in the meantime
+                pass
+        PENDING_REQUESTS.inc()
+        self.get_server().pool.apply_async(_call, (func,) + largs, callback=respond)
+
     def _process(self, t, request_number, msg):
         """
         Overwritten method for processing incoming requests to except
@@ -146,46 +314,96 @@ class SFTPServer(paramiko.SFTPServer):
 
         See L{paramiko.SFTPServer._process}
         """
+
+        request = Request(request_number, t, msg)
+        self.requests[request_number] = request
+        self._hook('before', request)
+        return self._process_command(t, request_number, msg)
+
+    def _process_command(self, t, request_number, msg):
         if t == CMD_BLOCKCHK:
             path = msg.get_string()
-            resp = self.server.blockchecksums(path)
-            self._response(request_number, t, resp)
-            return
+            # old clients send no algorithm, that reads as md5, and want
+            # strong checksums
+            algorithm = msg.get_string()
+            strong = not msg.get_int()
+            self._dispatch(request_number, t, self.server.blockchecksums, path, algorithm,
+                           strong)
         elif t == CMD_DELTA:
             path = msg.get_string()
             bs = msg.get_string()
-            resp = self.server.delta(path, bs)
-            self._response(request_number, t, resp)
+            # old clients send no codec, that reads as no compression
+            codec = msg.get_string()
+            self._dispatch(request_number, t, self.server.delta, path, bs, codec)
         elif t == CMD_PATCH:
             path = msg.get_string()
             d = msg.get_string()
-            self._send_status(request_number, self.server.patch(path, d))
+            self._dispatch(request_number, t, self.server.patch, path, d)
         elif t == CMD_OTP:
             self._send_status(request_number, self.server.onetimepass()) 
         elif t == CMD_POLL:
             #print "received poll"
-            resp = self.server.poll()
+            # old clients send no cursor and journal id, that reads as
+            # 0 and empty, a new client
+            cursor = msg.get_int64()
+            journal = msg.get_string()
+            resp = self.server.poll(cursor, journal)
             #print "send poll" + resp + "\n"
             self._response(request_number, t, resp)
+        elif t == CMD_HELLO:
+            resp = self.server.hello(msg.get_string())
+            self._response(request_number, t, resp)
+        elif t == CMD_READ_Z:
+            path = msg.get_string()
+            offset = msg.get_int64()
+            length = msg.get_int()
+            codec = msg.get_string()
+            resp = self.server.read_chunk(path, offset, length, codec)
+            if isinstance(resp, tuple):
+                self._response(request_number, t, *resp)
+            else:
+                self._send_status(request_number, resp)
+        elif t == CMD_WRITE_Z:
+            path = msg.get_string()
+            offset = msg.get_int64()
+            codec = msg.get_string()
+            data = msg.get_string()
+            self._send_status(request_number,
+                              self.server.write_chunk(path, offset, codec, data))
+        elif t == CMD_DIGEST:
+            path = msg.get_string()
+            length = msg.get_int64()
+            self._dispatch(request_number, t, self.server.digest, path, length)
         else:
             return paramiko.SFTPServer._process(self, t, request_number, msg)
 
     @classmethod
-    def run_server(cls, conn, addr, hostkey, userkey, root, salt):
+    def start_transport(cls, conn, hostkey, server):
+        """
+        Start the SSH transport for a new connection.
+
+        The transport runs in its own thread and serves the
+        sftp subsystem until the client disconnects.
+
+        @param conn: socket of the connection.
+        @type conn: socket
+        @param hostkey: the server's private key.
+        @type hostkey: L{paramiko.RSAKey}
+        @param server: server interface for authentication.
+        @type server: L{Server}
+        @return: the transport.
+        @rtype: L{paramiko.Transport}
+        """
+
         transport = paramiko.Transport(conn)
-        transport.add_server_key(paramiko.RSAKey.from_private_key_file(hostkey))
+        transport.add_server_key(hostkey)
         transport.set_subsystem_handler('sftp', cls, SFTPServerInterface)
-        server = Server(root, userkey, salt)
         transport.start_server(threading.Event(), server)
+        return transport
 
-        while transport.is_active():
-            time.sleep(1)
-
-        server.observer.stop()
-        server.observer.join()
-        transport.close()
-
-def run(host, port, hostkey, userkey, rootpath, backlog=0, logfile=None, loglevel=None):
+def run(host, port, hostkey, userkey, rootpath, backlog=0, logfile=None, loglevel=None,
+        max_connections=None, workers=None, processes=None, metrics_host=None,
+        metrics_port=None, hooks=()):
     """
     Main entry point to run the sftp server.
 
@@ -205,6 +423,21 @@ def run(host, port, hostkey, userkey, rootpath, backlog=0, logfile=None, logleve
     @type logfile: str
     @param loglevel: log level, usually 'INFO' or 'DEBUG'
     @type loglevel: str
+    @param max_connections: maximum number of concurrent connections.
+    @type max_connections: int
+    @param workers: number of workers for checksums, deltas and patches.
+    @type workers: int
+    @param processes: number of processes computing checksums, deltas
+                      and patches for the workers, 0 to compute in the workers.
+    @type processes: int
+    @param metrics_host: host name or ip address to serve the metrics on,
+                         localhost by default.
+    @type metrics_host: str
+    @param metrics_port: port number to serve the metrics on, no metrics
+                         are served if not set.
+    @type metrics_port: int
+    @param hooks: further hooks called around each request.
+    @type hooks: list of L{RequestHook}
     """
 
     if logfile:
@@ -217,11 +450,40 @@ def run(host, port, hostkey, userkey, rootpath, backlog=0, logfile=None, logleve
     server_socket.listen(int(backlog))
     server_socket.setblocking(0)
 
+    # config values are empty strings if not set
+    max_connections = int(max_connections) if max_connections else MAX_CONNECTIONS
+    workers = int(workers) if workers else cpu_count()
+    processes = int(processes) if processes not in (None, '') else cpu_count()
+    # the work of checksums, deltas and patches in the processes is
+    # sampled there, it only shows as waiting for the pool in this one
+    process_profiler = PoolProfiler({_range_checksums: 'blockchecksums',
+                                     _range_delta: 'delta', _patch: 'patch'})
+    # fork the processes before any other thread is started
+    process_pool = Pool(processes, profile_process, process_profiler.initargs) \
+                   if processes > 0 else None
+    pool = ThreadPool(workers)
+
     # this random salt is the same for all server instances
     # used to generated and verify one-time-passwords
     salt = os.urandom(16)
 
-    client_threads = []
+    # one observer for all sessions, clients poll the journal with
+    # their own cursor and can resume after a reconnect
+    journal = EventJournal()
+    observer = Observer()
+    observer.schedule(EventHandler(journal), path=rootpath, recursive=True)
+    observer.start()
+    cache = SignatureCache()
+    hostkey = paramiko.RSAKey.from_private_key_file(hostkey)
+    metrics = serve(metrics_host or 'localhost', metrics_port) if metrics_port else None
+    hooks = [MetricsHook()] + list(hooks)
+    # requests are sampled in the session threads and the workers
+    profiler = SamplingProfiler({
+        SFTPServer._process.__func__.__code__: lambda frame: _command_name(frame.f_locals['t']),
+        _call.__code__: lambda frame: frame.f_locals['func'].__name__},
+        processes=process_profiler if process_pool else None)
+
+    transports = []
     # select from stdin does not work on windows, see python select and stdin
     # therefor, stdin is deactivated on windows
     input_select = [server_socket, sys.stdin]
@@ -231,19 +493,44 @@ def run(host, port, hostkey, userkey, rootpath, backlog=0, logfile=None, logleve
     print header
     running = True
     while running:
-        input_ready, output_ready, except_ready = select.select(input_select, [], [])
+        input_ready, output_ready, except_ready = select.select(input_select, [], [], 1)
+        # forget about closed connections
+        transports = [t for t in transports if t.is_active()]
+        SESSIONS.set(len(transports))
         for input_ in input_ready:
             if input_ == server_socket:
                 conn, addr = server_socket.accept()
-                thread = threading.Thread(target=SFTPServer.run_server,
-                                          args=(conn, addr, hostkey, userkey, rootpath, salt))
-                client_threads.append(thread)
-                thread.start()
+                if len(transports) >= max_connections:
+                    conn.close()
+                    continue
+                server = Server(rootpath, userkey, salt, journal, cache, pool, process_pool,
+                                hooks)
+                transports.append(SFTPServer.start_transport(conn, hostkey, server))
             elif input_ == sys.stdin:
                 in_ = sys.stdin.readline()
                 if in_.rstrip() == 'license':
                     print about
+                if in_.rstrip() == 'profile':
+                    if profiler.active:
+                        profiler.stop()
+                        print 'Profile written to {0} and {1}'.format(*profiler.dump(
+                            "migbox-profile-" + time.strftime("%Y%m%d-%H%M%S")))
+                    else:
+                        profiler.start()
+                        print 'Profiling ...'
                 if in_.rstrip() == 'exit':
                     running = False
     print 'Server is going down ...'
+    profiler.stop()
+    for transport in transports:
+        transport.close()
+    pool.close()
+    pool.join()
+    if process_pool:
+        process_pool.close()
+        process_pool.join()
+    observer.stop()
+    observer.join()
+    if metrics:
+        metrics.stop()
     server_socket.close()
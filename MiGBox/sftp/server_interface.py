@@ -24,15 +24,24 @@ Provides a SFTP server interface for the MiG SFTP server.
 import os
 import base64
 import json
+import hashlib
 
 import paramiko
 
-from Queue import Empty
 from Crypto import Random
 from Crypto.Hash import MD5
 from watchdog.events import DirMovedEvent, FileMovedEvent 
 
-from MiGBox.sync.delta import blockchecksums, delta, patch
+from MiGBox.sync.delta import blockchecksums, delta, patch, negotiate_algorithm, \
+                              encode_signature, decode_signature
+from MiGBox.sftp.common import negotiate, compress, decompress, compress_delta, decompress_delta
+
+# The following functions do the CPU heavy work for the interface.
+# They are defined at module level, so they can be sent to the
+# worker processes of the server.
+
+def _patch(path, data):
+    return patch(path, decompress_delta(json.loads(data)))
 
 class SFTPHandle(paramiko.SFTPHandle):
     """
@@ -87,7 +96,11 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         super(paramiko.SFTPServerInterface, self).__init__(*largs, **kwargs)
         self.root = os.path.normpath(server.root)
         self.salt = server.salt
-        self.eventQueue = server.eventQueue
+        self.journal = server.journal
+        self.cache = server.cache
+        self.processes = server.processes
+        # events before this session are not of interest
+        self.cursor = self.journal.head
 
     def session_started(self):
         """
@@ -378,24 +391,42 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         except OSError as e:
             return paramiko.SFTPServer.convert_errno(e.errno)
 
-    def blockchecksums(self, path):
+    def _run(self, func, *largs):
+        """
+        Run C{func} with C{largs} in a worker process of the server
+        and return the result, or in this thread if there are none.
+        """
+
+        if self.processes:
+            return self.processes.apply(func, largs)
+        return func(*largs)
+
+    def blockchecksums(self, path, algorithm='', strong=True):
         """
         Get blockchecksums for the given file.
 
         @param path: path.
         @type path: str
+        @param algorithm: strong checksum algorithm, md5 if not available.
+        @type algorithm: str
+        @param strong: compute strong checksums of the blocks.
+        @type strong: bool
         @return: blockchecksums.
         @rtype: str (json dict)
         """
 
         path = self._get_path(path)
+        algorithm = negotiate_algorithm([algorithm])
         try:
-            bs = blockchecksums(path)
-        except OSError as e:
-            bs = {}
-        return json.dumps(bs)
+            # large files are split and computed by all processes
+            compute = lambda: encode_signature(blockchecksums(path, pool=self.processes,
+                                                              algorithm=algorithm,
+                                                              strong=strong))
+            return self.cache.get(path, compute, 'blockchecksums', algorithm, strong)
+        except (OSError, IOError) as e:
+            return json.dumps({})
 
-    def delta(self, path, checksums):
+    def delta(self, path, checksums, codec=''):
         """
         Get a delta for the given file to the given checksums.
 
@@ -403,57 +434,167 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         @type path: str
         @param checksums: blockchecksums.
         @type checksums: str (json dict)
+        @param codec: codec to compress the literal data with.
+        @type codec: str
         @return: delta.
         @rtype: str (json list)
         """
 
         path = self._get_path(path)
-        bs = json.loads(checksums)
+        codec = negotiate([codec])
+        def compute():
+            # large files are split and searched by all processes
+            d = delta(path, decode_signature(checksums), pool=self.processes)
+            return json.dumps(compress_delta(d, codec))
+        # clients with the same old version of a file get the same delta
+        basis = hashlib.md5(checksums).hexdigest()
         try:
-            d = delta(path, bs)
-        except OSError as e:
-            d = []
-        return json.dumps(d)
+            return self.cache.get(path, compute, 'delta', basis, codec)
+        except (OSError, IOError) as e:
+            return json.dumps([])
 
-    def patch(self, path, patch):
+    def patch(self, path, data):
         """
         Patch the given path with patch.
 
+        The patched file is written next to C{path} and replaces it only
+        if patching succeeded, so an interrupted patch leaves the file
+        untouched.
+
         @param path: path.
         @type path: str
-        @param patch: patch data.
-        @type patch: str (json list)
+        @param data: patch data.
+        @type data: str (json list)
         @return: return code.
         @rtype: int
         """
 
         path = self._get_path(path)
-        d = json.loads(patch)
-        patched = patch(path, d)
         try:
+            patched = self._run(_patch, path, data)
             os.rename(patched, path)
             return paramiko.SFTP_OK
-        except OSError as e:
+        except (OSError, IOError) as e:
             return paramiko.SFTPServer.convert_errno(e.errno)
 
-    def poll(self):
+    def hello(self, features):
         """
-        Poll for events observed by the watchdog file system observer.
+        Negotiate features with the client.
 
-        @return: list of events.
-        @rtype: str (json list)
+        @param features: features offered by the client.
+        @type features: str (json dict)
+        @return: features chosen by the server.
+        @rtype: str (json dict)
         """
 
-        r = []
+        offered = json.loads(features)
+        return json.dumps({"compression": negotiate(offered.get("compression", [])),
+                           "checksums": negotiate_algorithm(offered.get("checksums", []))})
+
+    def read_chunk(self, path, offset, length, codec=''):
+        """
+        Read and compress a chunk of the given file.
+
+        @param path: path.
+        @type path: str
+        @param offset: offset of the chunk.
+        @type offset: int
+        @param length: length of the chunk.
+        @type length: int
+        @param codec: codec to compress the chunk with.
+        @type codec: str
+        @return: tuple as (codec used, data) or error code.
+        @rtype: tuple I{or error code}
+        """
+
+        path = self._get_path(path)
         try:
-            while True:
-                event = self.eventQueue.get_nowait()
-                r.append(event)
-        except Empty:
-            pass
-            #print "empty"
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except (OSError, IOError) as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return compress(data, negotiate([codec]))
+
+    def write_chunk(self, path, offset, codec, data):
+        """
+        Decompress and write a chunk to the given, existing file.
+
+        @param path: path.
+        @type path: str
+        @param offset: offset of the chunk.
+        @type offset: int
+        @param codec: codec the chunk is compressed with.
+        @type codec: str
+        @param data: chunk data.
+        @type data: str
+        @return: return code.
+        @rtype: int
+        """
+
+        path = self._get_path(path)
+        try:
+            data = decompress(codec, data)
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            return paramiko.SFTP_OK
+        except (OSError, IOError) as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def digest(self, path, length):
+        """
+        Compute the md5 of the first bytes of the given file, e.g. to
+        verify a partial transfer.
+
+        @param path: path.
+        @type path: str
+        @param length: number of bytes.
+        @type length: int
+        @return: hex digest or error code.
+        @rtype: str I{or error code}
+        """
+
+        path = self._get_path(path)
+        md5 = hashlib.md5()
+        try:
+            with open(path, 'rb') as f:
+                while length > 0:
+                    data = f.read(min(262144, length))
+                    if not data:
+                        # shorter than length, no digest matches
+                        return paramiko.SFTP_FAILURE
+                    md5.update(data)
+                    length -= len(data)
+        except (OSError, IOError) as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return md5.hexdigest()
+
+    def poll(self, cursor=0, journal=''):
+        """
+        Poll for events observed by the watchdog file system observer.
+
+        A client that reconnects sends the cursor and journal id of its
+        last poll to get the events it missed in between. If the journal
+        does not reach back that far or is not the one of the cursor, e.g.
+        after a restart of the server, complete is False and the client
+        has to resynchronize.
+
+        @param cursor: last known event cursor.
+        @type cursor: int
+        @param journal: journal id of C{cursor}, empty for a client that
+                        has not polled yet, which gets this session's events.
+        @type journal: str
+        @return: new cursor, journal id, complete flag and list of events.
+        @rtype: str (json dict)
+        """
+
+        if not journal:
+            cursor, journal = self.cursor, None
+        self.cursor, complete, r = self.journal.since(cursor, journal)
         r = filter(lambda x: isinstance(x, dict), map(self._serialize_event, r))
-        return json.dumps(r)
+        return json.dumps({"cursor": self.cursor, "journal": self.journal.id,
+                           "complete": complete, "events": r})
 
     def _serialize_event(self, event):
         dst_path = ""
@@ -464,6 +605,8 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         except IndexError:
             return
         else:
+            # the size of the file schedules the event on the client
             return {"event_type": event.event_type, "src_path": src_path,
-                    "dst_path": dst_path, "is_dir": event.is_directory}
+                    "dst_path": dst_path, "is_dir": event.is_directory,
+                    "size": getattr(event, "size", 0)}
          
@@ -19,7 +19,9 @@
 __version__ = 0.6
 __author__ = 'Benjamin Ertl'
 
-from sync import EventQueue, EventHandler, sync_events, sync_file, sync_all_files
+from sync import EventQueue, EventJournal, EventHandler, Observer, sync_events, sync_file, \
+                 sync_all_files, rescan
+from plan import SyncPlan, plan_sync
 
-__all__ = [ 'EventQueue', 'EventHandler', 'sync_events', 'sync_file',
-            'sync_all_files', 'delta', 'rsync', 'sync', 'syncd' ]
+__all__ = [ 'EventQueue', 'EventJournal', 'EventHandler', 'Observer', 'sync_events', 'sync_file',
+            'sync_all_files', 'rescan', 'SyncPlan', 'plan_sync', 'delta', 'plan', 'rsync', 'sync', 'syncd' ]
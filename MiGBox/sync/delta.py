@@ -21,10 +21,72 @@ Module for delta computation.
 Provides methods for checksum and delta computation and application. 
 """
 
+import os
+import sys
+import re
+import errno
 import zlib, hashlib
-import base64
+import base64, binascii
+import array, bisect
+import cPickle
+import tempfile
+from itertools import izip
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
 
 BLOCKSIZE = 64
+# delta instructions, (COPY, offset, length) copies a range of the
+# other file, (LITERAL, data) writes new data and (ZERO, length) leaves
+# a hole of zeros
+COPY = 'C'
+LITERAL = 'L'
+ZERO = 'Z'
+# files are split into ranges of this size for parallel checksums and deltas
+RANGESIZE = 16777216
+# bytes read at once while searching for matching blocks
+BUFSIZE = 1048576
+
+# modulus of the adler32 checksum
+ADLER = 65521
+# lseek whence values to find the data and holes of sparse files
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
+# bits of the weak checksum index per block, and its minimum and
+# maximum size in bits, powers of 2
+INDEXBITS = 64
+MIN_INDEXSIZE = 65536
+MAX_INDEXSIZE = 1073741824
+
+# strong checksum algorithms by name, in order of preference
+ALGORITHMS = {'md5': hashlib.md5, 'sha1': hashlib.sha1}
+ALGORITHM_ORDER = ['md5']
+if blake2b:
+    ALGORITHMS['blake2b'] = blake2b
+    ALGORITHM_ORDER.insert(0, 'blake2b')
+# default strong checksum algorithm
+ALGORITHM = ALGORITHM_ORDER[0]
+# maximum digest size of the algorithms
+DIGEST_SIZES = {'md5': 16, 'sha1': 20, 'blake2b': 64}
+# minimum digest size
+MIN_DIGEST_SIZE = 8
+# bits of a digest in addition to the ones needed for the number of
+# comparisons, the probability of a false match is below 2**-SAFETY_BITS
+SAFETY_BITS = 40
+
+# table of the last delta in a worker process, as (token, table, index, bitset)
+_table = (None, None, None, None)
 
 def weakchecksum(data):
     """
@@ -37,126 +99,867 @@ def weakchecksum(data):
     """
     return zlib.adler32(data) & 0xffffffff
 
-def strongchecksum(data):
+def _new(algorithm, digest_size):
+    # new hash object of the algorithm
+    if algorithm == 'blake2b':
+        return blake2b(digest_size=digest_size)
+    return ALGORITHMS[algorithm]()
+
+def _hasher(algorithm, digest_size):
+    # function returning the truncated digest of data
+    proto = _new(algorithm, digest_size)
+    def digest(data):
+        h = proto.copy()
+        h.update(data)
+        return h.digest()[:digest_size]
+    return digest
+
+def strongchecksum(data, algorithm=ALGORITHM, digest_size=None):
     """
     Compute strong checksum.
 
     @param data: data for checksum computation.
     @type data: str
-    @return: md5 hexdigest.
+    @param algorithm: name of the algorithm, see L{ALGORITHMS}.
+    @type algorithm: str
+    @param digest_size: bytes of the digest, all if None.
+    @type digest_size: int
+    @return: digest.
+    @rtype: str
+    """
+    return _hasher(algorithm, digest_size or DIGEST_SIZES[algorithm])(data)
+
+def negotiate_algorithm(offered):
+    """
+    Choose the first strong checksum algorithm of C{offered} that
+    is available here.
+
+    @param offered: algorithm names in order of preference.
+    @type offered: list
+    @return: algorithm name, md5 if none is available.
     @rtype: str
     """
-    md5 = hashlib.md5()
-    md5.update(data)
-    return md5.hexdigest()
+    for algorithm in offered:
+        if algorithm in ALGORITHMS:
+            return str(algorithm)
+    return 'md5'
 
-def blockchecksums(filename, size=BLOCKSIZE):
+def digest_size(filesize, size=BLOCKSIZE, algorithm=ALGORITHM):
+    """
+    Return the digest size for the strong checksums of a file.
+
+    A delta compares up to one block per byte of the file to all blocks
+    of the file, the digest is long enough to keep the probability of a
+    false match of these comparisons below 2**-L{SAFETY_BITS}.
+
+    @param filesize: size of the file.
+    @type filesize: int
+    @param size: block size.
+    @type size: int
+    @param algorithm: name of the algorithm.
+    @type algorithm: str
+    @return: digest size in bytes.
+    @rtype: int
+    """
+    bits = 2 * filesize.bit_length() - size.bit_length() + 1 + SAFETY_BITS
+    return min(max((bits + 7) // 8, MIN_DIGEST_SIZE), DIGEST_SIZES[algorithm])
+
+def encode_signature(signature):
+    """
+    Encode block checksums from L{blockchecksums} as json.
+
+    @param signature: block checksums.
+    @type signature: dict
+    @return: json.
+    @rtype: str
+    """
+    signature = dict(signature)
+    # base64 digests for json
+    signature['blocks'] = [(off, weak, strong and base64.b64encode(strong))
+                           for off, weak, strong in signature['blocks']]
+    if 'digest' in signature:
+        signature['digest'] = base64.b64encode(signature['digest'])
+    return json.dumps(signature)
+
+def decode_signature(data):
+    """
+    Decode block checksums encoded by L{encode_signature}.
+
+    Plain tables of md5 hexdigests of older versions are decoded as well.
+
+    @param data: json.
+    @type data: str
+    @return: block checksums.
+    @rtype: dict
+    """
+    signature = json.loads(data)
+    if 'blocks' in signature:
+        decode = base64.b64decode
+        signature['algorithm'] = str(signature['algorithm'])
+    else:
+        decode = binascii.unhexlify
+        blocks = sorted(block for blocks in signature.itervalues() for block in blocks)
+        signature = {'algorithm': 'md5', 'digest_size': 16,
+                     'blocksize': BLOCKSIZE, 'blocks': blocks}
+    signature['blocks'] = [(off, weak, strong and decode(strong))
+                           for off, weak, strong in signature['blocks']]
+    if 'zeros' in signature:
+        signature['zeros'] = [tuple(zeros) for zeros in signature['zeros']]
+    if 'digest' in signature:
+        signature['digest'] = decode(signature['digest'])
+    return signature
+
+def _block_weaks(data, size):
+    """
+    Compute the weak checksums of all full blocks of data with numpy.
+
+    @param data: data for checksum computation.
+    @type data: str
+    @param size: block size.
+    @type size: int
+    @return: adler32 checksums.
+    @rtype: L{numpy.ndarray}
+    """
+    n = len(data) // size
+    x = numpy.frombuffer(data, dtype=numpy.uint8, count=n*size).reshape(n, size)
+    x = x.astype(numpy.int64)
+    a = (1 + x.sum(axis=1)) % ADLER
+    b = (size + x.dot(numpy.arange(size, 0, -1))) % ADLER
+    return (b << 16) | a
+
+def _rolling_weaks(data, size):
+    """
+    Compute the weak checksums of the blocks at all positions of data
+    with numpy.
+
+    The sums of a block are differences of cumulative sums over data,
+    which are exact for data of some MB.
+
+    @param data: data for checksum computation.
+    @type data: str
+    @param size: block size.
+    @type size: int
+    @return: adler32 checksums, one for each position with a full block.
+    @rtype: L{numpy.ndarray}
+    """
+    x = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+    n = len(x) - size + 1
+    c = numpy.concatenate(([0], numpy.cumsum(x)))
+    d = numpy.concatenate(([0], numpy.cumsum(x * numpy.arange(len(x)))))
+    s = c[size:] - c[:n]
+    # sum of (size - i) * x[p + i] is (p + size) * s - sum of j * x[j]
+    a = (1 + s) % ADLER
+    b = (size + (numpy.arange(size, n + size) * s) - (d[size:] - d[:n])) % ADLER
+    return (b << 16) | a
+
+def _table_of(blocks):
+    """
+    Create a table of the blocks of checksums from L{blockchecksums}
+    keyed by their weak checksums.
+
+    @param blocks: blocks of the checksums.
+    @type blocks: list
+    @return: hashtable of lists of tuples as (block offset, strong checksum).
+    @rtype: dict
+    """
+    table = {}
+    for off, weak, strong in blocks:
+        if weak in table:
+            table[weak].append((off, strong))
+        else:
+            table[weak] = [(off, strong)]
+    return table
+
+def _slot(h, mask):
+    # spread weak checksums over the bits of an index, the low bits
+    # of an adler32 checksum are not spread well
+    return ((h * 2654435761) >> 7) & mask
+
+def _index(table):
+    """
+    Create an index of the weak checksums of the table, a bitset
+    with L{INDEXBITS} bits per block.
+
+    The index marks the slots of all weak checksums. A weak checksum
+    with an unmarked slot is not in the table, that rejects most
+    positions of a search before the table is looked up.
+
+    @param table: table from L{_table_of}.
+    @type table: dict
+    @return: index.
+    @rtype: bytearray
+    """
+    bits = MIN_INDEXSIZE
+    while bits < len(table) * INDEXBITS and bits < MAX_INDEXSIZE:
+        bits <<= 1
+    index = bytearray(bits // 8); mask = bits - 1
+    if numpy:
+        slots = _slot(numpy.fromiter(table, dtype=numpy.int64, count=len(table)), mask)
+        bitset = numpy.frombuffer(index, dtype=numpy.uint8)
+        numpy.bitwise_or.at(bitset, slots >> 3, numpy.left_shift(1, slots & 7).astype(numpy.uint8))
+    else:
+        for h in table:
+            s = _slot(h, mask)
+            index[s >> 3] |= 1 << (s & 7)
+    return index
+
+def _bitset(index):
+    # one byte per bit of the index for lookups with numpy
+    bitset = numpy.unpackbits(numpy.frombuffer(index, dtype=numpy.uint8))
+    return bitset.reshape(-1, 8)[:, ::-1].ravel().astype(numpy.bool_)
+
+def _ranges(end, size, start=0):
+    # split [start, end) into ranges of RANGESIZE, starting at start
+    span = max(RANGESIZE // size, 1) * size
+    return [(offset, min(offset + span, end)) for offset in xrange(start, end, span)]
+
+def _extend(ranges, offset, length):
+    # append the range (offset, length) to ranges, merged with the last one
+    if ranges and sum(ranges[-1]) == offset:
+        ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+    else:
+        ranges.append((offset, length))
+
+def _holes(f, start, end, size=1):
+    """
+    Find the holes of file f between start and end with SEEK_HOLE
+    and SEEK_DATA.
+
+    Without support of the platform or the file system, there are no holes.
+
+    @param f: file.
+    @type f: file
+    @param start: offset to start at.
+    @type start: int
+    @param end: offset to stop at.
+    @type end: int
+    @param size: block size, only the blocks in holes are returned.
+    @type size: int
+    @return: list of tuples as (start, end) of holes.
+    @rtype: list
+    """
+    holes = []
+    if SEEK_HOLE is None:
+        return holes
+    fd = f.fileno(); pos = start
+    try:
+        while pos < end:
+            a = os.lseek(fd, pos, SEEK_HOLE)
+            if a >= end:
+                break
+            try:
+                b = min(os.lseek(fd, a, SEEK_DATA), end)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # hole up to the end of the file
+                b = end
+            a_, b_ = -(-a // size) * size, b // size * size
+            if b_ > a_:
+                holes.append((a_, b_))
+            pos = b
+    except OSError:
+        return []
+    return holes
+
+def _segments(start, end, holes):
+    # split [start, end) into tuples as (start, end, hole) by the holes in it
+    pos = start
+    for a, b in holes:
+        if a > pos:
+            yield pos, a, False
+        yield a, b, True
+        pos = b
+    if pos < end:
+        yield pos, end, False
+
+def _range_checksums(args, throttle=None):
+    """
+    Compute block checksums for a range of file filename.
+
+    Blocks of zeros are not checksummed but returned as ranges of
+    zeros. Blocks in holes of the file are not even read. The data is
+    read in parts of up to L{BUFSIZE} bytes.
+
+    The checksums are returned packed, so they are cheap to send
+    back from a worker process.
+
+    @param args: tuple as (filename, start, end, size, algorithm, digest_size,
+                 strong).
+    @type args: tuple
+    @param throttle: function called with the number of bytes of every
+                     part read, see L{MiGBox.FileSystem.throttle}.
+    @type throttle: function
+    @return: tuple as (offsets, weak checksums, strong checksums, zeros)
+            with the offsets of the blocks from start and the weak
+            checksums as L{array.array}, the strong checksums as
+            concatenated digests, or the digest of the blocks if strong
+            is False, and zeros as list of tuples (offset, length).
+    @rtype: tuple
+    """
+    filename, start, end, size, algorithm, digest_size, blocks = args
+    digest = _hasher(algorithm, digest_size)
+    h = _new(algorithm, digest_size)
+    offsets = array.array('L'); weak = array.array('L'); strong = []; zeros = []
+    zero = '\0' * size
+    # parts of whole blocks
+    span = max(BUFSIZE // size, 1) * size
+    with open(filename, "rb") as f:
+        for a, b, hole in _segments(start, end, _holes(f, start, end, size)):
+            if hole:
+                _extend(zeros, a, b - a)
+                continue
+            f.seek(a)
+            for pos in xrange(a, b, span):
+                data = f.read(min(span, b - pos))
+                if not data:
+                    break
+                if throttle:
+                    throttle(len(data))
+                if numpy:
+                    n = len(data) // size
+                    x = numpy.frombuffer(data, dtype=numpy.uint8, count=n*size).reshape(n, size)
+                    full = x.any(axis=1)
+                    nonzero = numpy.flatnonzero(full)
+                    # runs of zero blocks as (start, end) block numbers
+                    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([1], full, [1]))))
+                    for i, j in edges.reshape(-1, 2).tolist():
+                        _extend(zeros, pos + i * size, (j - i) * size)
+                    offsets.extend((pos - start + nonzero * size).tolist())
+                    weak.extend(_block_weaks(data, size)[nonzero].tolist())
+                    if len(data) % size:
+                        # short last block
+                        offsets.append(pos - start + n * size)
+                        weak.append(weakchecksum(data[n*size:]))
+                        nonzero = numpy.append(nonzero, n)
+                    if blocks:
+                        strong.extend(digest(data[i*size:i*size+size]) for i in nonzero.tolist())
+                    elif len(nonzero) == n + (len(data) % size > 0):
+                        h.update(data)
+                    else:
+                        for i in nonzero.tolist():
+                            h.update(data[i*size:i*size+size])
+                    continue
+                for offset in xrange(pos, pos + len(data), size):
+                    block = data[offset-pos:offset-pos+size]
+                    if block == zero:
+                        _extend(zeros, offset, size)
+                    else:
+                        offsets.append(offset - start)
+                        weak.append(weakchecksum(block))
+                        if blocks:
+                            strong.append(digest(block))
+                        else:
+                            h.update(block)
+    if not blocks:
+        return offsets, weak, h.digest()[:digest_size], zeros
+    return offsets, weak, ''.join(strong), zeros
+
+def blockchecksums(filename, size=BLOCKSIZE, pool=None, algorithm=ALGORITHM, strong=True,
+                   throttle=None):
     """
     Compute block checksums for file filename with size size.
     Chechsums are L{zlib.adler32} checksums as weak checksums
-    and L{hashlib.md5} checksums as strong checksums.
+    and truncated digests of the given algorithm as strong checksums,
+    see L{digest_size}.
+
+    Blocks of zeros, e.g. in holes of sparse files, are not in the
+    blocks but listed as ranges of zeros.
+
+    Without strong checksums of the blocks, the signature is cheap to
+    compute and sufficient to compare files. It contains the digest of
+    the blocks and the strong checksums are None.
+
+    If a pool is given, the file is split into ranges of L{RANGESIZE}
+    which are computed by the pool in parallel.
 
     @param filename: filename.
     @type filename: str
     @param size: block size.
     @type size: int
-    @return: dict as hashtable of tuples as
-            (block offset, weak checksum, strong checksum).
+    @param pool: process pool for parallel computation.
+    @type pool: L{multiprocessing.Pool}
+    @param algorithm: name of the strong checksum algorithm.
+    @type algorithm: str
+    @param strong: compute strong checksums of the blocks.
+    @type strong: bool
+    @param throttle: function called with the number of bytes of every
+                     part read, see L{MiGBox.FileSystem.throttle}. It is
+                     not called by the processes of a pool.
+    @type throttle: function
+    @return: dict with the algorithm, digest_size, blocksize,
+            blocks as list of tuples as
+            (block offset, weak checksum, strong checksum),
+            zeros as list of tuples as (offset, length)
+            and the digest of the file without strong checksums.
     @rtype: dict
     """
+    filesize = os.path.getsize(filename)
+    n = digest_size(filesize, size, algorithm)
+    # the digest of a file is the digest of the digests of its ranges
+    m = n if strong else DIGEST_SIZES[algorithm]
+    spans = _ranges(filesize, size)
+    ranges = [(filename, start, end, size, algorithm, m, strong) for start, end in spans]
+    if pool:
+        parts = pool.imap(_range_checksums, ranges)
+    else:
+        parts = (_range_checksums(r, throttle) for r in ranges)
+    results = []; zeros = []; digests = []
+    for (start, _), (offsets, weak, digest, found) in izip(spans, parts):
+        if strong:
+            results.extend((start + off, h, digest[n*i:n*i+n])
+                           for i, (off, h) in enumerate(izip(offsets, weak)))
+        else:
+            digests.append(digest)
+            results.extend((start + off, h, None) for off, h in izip(offsets, weak))
+        for offset, length in found:
+            _extend(zeros, offset, length)
+    signature = {'algorithm': algorithm, 'digest_size': n, 'blocksize': size, 'blocks': results,
+                 'zeros': zeros}
+    if not strong:
+        signature['digest'] = _hasher(algorithm, m)(''.join(digests))
+    return signature
+
+def _search(filename, table, index, start, end, size=BLOCKSIZE, step=1,
+            digest=strongchecksum, throttle=None):
+    """
+    Search matching blocks in file filename, starting at offset start.
+
+    At every position the block is compared to the table. If it
+    matches, the search continues after the block, else it moves
+    step bytes forward, until the position reaches end.
+
+    @param filename: filename.
+    @type filename: str
+    @param table: table from L{_table_of}.
+    @type table: dict
+    @param index: index from L{_index}.
+    @type index: bytearray
+    @param start: offset to start at.
+    @type start: int
+    @param end: offset to stop at.
+    @type end: int
+    @param size: block size.
+    @type size: int
+    @param step: bytes to move forward if there is no match.
+    @type step: int
+    @param digest: function computing the strong checksum of a block.
+    @type digest: function
+    @param throttle: function called with the number of bytes of every
+                     buffer read, see L{MiGBox.FileSystem.throttle}.
+    @type throttle: function
+    @return: tuple as (matches, position) with matches as list of
+            tuples (offset, basis offset) and the position the search
+            stopped at.
+    @rtype: tuple
+    """
+    matches = []; pos = start
+    mask = len(index) * 8 - 1
     with open(filename, "rb") as f:
-        results = {}; offset = 0
-        data = f.read(size)
-        while data:
-            hmd5 = strongchecksum(data)
+        f.seek(start)
+        buf = f.read(BUFSIZE + size); base = start
+        if throttle:
+            throttle(len(buf))
+        while pos < end:
+            i = pos - base
+            if i + size > len(buf):
+                f.seek(pos)
+                buf = f.read(BUFSIZE + size); base = pos; i = 0
+                if throttle:
+                    throttle(len(buf))
+            data = buf[i:i+size]
+            if not data:
+                break
             h = weakchecksum(data)
-            # unicode keys for compatibility with json over sftp
-            k = unicode(h >> 16)
-            if k in results:
-                results[k].append((offset, h, hmd5))
+            s = _slot(h, mask)
+            if index[s >> 3] & (1 << (s & 7)):
+                match = _strong_match(data, h, table, digest)
+            else:
+                match = None
+            if match is None:
+                # no match, search for matching blocks by moving one byte forward
+                pos += step
             else:
-                results[k] = [(offset, h, hmd5)]
-            offset += size
-            data = f.read(size)
-    return results
+                matches.append((pos, match))
+                pos += size
+    return matches, pos
+
+def _strong_match(data, h, table, digest):
+    # offset of the first block of the table matching data with weak checksum h,
+    # the strong checksum of data is computed once if there are candidates
+    blocks = table.get(h)
+    if blocks:
+        d = digest(data)
+        for off, strong in blocks:
+            if strong == d:
+                return off
+    return None
+
+def _vsearch(filename, table, index, start, end, size=BLOCKSIZE, step=1,
+             digest=strongchecksum, bitset=None, throttle=None):
+    """
+    Search matching blocks like L{_search}, with numpy.
+
+    The weak checksums of all positions of a buffer are computed at once
+    and looked up in the index, so only positions with a weak match are
+    visited one by one. The lookups use the index as one byte per bit,
+    from L{_bitset}, which is built once per delta and passed as
+    C{bitset}, as it is up to 8 times as large as the index.
+    """
+    matches = []; pos = start
+    mask = len(index) * 8 - 1
+    if bitset is None:
+        bitset = _bitset(index)
+    with open(filename, "rb") as f:
+        while pos < end:
+            f.seek(pos)
+            buf = f.read(BUFSIZE + size); base = pos
+            if throttle:
+                throttle(len(buf))
+            if len(buf) < size:
+                # less than a block left at the end of the file
+                found, pos = _search(filename, table, index, pos, end, size, step, digest,
+                                     throttle)
+                matches.extend(found)
+                break
+            h = _rolling_weaks(buf, size)
+            slots = _slot(h, mask)
+            hits = numpy.flatnonzero(bitset[slots]).tolist()
+            limit = min(len(h), end - base)
+            i = k = 0
+            while i < limit:
+                # move forward to the next weak match on the way
+                while k < len(hits) and (hits[k] < i or (hits[k] - i) % step):
+                    k += 1
+                if k == len(hits) or hits[k] >= limit:
+                    i += -(-(limit - i) // step) * step
+                    break
+                i = hits[k]
+                match = _strong_match(buf[i:i+size], int(h[i]), table, digest)
+                if match is None:
+                    i += step
+                else:
+                    matches.append((base + i, match))
+                    i += size
+            pos = base + i
+    return matches, pos
+
+def _range_delta(args):
+    """
+    Search matching blocks in a range of file filename, in a worker process.
+
+    The table is not sent with the ranges, it is pickled to a file
+    which every worker process loads once for all ranges of a delta.
+
+    @param args: tuple as (filename, token, table path, start, end, size,
+                 step, algorithm, digest_size).
+    @type args: tuple
+    @return: tuple as (matches, position), see L{_search}.
+    @rtype: tuple
+    """
+    global _table
+    filename, token, path, start, end, size, step, algorithm, digest_size = args
+    if _table[0] != token:
+        with open(path, 'rb') as f:
+            table = cPickle.load(f)
+        index = _index(table)
+        _table = (token, table, index, _bitset(index) if numpy else None)
+    token, table, index, bitset = _table
+    if numpy:
+        return _vsearch(filename, table, index, start, end, size, step,
+                        _hasher(algorithm, digest_size), bitset)
+    return _search(filename, table, index, start, end, size, step,
+                   _hasher(algorithm, digest_size))
 
-def delta(filename, checksums, size=BLOCKSIZE, step=1):
+def _on_path(p, start, matches, size, step):
+    # whether a search from start with matches at positions matches gets to p
+    i = bisect.bisect_left(matches, (p,))
+    if i < len(matches) and matches[i][0] == p:
+        return True
+    b = matches[i-1][0] + size if i else start
+    return p >= b and (p - b) % step == 0
+
+def _clip(holes, start, end):
+    # holes in [start, end), clipped to it
+    i = max(bisect.bisect_left(holes, (start,)) - 1, 0)
+    result = []
+    for a, b in holes[i:]:
+        if a >= end:
+            break
+        if b > start:
+            result.append((max(a, start), min(b, end)))
+    return result
+
+def _literals(f, start, end, holes, zeros, throttle=None):
+    """
+    Read the new data of file f between start and end as instructions.
+
+    Holes and runs of zeros matching the pattern zeros become
+    L{ZERO} instructions, the rest L{LITERAL} instructions of up to
+    L{BUFSIZE} bytes.
+
+    @param f: file.
+    @type f: file
+    @param start: offset to start at.
+    @type start: int
+    @param end: offset to stop at.
+    @type end: int
+    @param holes: holes of the file from L{_holes}.
+    @type holes: list
+    @param zeros: pattern of runs of zeros.
+    @type zeros: L{re.RegexObject}
+    @param throttle: function called with the number of bytes of every
+                     part read, see L{MiGBox.FileSystem.throttle}.
+    @type throttle: function
+    @return: generator of instructions.
+    @rtype: generator
     """
-    Compute delta for file filename with size size.
+    for a, b, hole in _segments(start, end, _clip(holes, start, end)):
+        if hole:
+            yield (ZERO, b - a)
+            continue
+        f.seek(a)
+        while a < b:
+            data = f.read(min(b - a, BUFSIZE))
+            if not data:
+                break
+            if throttle:
+                throttle(len(data))
+            pos = 0
+            for m in zeros.finditer(data):
+                if m.start() > pos:
+                    yield (LITERAL, data[pos:m.start()])
+                yield (ZERO, m.end() - m.start())
+                pos = m.end()
+            if pos < len(data):
+                yield (LITERAL, data[pos:])
+            a += len(data)
+
+def _append(diff, instruction):
+    # append instruction to diff, merged with a preceding zero instruction
+    if instruction[0] == ZERO and diff and diff[-1][0] == ZERO:
+        diff[-1] = (ZERO, diff[-1][1] + instruction[1])
+    else:
+        diff.append(instruction)
+
+def delta(filename, checksums, step=1, pool=None, throttle=None):
+    """
+    Compute delta for file filename to the block checksums of
+    an other file, with their block size and strong checksums.
+
+    Holes of the file are not searched and runs of zeros of at
+    least a block in the new data are sent as L{ZERO} instructions.
+
+    If a pool is given, the file is split into ranges of L{RANGESIZE}
+    which are searched by the pool in parallel. A search of a range
+    may start out of step with the preceding range, e.g. in the middle
+    of a matching block. Such ranges are searched again from the end
+    of the preceding range, until the search gets in step with the
+    pool's one, so the delta is the same as without a pool.
         
     @param filename: filename.
     @type filename: str
     @param checksums: checksums from L{blockchecksums}
     @type checksums: dict
-    @param size: block size.
-    @type size: int
-    @return: list of tuples as (offset, data).
+    @param step: bytes to move forward if there is no match.
+    @type step: int
+    @param pool: process pool for parallel computation.
+    @type pool: L{multiprocessing.Pool}
+    @param throttle: function called with the number of bytes of every
+                     part read, see L{MiGBox.FileSystem.throttle}. It is
+                     not called by the processes of a pool.
+    @type throttle: function
+    @return: list of instructions as (L{LITERAL}, data) of new data,
+            (L{ZERO}, length) of zeros or (L{COPY}, offset, length)
+            of ranges of the other file to copy.
     @rtype: list
     """
     diff = []
+    algorithm, n = checksums['algorithm'], checksums['digest_size']
+    size = checksums['blocksize']
+    digest = _hasher(algorithm, n)
+    table = _table_of(checksums['blocks'])
+    zeros = re.compile('\0{%d,}' % size)
     with open(filename, "rb") as f:
-        if not checksums:
-            # checksums file was empty, diff is whole file
-            f.seek(0)
-            diff.append((0, base64.b64encode(f.read())))
+        filesize = os.fstat(f.fileno()).st_size
+        holes = _holes(f, 0, filesize)
+        if not table:
+            # checksums file was empty or zeros, diff is whole file
+            for instruction in _literals(f, 0, filesize, holes, zeros, throttle):
+                _append(diff, instruction)
             return diff
-        offset = last = 0; match = False
-        data = f.read(size)
-        while data:
-            h = weakchecksum(data)
-            k = unicode(h >> 16)
-            if k in checksums:
-                for off, weak, strong in checksums[k]:
-                    if h == weak:
-                        if strong == strongchecksum(data):
-                            # match
-                            match = True
-                            with open(filename, "rb") as tmp:
-                                tmp.seek(last)
-                                new_data = tmp.read(offset - last)
-                                # base64 encoding for json/sftp compatibility
-                                new_data = base64.b64encode(new_data)
-                                if new_data:
-                                    diff.append((last, new_data))
-                                diff.append((off, ''))
-                            offset += size
-                            last = offset
-            if not match:
-                # no match, search for matching blocks by moving one byte forward
-                offset += step
-                f.seek(offset)
-            match = False
-            data = f.read(size)
-        if last != offset:
-            f.seek(last)
-            data = f.read(offset - last)
-            diff.append((last, base64.b64encode(data)))
+        # search the data of the file, a search stopping in a hole
+        # continues at the next data
+        extents = [(a, b) for a, b, hole in _segments(0, filesize, holes) if not hole]
+        if pool:
+            # the table is passed to the workers as file, the token tells
+            # them whether they have loaded it already
+            token = os.urandom(8)
+            fd, path = tempfile.mkstemp(prefix='migbox-table-')
+            try:
+                with os.fdopen(fd, 'wb') as t:
+                    cPickle.dump(table, t, cPickle.HIGHEST_PROTOCOL)
+                ranges = [r for a, b in extents for r in _ranges(b, size, a)]
+                results = pool.imap(_range_delta, [(filename, token, path, start, end, size,
+                                                    step, algorithm, n) for start, end in ranges])
+                index = _index(table)
+                matches = []; pos = 0
+                for (start, end), (found, stop) in izip(ranges, results):
+                    pos = max(pos, start)
+                    while pos < end and not _on_path(pos, start, found, size, step):
+                        # single steps, without numpy
+                        found_, pos = _search(filename, table, index, pos, pos + 1, size,
+                                              step, digest, throttle)
+                        matches.extend(found_)
+                    if pos < end:
+                        # in step with the pool's search from here on
+                        matches.extend(found[bisect.bisect_left(found, (pos,)):])
+                        pos = stop
+            finally:
+                os.remove(path)
+        else:
+            index = _index(table)
+            bitset = _bitset(index) if numpy else None
+            matches = []; pos = 0
+            for start, end in extents:
+                if numpy:
+                    found, pos = _vsearch(filename, table, index, max(pos, start), end, size,
+                                          step, digest, bitset, throttle)
+                else:
+                    found, pos = _search(filename, table, index, max(pos, start), end, size,
+                                         step, digest, throttle)
+                matches.extend(found)
+        last = 0
+        for offset, off in matches:
+            if offset > last:
+                for instruction in _literals(f, last, offset, holes, zeros, throttle):
+                    _append(diff, instruction)
+            # the last block may be short
+            length = min(size, filesize - offset)
+            if offset == last and diff and diff[-1][0] == COPY \
+               and diff[-1][1] + diff[-1][2] == off:
+                # block follows the copied range, extend the range
+                diff[-1] = (COPY, diff[-1][1], diff[-1][2] + length)
+            else:
+                diff.append((COPY, off, length))
+            last = offset + size
+        if last < filesize:
+            for instruction in _literals(f, last, filesize, holes, zeros, throttle):
+                _append(diff, instruction)
     return diff
 
-def patch(filename, delta, size=BLOCKSIZE):
+def sparse_write(f, data):
+    """
+    Write data to file f, or seek over it if it is all zeros to leave
+    a hole. Files written this way have to be ended with L{sparse_end}
+    if the last data was skipped.
+
+    @param f: file being written.
+    @type f: file
+    @param data: data.
+    @type data: str
+    @return: whether the data was skipped.
+    @rtype: bool
+    """
+    if data and not data.lstrip('\0'):
+        f.seek(len(data), os.SEEK_CUR)
+        return True
+    f.write(data)
+    return False
+
+def sparse_end(f):
+    """
+    End file f after skipped data by writing its last byte.
+
+    Writing works with all files, while truncating a file over SFTP
+    may lose its data with some servers.
+
+    @param f: file being written.
+    @type f: file
+    """
+    f.seek(-1, os.SEEK_CUR)
+    f.write('\0')
+
+def sparse_copy(src, dst, offset, length, throttle=None):
+    """
+    Copy a range of file src to the current position of file dst.
+    Holes and zeros of src are skipped with L{sparse_write}.
+
+    @param src: file to read.
+    @type src: file
+    @param dst: file being written.
+    @type dst: file
+    @param offset: offset of the range.
+    @type offset: int
+    @param length: length of the range.
+    @type length: int
+    @param throttle: function called with the number of bytes read and
+                     written of every part, see L{MiGBox.FileSystem.throttle}.
+    @type throttle: function
+    @return: whether the end of the range was skipped.
+    @rtype: bool
+    """
+    skipped = False
+    for a, b, hole in _segments(offset, offset + length, _holes(src, offset, offset + length)):
+        if hole:
+            dst.seek(b - a, os.SEEK_CUR)
+            skipped = True
+            continue
+        src.seek(a)
+        while a < b:
+            data = src.read(min(b - a, BUFSIZE))
+            if not data:
+                return skipped
+            skipped = sparse_write(dst, data)
+            if throttle:
+                throttle(len(data) if skipped else 2 * len(data))
+            a += len(data)
+    return skipped
+
+def patch(filename, delta, throttle=None):
     """
     Patch file filename.
     Write patched file to filename + .patched.
 
+    Zeros are not written, the patched file has holes instead.
+
     @param filename: filename.
     @type filename: str
-    @param delta: list of tuples from L{delta}.
+    @param delta: list of instructions from L{delta}.
     @type delta: list of tuples
-    @param size: block size.
-    @type size: int
+    @param throttle: function called with the number of bytes read and
+                     written of every instruction or part of a copied
+                     range, see L{MiGBox.FileSystem.throttle}.
+    @type throttle: function
     @return: name of patched file.
     @rtype: str
     """
-    with open(filename, "rb") as old:
-        with open(filename + ".patched", "wb") as new:
-            for offset, data in delta:
-                if data:
-                    # there was no matching block, write new data
-                    d = base64.b64decode(data)
-                    new.write(d)
-                else:
-                    # there is a matching block we can reuse the data
-                    old.seek(int(offset))
-                    d = old.read(size)
-                    new.write(d)
-    return filename + ".patched"
+    patched = filename + ".patched"
+    try:
+        with open(filename, "rb") as old:
+            with open(patched, "wb") as new:
+                skipped = False
+                for instruction in delta:
+                    if instruction[0] == LITERAL:
+                        # there was no matching block, write new data
+                        new.write(instruction[1])
+                        skipped = False
+                        if throttle:
+                            throttle(len(instruction[1]))
+                    elif instruction[0] == COPY:
+                        # there are matching blocks we can reuse the data
+                        skipped = sparse_copy(old, new, instruction[1], instruction[2], throttle)
+                    elif instruction[0] == ZERO:
+                        new.seek(instruction[1], os.SEEK_CUR)
+                        skipped = True
+                    else:
+                        raise ValueError("Unknown delta instruction %r" % (instruction[0],))
+                if skipped:
+                    # the file ends with a hole
+                    sparse_end(new)
+    except:
+        # do not leave a partially patched file behind
+        if os.path.exists(patched):
+            os.remove(patched)
+        raise
+    return patched
@@ -0,0 +1,415 @@
+# MiGBox sync planner
+#
+# Copyright (C) 2013 Benjamin Ertl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Sync planner for MiGBox.
+Provides a planner comparing two file system abstractions, see
+L{MiGBox.FileSystem}, without changing them.
+
+The resulting L{SyncPlan} lists the actions that synchronize both sides
+in both directions with their estimated cost, and is executed later::
+
+    p = plan_sync(local, remote)
+    print p.summary()
+    p.execute(workers=4)
+"""
+
+import stat
+import errno
+import logging
+import threading
+
+from Queue import Queue, Empty
+
+from MiGBox import throttle
+from MiGBox.sync.sync import get_sync_path, sync_file, copy_file, make_dir, move, \
+                             exists, remove_file, remove_dirs, _temp_suffixes
+
+# kinds of actions in the order they are executed, directories are made
+# before the files in them are moved or copied and removed after the
+# files in them are moved or deleted
+MKDIR = 'mkdir'
+MOVE = 'move'
+DELETE = 'delete'
+RMDIR = 'rmdir'
+COPY = 'copy'
+DELTA = 'delta'
+CONFLICT = 'conflict'
+KINDS = (MKDIR, MOVE, DELETE, RMDIR, COPY, DELTA, CONFLICT)
+
+class Action(object):
+    """
+    This class is an action of a sync plan, from C{src_path} on C{src}
+    to C{dst_path} on C{dst}.
+
+     - L{MKDIR} makes the directory C{dst_path}.
+     - L{COPY} copies the file C{src_path} to C{dst_path}.
+     - L{DELTA} patches C{dst_path} to the newer file C{src_path}.
+     - L{CONFLICT} is a delta of files that both changed, the newer wins.
+     - L{DELETE} removes C{dst_path}, as C{src_path} has been deleted.
+     - L{RMDIR} removes the directory C{dst_path} and the empty
+       directories in it, as C{src_path} has been deleted.
+     - L{MOVE} renames C{moved_from} to C{dst_path}, as C{src_path} is
+       a file that has been moved there.
+
+    C{size} is the estimated number of bytes transferred, the size of the
+    copied or newer file.
+    """
+
+    def __init__(self, kind, src, src_path, dst, dst_path, size=0, moved_from=None):
+        """
+        Create a new action.
+
+        @param kind: kind of the action, one of L{KINDS}.
+        @type kind: str
+        @param src: source file system abstraction.
+        @type src: L{MiGBox.FileSystem}
+        @param src_path: source path.
+        @type src_path: str
+        @param dst: destination file system abstraction.
+        @type dst: L{MiGBox.FileSystem}
+        @param dst_path: destination path.
+        @type dst_path: str
+        @param size: estimated bytes transferred.
+        @type size: int
+        @param moved_from: path on C{dst} renamed by a move.
+        @type moved_from: str
+        """
+
+        self.kind = kind
+        self.src = src
+        self.src_path = src_path
+        self.dst = dst
+        self.dst_path = dst_path
+        self.size = size
+        self.moved_from = moved_from
+
+    def __repr__(self):
+        return "<Action {0} {1} ==> {2}>".format(self.kind, self.src_path, self.dst_path)
+
+    def execute(self):
+        """
+        Execute the action with the sync methods of L{MiGBox.sync.sync}.
+        """
+
+        if self.kind == MKDIR:
+            if not make_dir(self.dst, self.dst_path):
+                raise IOError(errno.EIO, "Cannot make {0}".format(self.dst_path))
+            _synchronized(self.src, self.src_path, self.dst, self.dst_path)
+        elif self.kind == COPY:
+            st = self.src.stat(self.src_path)
+            if not copy_file(self.src, self.src_path, self.dst, self.dst_path):
+                raise IOError(errno.EIO, "Cannot copy {0}".format(self.src_path))
+            # the copy is synchronized unless the file changed meanwhile,
+            # a file deleted later on one side is deleted on the other
+            if self.src.stat(self.src_path).st_mtime == st.st_mtime:
+                _synchronized(self.src, self.src_path, self.dst, self.dst_path,
+                              _checksums(self.src, self.src_path, st))
+        elif self.kind in (DELTA, CONFLICT):
+            sync_file(self.src, self.src_path, self.dst, self.dst_path)
+        elif self.kind == DELETE:
+            # the checksums are kept, a failed delete is planned again
+            if not remove_file(self.dst, self.dst_path):
+                raise IOError(errno.EIO, "Cannot remove {0}".format(self.dst_path))
+            self.src.cache.pop(self.src_path, None)
+        elif self.kind == RMDIR:
+            remove_dirs(self.dst, self.dst_path)
+            if exists(self.dst, self.dst_path):
+                raise IOError(errno.ENOTEMPTY, "Cannot remove {0}".format(self.dst_path))
+            self.dst.cache.pop(self.dst_path, None)
+            self.src.cache.pop(self.src_path, None)
+        elif self.kind == MOVE:
+            if not move(self.dst, self.moved_from, self.dst_path):
+                raise IOError(errno.EIO, "Cannot move {0}".format(self.moved_from))
+            # the renamed file keeps its mtime and checksums
+            if self.moved_from in self.dst.cache:
+                self.dst.cache[self.dst_path] = self.dst.cache.pop(self.moved_from)
+            self.src.cache.pop(get_sync_path(self.dst, self.src, self.moved_from), None)
+            sync_file(self.src, self.src_path, self.dst, self.dst_path)
+
+class SyncPlan(object):
+    """
+    This class is a plan of the actions synchronizing two file system
+    abstractions.
+    """
+
+    def __init__(self, actions):
+        """
+        Create a new plan.
+
+        @param actions: actions of the plan.
+        @type actions: list of L{Action}
+        """
+
+        self.actions = sorted(actions, key=lambda a: (KINDS.index(a.kind), a.dst_path))
+
+    @property
+    def bytes(self):
+        """
+        Estimated bytes transferred.
+        """
+
+        return sum(action.size for action in self.actions)
+
+    @property
+    def operations(self):
+        """
+        Number of actions.
+        """
+
+        return len(self.actions)
+
+    def count(self, kind):
+        """
+        Return the number of actions of a kind.
+
+        @param kind: kind of the actions.
+        @type kind: str
+        @return: number of actions.
+        @rtype: int
+        """
+
+        return sum(1 for action in self.actions if action.kind == kind)
+
+    def summary(self, verbose=False):
+        """
+        Return a summary of the plan as text.
+
+        @param verbose: list every action.
+        @type verbose: bool
+        @return: summary.
+        @rtype: str
+        """
+
+        lines = []
+        if verbose:
+            lines.extend("{0:<8} {1} ==> {2}".format(action.kind.upper(), action.src_path,
+                                                     action.moved_from or action.dst_path)
+                         for action in self.actions)
+        for kind in KINDS:
+            actions = [action for action in self.actions if action.kind == kind]
+            if actions:
+                lines.append("{0:<8} {1:>8} {2:>16} bytes".format(
+                             kind, len(actions), sum(action.size for action in actions)))
+        lines.append("{0:<8} {1:>8} {2:>16} bytes".format("total", self.operations, self.bytes))
+        return "\n".join(lines)
+
+    def execute(self, workers=1, stop=None):
+        """
+        Execute the plan.
+
+        Directories, moves and deletes are executed in order, the file
+        transfers by C{workers} threads of the priority class of the
+        calling thread, see L{MiGBox.throttle}.
+
+        @param workers: number of threads transferring files.
+        @type workers: int
+        @param stop: stop event, remaining actions are skipped if set.
+        @type stop: python threading event
+        @return: actions that failed.
+        @rtype: list of L{Action}
+        """
+
+        failed = []
+        queue = Queue()
+        for action in self.actions:
+            if action.kind in (MKDIR, MOVE, DELETE, RMDIR):
+                _execute(action, failed, stop)
+            else:
+                queue.put(action)
+
+        level = throttle.current_priority()
+
+        def work():
+            with throttle.priority(level):
+                while True:
+                    try:
+                        action = queue.get_nowait()
+                    except Empty:
+                        return
+                    _execute(action, failed, stop)
+
+        threads = [threading.Thread(target=work, name="SyncPlan-{0}".format(i))
+                   for i in xrange(max(1, workers) - 1)]
+        for thread in threads:
+            thread.start()
+        work()
+        for thread in threads:
+            thread.join()
+        return failed
+
+def _execute(action, failed, stop):
+    if stop and stop.isSet():
+        return
+    try:
+        action.execute()
+    except (IOError, OSError) as e:
+        logging.getLogger("sync").debug("%r failed: %s", action, e)
+        failed.append(action)
+
+def _synchronized(src, src_path, dst, dst_path, checksums=None):
+    # record a file or directory on both sides as synchronized, directories
+    # have no checksums
+    src.cache[src_path] = (src.stat(src_path).st_mtime, checksums)
+    dst.cache[dst_path] = (dst.stat(dst_path).st_mtime, checksums)
+
+def _walk(src, path):
+    # stats of all directories and files below path
+    entries = {}
+    dirs = [path]
+    while dirs:
+        dir_ = dirs.pop()
+        try:
+            pathnames = src.listdir(dir_)
+        except (IOError, OSError):
+            continue
+        for pathname in pathnames:
+            if pathname.endswith(_temp_suffixes):
+                continue
+            abs_path = src.join_path(dir_, pathname)
+            try:
+                st = src.stat(abs_path)
+            except (IOError, OSError):
+                continue
+            entries[abs_path] = st
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(abs_path)
+    return entries
+
+def _checksums(src, path, st):
+    # weak block checksums of a file, kept in the cache for the engine
+    cached = src.cache.get(path)
+    if not cached or st.st_mtime > cached[0]:
+        src.cache[path] = cached = (st.st_mtime, src.blockchecksums(path, False))
+    return cached[1]
+
+def _changed(src, path, st):
+    # the file changed since it was last synchronized
+    return path not in src.cache or st.st_mtime > src.cache[path][0]
+
+def _plan_file(src, src_path, src_st, dst, dst_path, dst_st):
+    # action for a file on both sides
+    conflict = src_path in src.cache and dst_path in dst.cache and \
+               _changed(src, src_path, src_st) and _changed(dst, dst_path, dst_st)
+    if src_st.st_size == dst_st.st_size and \
+       _checksums(src, src_path, src_st) == _checksums(dst, dst_path, dst_st):
+        return None
+    kind = CONFLICT if conflict else DELTA
+    if src_st.st_mtime >= dst_st.st_mtime:
+        return Action(kind, src, src_path, dst, dst_path, src_st.st_size)
+    return Action(kind, dst, dst_path, src, src_path, dst_st.st_size)
+
+def _plan_missing(src, src_path, src_st, dst, dst_path):
+    # action for a file on src only, it is either new or deleted on dst
+    if dst_path in dst.cache and not _changed(src, src_path, src_st):
+        return Action(DELETE, dst, dst_path, src, src_path, 0)
+    return Action(COPY, src, src_path, dst, dst_path, src_st.st_size)
+
+def _plan_dirs(dirs, actions):
+    # a deleted directory is made again if files are moved or copied into it
+    targets = [(action.dst, action.dst_path) for action in actions + dirs
+               if action.kind in (MKDIR, MOVE, COPY)]
+    planned = []
+    for action in dirs:
+        if action.kind == RMDIR:
+            prefix = action.src.join_path(action.src_path, '')
+            if any(fs is action.src and path.startswith(prefix) for fs, path in targets):
+                action = Action(MKDIR, action.dst, action.dst_path, action.src, action.src_path)
+        planned.append(action)
+    return planned
+
+def _plan_moves(actions, sizes):
+    # a copy of a file with the checksums of a deleted one is a move
+    deleted = {}
+    for action in actions:
+        if action.kind == DELETE and action.src_path in action.src.cache:
+            deleted.setdefault((id(action.src), sizes[action]), []).append(action)
+    if not deleted:
+        return actions
+    moved = set()
+    for i, action in enumerate(actions):
+        candidates = deleted.get((id(action.src), action.size)) if action.kind == COPY else None
+        if not candidates:
+            continue
+        try:
+            st = action.src.stat(action.src_path)
+            checksums = _checksums(action.src, action.src_path, st)
+        except (IOError, OSError):
+            continue
+        for delete in candidates:
+            if delete not in moved and action.src.cache[delete.src_path][1] == checksums:
+                moved.add(delete)
+                actions[i] = Action(MOVE, action.src, action.src_path, action.dst,
+                                    action.dst_path, 0, moved_from=delete.dst_path)
+                break
+    return [action for action in actions if action not in moved]
+
+def plan_sync(src, dst):
+    """
+    Plan the synchronization of C{src} and C{dst} in both directions,
+    like L{MiGBox.sync.sync_all_files} from C{src} to C{dst} and back.
+
+    Files on both sides are compared like L{MiGBox.sync.sync_file} by
+    their weak block checksums, which are computed for files of equal
+    size and kept in the caches of the file systems for the execution.
+    A file on one side only is copied to the other side, unless both
+    sides have already been synchronized and the file has been deleted
+    on the other side since. A deleted file with the checksums of a new
+    one on the same side has been moved. Directories are made or deleted
+    like files, a deleted directory is made again if files are moved or
+    copied into it.
+
+    @param src: source file system abstraction.
+    @type src: L{MiGBox.FileSystem}
+    @param dst: destination file system abstraction.
+    @type dst: L{MiGBox.FileSystem}
+    @return: the sync plan.
+    @rtype: L{SyncPlan}
+    """
+
+    src_entries = _walk(src, src.root)
+    dst_entries = _walk(dst, dst.root)
+    actions = []
+    dirs = []
+    # sizes of the files removed by deletes
+    sizes = {}
+    for from_, from_entries, to, to_entries in ((src, src_entries, dst, dst_entries),
+                                                (dst, dst_entries, src, src_entries)):
+        for from_path, from_st in from_entries.items():
+            to_path = get_sync_path(from_, to, from_path)
+            to_st = to_entries.get(to_path)
+            if stat.S_ISDIR(from_st.st_mode):
+                if to_st is None:
+                    if to_path in to.cache:
+                        dirs.append(Action(RMDIR, to, to_path, from_, from_path))
+                    else:
+                        dirs.append(Action(MKDIR, from_, from_path, to, to_path))
+                elif stat.S_ISDIR(to_st.st_mode):
+                    from_.cache[from_path] = (from_st.st_mtime, None)
+                continue
+            if to_st is None:
+                action = _plan_missing(from_, from_path, from_st, to, to_path)
+                sizes[action] = from_st.st_size
+                actions.append(action)
+            elif from_ is src and not stat.S_ISDIR(to_st.st_mode):
+                # files on both sides are planned once
+                action = _plan_file(from_, from_path, from_st, to, to_path, to_st)
+                if action:
+                    actions.append(action)
+    actions = _plan_moves(actions, sizes)
+    return SyncPlan(actions + _plan_dirs(dirs, actions))
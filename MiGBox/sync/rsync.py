@@ -19,17 +19,23 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 """
-Rsync demo implementation with weak rolling checksum and sha1 strong checksum.
+Rsync demo implementation with weak rolling checksum and strong checksum.
 Based on the rsync algorithm by Andrew Tridgell.
 """
 
 import os, sys
-import hashlib
 
 from collections import namedtuple
+from MiGBox.sync.delta import ALGORITHM, strongchecksum
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 default_size = 16384
 modulo = 65536
+digest_size = 16
 
 Weakchksum = namedtuple('Weakchksum',['a','b','s','length'])
 
@@ -127,13 +133,16 @@ def block_chksums(stream, offset=0, blocksize=default_size):
         offset += blocksize
     return table
 
-def strong_chksum(data):
-    sha1 = hashlib.sha1()
-    sha1.update(data)
-    return sha1.hexdigest()
+def strong_chksum(data, algorithm=ALGORITHM, size=digest_size):
+    return strongchecksum(data, algorithm, size)
 
 def weak_chksum(data, M=modulo):
     length = len(data)
+    if numpy:
+        x = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+        a = int(x.sum()) % M
+        b = int(x.dot(numpy.arange(length, 0, -1)))
+        return Weakchksum(a, b, a + (b << 16), length)
     a = sum([ord(x) for x in data]) % M
     b = sum([(length - i) * ord(data[i]) for i in xrange(0,length)])
     return Weakchksum(a, b, a + (b << 16), length)
@@ -23,32 +23,320 @@ L{MiGBox.FileSystem}.
 
 import os
 import stat
+import time
+import posixpath
+import uuid
+import heapq
 import logging
+import itertools
 import threading
 
 from Queue import Queue, Empty
+from collections import deque, defaultdict
 
 from watchdog.events import *
+from watchdog.observers.api import BaseObserver, DEFAULT_OBSERVER_TIMEOUT
+from watchdog.observers.polling import PollingEmitter
+from MiGBox.metrics import EVENT_QUEUE_DEPTH, EVENT_LAG, SCAN_SECONDS
+from MiGBox import throttle
 
 sync_logger = logging.getLogger("sync")
 event_logger = logging.getLogger("event")
 
-_log = {'create': 'CREATE {0}<br />',
-        'remove': 'REMOVE {0}<br />',
-        'sync_to': 'SYNC {0} ==> {1}<br />',
-        'sync_eq': 'SYNC {0} == {1}<br />',
-        'sync_er': 'SYNC {0} !! {1}<br />',
-        'sync_conf': 'SYNC {0} !CONFLICT! {1}<br />',
-        'move': 'MOVE {0} ==> {1}<br />',
-        'copy': 'COPY {0} ==> {1}<br />'}
+# messages of the sync actions, see _record
+_log = {'create': 'CREATE %s',
+        'remove': 'REMOVE %s',
+        'sync_to': 'SYNC %s ==> %s',
+        'sync_eq': 'SYNC %s == %s',
+        'sync_er': 'SYNC %s !! %s',
+        'sync_conf': 'SYNC %s !CONFLICT! %s',
+        'move': 'MOVE %s ==> %s',
+        'copy': 'COPY %s ==> %s'}
+
+# temporary files of unfinished transfers and patches are not synchronized
+_temp_suffixes = ('.part', '.part.chk', '.patched')
+
+# lanes of the event queue, events of large files have their own lane
+SMALL = 0
+LARGE = 1
+LANES = (SMALL, LARGE)
+# origins of events, edits are synchronized before rescans
+EDIT = 0
+RESCAN = 1
+# files of at least SMALL_SIZE bytes wait for smaller ones, files of at
+# least LARGE_SIZE bytes are synchronized in the large lane
+SMALL_SIZE = 1048576
+LARGE_SIZE = 16777216
+# seconds after which an event is synchronized before the others
+MAX_WAIT = 10
+
+def _event_paths(event):
+    # paths an event changes
+    dest_path = getattr(event, 'dest_path', None)
+    return (event.src_path, dest_path) if dest_path else (event.src_path,)
+
+def _event_prefixes(event, paths):
+    # prefixes of the paths of the files below a moved or deleted directory,
+    # local or remote
+    if not event.is_directory or event.event_type not in (EVENT_TYPE_MOVED, EVENT_TYPE_DELETED):
+        return ()
+    return tuple(set(path.rstrip(sep) + sep for path in paths for sep in (os.sep, posixpath.sep)))
 
 class EventQueue(Queue):
     """
-    This class is used to keep track of the file system
-    events and is as for now the default python queue.
+    This class is used to keep track of the file system events and
+    schedules them in two lanes.
+
+    Events of files of at least L{LARGE_SIZE} bytes go to the L{LARGE}
+    lane, the others to the L{SMALL} lane, so that a large transfer does
+    not delay the edits behind it. The size of a file is given by the
+    C{size} attribute of its event, the origin by C{origin}, see L{put}.
+    Events of a path that is queued or synchronized in a lane go to the
+    same lane and keep their order. A moved or deleted directory goes to
+    the lane of the files below it, preferably the L{LARGE} lane, and is
+    taken after them. In the L{LARGE} lane it is also held, with the
+    events behind it, until the files below it in the L{SMALL} lane are
+    synchronized.
+
+    The L{SMALL} lane takes L{EDIT} events before L{RESCAN} events and
+    smaller files than L{SMALL_SIZE} before larger ones, each in the order
+    of their arrival. An event waiting for more than L{MAX_WAIT} seconds
+    is taken first. The L{LARGE} lane is in the order of arrival.
+
+    The queued events are counted in L{EVENT_QUEUE_DEPTH} and get
+    their arrival time as C{arrival} attribute.
     """
 
-    pass
+    def _init(self, maxsize):
+        self.seq = itertools.count()
+        # heap of the small lane's entries and their arrival order,
+        # taken entries are marked by removing their event
+        self.heap = []
+        self.arrivals = deque()
+        self.large = deque()
+        self.sizes = [0] * len(LANES)
+        # queued events by path and the paths synchronized by each lane
+        self.paths = [defaultdict(int) for lane in LANES]
+        self.last = {}
+        self.running = [() for lane in LANES]
+
+    def _qsize(self, lane=None):
+        return sum(self.sizes) if lane is None else self.sizes[lane]
+
+    def put(self, item, block=True, timeout=None, origin=None, lane=None):
+        """
+        Put an event into the queue.
+
+        @param item: file system event, with its file's size as C{size}
+                     attribute if known.
+        @type item: watchdog event
+        @param origin: L{EDIT} or L{RESCAN}, by default the event's
+                       C{origin} or L{EDIT}.
+        @type origin: int
+        @param lane: lane of the event, by default by its size.
+        @type lane: int
+        """
+
+        if origin is not None:
+            item.origin = origin
+        # events of another queue, e.g. polled ones, are routed again
+        item.lane = lane
+        Queue.put(self, item, block, timeout)
+
+    def _put(self, item):
+        item.arrival = time.time()
+        paths = _event_paths(item)
+        prefixes = _event_prefixes(item, paths)
+        lane = getattr(item, 'lane', None)
+        if lane is None:
+            # a directory waits for the large files below it
+            for lane in reversed(LANES):
+                if self._queued(lane, paths, prefixes):
+                    break
+            else:
+                lane = LARGE if (getattr(item, 'size', 0) or 0) >= LARGE_SIZE else SMALL
+        if lane == SMALL:
+            key = (getattr(item, 'origin', EDIT), (getattr(item, 'size', 0) or 0) >= SMALL_SIZE)
+            # an event is not taken before the earlier ones of its paths
+            earlier = [self.last[path] for path in paths if self.paths[SMALL].get(path)]
+            if prefixes:
+                earlier.extend(self.last[path] for path in self.paths[SMALL]
+                               if path.startswith(prefixes))
+            key = max([key] + earlier)
+            entry = [key, next(self.seq), item]
+            for path in paths:
+                self.last[path] = key
+            heapq.heappush(self.heap, entry)
+            self.arrivals.append(entry)
+        else:
+            self.large.append(item)
+        item.lane = lane
+        for path in paths:
+            self.paths[lane][path] += 1
+        self.sizes[lane] += 1
+        EVENT_QUEUE_DEPTH.inc()
+        # consumers of both lanes wait for the same condition
+        self.not_empty.notify_all()
+
+    def _ready(self, lane):
+        # a directory in the large lane waits for the files below it in the
+        # small lane, queued or synchronized
+        if lane != LARGE:
+            return self._qsize(lane)
+        if not self.large:
+            return False
+        item = self.large[0]
+        return not self._queued(SMALL, (), _event_prefixes(item, _event_paths(item)))
+
+    def _queued(self, lane, paths, prefixes=()):
+        # the lane has events of the paths or of the files below the prefixes
+        if any(self.paths[lane].get(path) or path in self.running[lane] for path in paths):
+            return True
+        return bool(prefixes) and any(path.startswith(prefixes) for path in
+                                      itertools.chain(self.paths[lane], self.running[lane]))
+
+    def get(self, block=True, timeout=None, lane=None):
+        """
+        Remove and return an event from the queue.
+
+        A consumer of a lane calls this again after it synchronized the
+        event, until then later events of its paths are kept in the lane.
+
+        @param lane: lane to take the event from, by default the L{SMALL}
+                     lane and the L{LARGE} lane if it is empty.
+        @type lane: int
+        @return: file system event.
+        @rtype: watchdog event
+        """
+
+        with self.not_empty:
+            if lane is not None:
+                self.running[lane] = ()
+                # a directory of the other lane may wait for the paths
+                self.not_empty.notify_all()
+            end = time.time() + timeout if timeout is not None else None
+            while not self._ready(lane):
+                if not block:
+                    raise Empty
+                if end is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            item = self._get(lane)
+            if lane is not None:
+                self.running[lane] = _event_paths(item)
+            self.not_full.notify()
+            return item
+
+    def _get(self, lane=None):
+        if lane is None:
+            lane = SMALL if self.sizes[SMALL] else LARGE
+        if lane == SMALL:
+            while self.arrivals[0][2] is None:
+                self.arrivals.popleft()
+            if time.time() - self.arrivals[0][2].arrival > MAX_WAIT:
+                entry = self.arrivals.popleft()
+            else:
+                entry = heapq.heappop(self.heap)
+                while entry[2] is None:
+                    entry = heapq.heappop(self.heap)
+            item, entry[2] = entry[2], None
+        else:
+            item = self.large.popleft()
+        for path in _event_paths(item):
+            self.paths[lane][path] -= 1
+            if not self.paths[lane][path]:
+                del self.paths[lane][path]
+                if lane == SMALL:
+                    self.last.pop(path, None)
+        self.sizes[lane] -= 1
+        EVENT_QUEUE_DEPTH.dec()
+        return item
+
+class _ScanEmitter(PollingEmitter):
+    # polling emitter observing the duration of its scans
+
+    def __init__(self, *largs, **kwargs):
+        PollingEmitter.__init__(self, *largs, **kwargs)
+        take_snapshot = self._take_snapshot
+
+        def timed_snapshot():
+            with SCAN_SECONDS.time():
+                return take_snapshot()
+        self._take_snapshot = timed_snapshot
+
+class Observer(BaseObserver):
+    """
+    This class is the polling observer of watchdog, that observes the
+    duration of its scans in L{SCAN_SECONDS}.
+    """
+
+    def __init__(self, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        BaseObserver.__init__(self, emitter_class=_ScanEmitter, timeout=timeout)
+
+class EventJournal(object):
+    """
+    This class keeps a bounded journal of file system events.
+
+    Every event gets a sequence number, so that several readers can
+    poll the events since their last known cursor. A reader whose
+    cursor is no longer covered by the journal has lost events and
+    has to resynchronize completely.
+
+    Cursors are only valid for the journal they were taken from, which
+    is identified by its C{id}, e.g. not after a restart of the server.
+    """
+
+    def __init__(self, maxlen=10000):
+        """
+        Create a new event journal.
+
+        @param maxlen: maximum number of events kept.
+        @type maxlen: int
+        """
+
+        self.events = deque(maxlen=maxlen)
+        self.head = 0
+        self.lock = threading.Lock()
+        # identifies the cursors of this journal
+        self.id = uuid.uuid4().hex
+
+    def put(self, event):
+        """
+        Append an event to the journal.
+
+        @param event: file system event.
+        @type event: watchdog event
+        """
+
+        with self.lock:
+            self.head += 1
+            self.events.append((self.head, event))
+
+    def since(self, cursor, journal=None):
+        """
+        Return all events after C{cursor}.
+
+        @param cursor: sequence number of the last seen event.
+        @type cursor: int
+        @param journal: id of the journal of C{cursor}, by default this one.
+        @type journal: str
+        @return: tuple as (new cursor, complete, list of events), complete
+            is False if events after C{cursor} have already been dropped
+            or C{cursor} is from another journal.
+        @rtype: tuple
+        """
+
+        with self.lock:
+            if (journal is not None and journal != self.id) or cursor > self.head or \
+               (self.events and self.events[0][0] > cursor + 1):
+                # cursor from an earlier server run or events dropped
+                return self.head, False, []
+            events = [event for n, event in self.events if n > cursor]
+            return self.head, True, events
 
 class EventHandler(FileSystemEventHandler):
     """
@@ -63,13 +351,22 @@ class EventHandler(FileSystemEventHandler):
 
     def on_any_event(self, event):
         super(EventHandler, self).on_any_event(event)
+        if not event.is_directory and event.event_type != 'deleted':
+            # the size of the file schedules the event, see EventQueue
+            try:
+                event.size = os.stat(getattr(event, 'dest_path', event.src_path)).st_size
+            except OSError:
+                pass
         self.eventQueue.put(event)
-        event_logger.info(event)
+        event_logger.debug("%s", event)
 
-def sync_events(src, dst, eventQueue, stop, lock=threading.Lock()):
+def sync_events(src, dst, eventQueue, stop, lock=threading.Lock(), lane=None):
     """
     Sync events from the C{eventQueue} between C{src} and C{dst}.
 
+    Events of L{RESCAN} origin are synchronized in the background
+    priority class of L{MiGBox.throttle}.
+
     @param src: source file system abstraction.
     @type src: L{MiGBox.FileSystem}
     @param dst: destination file system abstraction.
@@ -78,46 +375,75 @@ def sync_events(src, dst, eventQueue, stop, lock=threading.Lock()):
     @type eventQueue: L{MiGBox.sync.EventQueue}
     @param stop: stop event.
     @type stop: python threading event
+    @param lock: lock held while an event is synchronized.
+    @type lock: python threading lock
+    @param lane: lane of the queue to synchronize, by default both.
+    @type lane: int
     """
 
     while not stop.isSet():
-        from_, to = src, dst
-        event = eventQueue.get()
+        event = eventQueue.get(lane=lane)
         lock.acquire()
-        #print "sync event"
-        #print event
-        from_path = event.src_path
-        if not from_path.startswith(src.root):
-            from_, to = dst, src
-        if isinstance(event, DirCreatedEvent):
-            to_path = get_sync_path(from_, to, from_path)
-            make_dir(to, to_path)
-        elif isinstance(event, FileCreatedEvent):
-            to_path = get_sync_path(from_, to, from_path)
-            sync_file(from_, from_path, to, to_path)
-        elif isinstance(event, DirDeletedEvent):
-            to_path = get_sync_path(from_, to, from_path)
-            remove_dir(to, to_path)
-            remove_dirs(to, to_path)
-        elif isinstance(event, FileDeletedEvent):
+        try:
+            if getattr(event, 'origin', EDIT) == RESCAN:
+                with throttle.priority(throttle.BACKGROUND):
+                    _sync_event(src, dst, eventQueue, event)
+            else:
+                _sync_event(src, dst, eventQueue, event)
+                EVENT_LAG.observe(time.time() - event.arrival)
+        finally:
+            lock.release()
+            eventQueue.task_done()
+
+def _sync_event(src, dst, eventQueue, event):
+    # synchronize a single event
+    from_, to = src, dst
+    #print "sync event"
+    #print event
+    from_path = event.src_path
+    if from_path.endswith(_temp_suffixes) and not isinstance(event, FileMovedEvent):
+        return
+    if not from_path.startswith(src.root):
+        from_, to = dst, src
+    if isinstance(event, DirCreatedEvent):
+        to_path = get_sync_path(from_, to, from_path)
+        make_dir(to, to_path)
+    elif isinstance(event, FileCreatedEvent):
+        to_path = get_sync_path(from_, to, from_path)
+        sync_file(from_, from_path, to, to_path)
+    elif isinstance(event, DirDeletedEvent):
+        to_path = get_sync_path(from_, to, from_path)
+        remove_dir(to, to_path)
+        remove_dirs(to, to_path)
+    elif isinstance(event, FileDeletedEvent):
+        # a file replaced by a rename, e.g. by a patch, is reported as
+        # deleted too, it is only removed if it is still gone
+        if not exists(from_, from_path):
             to_path = get_sync_path(from_, to, from_path)
             remove_file(to, to_path)
-        elif isinstance(event, FileModifiedEvent):
-            to_path = get_sync_path(from_, to, from_path)
-            sync_file(from_, from_path, to, to_path)
-        elif isinstance(event, DirMovedEvent):
-            to_path = get_sync_path(from_, to, from_path)
-            new_path = get_sync_path(from_, to, event.dest_path)
-            move(to, to_path, new_path)
-            eventQueue.put(DirDeletedEvent(from_path))
-        elif isinstance(event, FileMovedEvent):
-            to_path = get_sync_path(from_, to, from_path)
-            new_path = get_sync_path(from_, to, event.dest_path)
+    elif isinstance(event, FileModifiedEvent):
+        to_path = get_sync_path(from_, to, from_path)
+        sync_file(from_, from_path, to, to_path)
+    elif isinstance(event, DirMovedEvent):
+        to_path = get_sync_path(from_, to, from_path)
+        new_path = get_sync_path(from_, to, event.dest_path)
+        move(to, to_path, new_path)
+        eventQueue.put(DirDeletedEvent(from_path))
+    elif isinstance(event, FileMovedEvent):
+        to_path = get_sync_path(from_, to, from_path)
+        new_path = get_sync_path(from_, to, event.dest_path)
+        if exists(from_, from_path):
+            # the observer matches files by inode, a file replaced by a
+            # rename may reuse the inode of another one that was not moved
+            sync_file(from_, event.dest_path, to, new_path)
+        else:
             move(to, to_path, new_path)
             sync_file(from_, event.dest_path, to, new_path)
             remove_file(to, to_path)
-        lock.release()
-        eventQueue.task_done()
+
+def _record(level, action, *paths):
+    # log a sync action, the action and its paths are fields of the record
+    sync_logger.log(level, _log[action], *paths, extra={'action': action, 'paths': paths})
 
 def get_sync_path(src, dst, path):
     """
@@ -157,6 +483,8 @@ def sync_all_files(src, dst, path=None):
     while dirs:
         dir_ = dirs.pop()
         for pathname in src.listdir(dir_):
+            if pathname.endswith(_temp_suffixes):
+                continue
             abs_path = src.join_path(dir_, pathname)
             sync_path = get_sync_path(src, dst, abs_path)
             try:
@@ -171,6 +499,45 @@ def sync_all_files(src, dst, path=None):
             except (IOError, OSError):
                 continue
 
+def rescan(src, eventQueue, path=None):
+    """
+    Put events for all directories and files of C{src} starting at
+    C{path} into the C{eventQueue}, as L{RESCAN} events that are
+    synchronized like L{sync_all_files} after the edits.
+
+    @param src: source file system abstraction.
+    @type src: L{MiGBox.FileSystem}
+    @param eventQueue: event queue.
+    @type eventQueue: L{MiGBox.sync.EventQueue}
+    @param path: root path
+    @type path: str
+    """
+
+    if not path:
+        path = src.root
+    dirs = [path]
+    while dirs:
+        dir_ = dirs.pop()
+        try:
+            pathnames = src.listdir(dir_)
+        except (IOError, OSError):
+            continue
+        for pathname in pathnames:
+            if pathname.endswith(_temp_suffixes):
+                continue
+            abs_path = src.join_path(dir_, pathname)
+            try:
+                st = src.stat(abs_path)
+            except (IOError, OSError):
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(abs_path)
+                event = DirCreatedEvent(abs_path)
+            else:
+                event = FileModifiedEvent(abs_path)
+                event.size = st.st_size
+            eventQueue.put(event, origin=RESCAN)
+
 def sync_file(src, src_path, dst, dst_path):
     """
     Synchronize a file from C{src} file system abstraction to C{dst}
@@ -201,40 +568,42 @@ def sync_file(src, src_path, dst, dst_path):
                 del src.cache[src_path]
             remove_file(dst, dst_path)
         else:
+            # cached checksums are only compared, strong checksums
+            # are computed if a delta is needed
             if not dst_path in dst.cache:
-                dst.cache[dst_path] = (dst_mtime, dst.blockchecksums(dst_path))
+                dst.cache[dst_path] = (dst_mtime, dst.blockchecksums(dst_path, False))
             if not src_path in src.cache:
-                src.cache[src_path] = (src_mtime, src.blockchecksums(src_path))
+                src.cache[src_path] = (src_mtime, src.blockchecksums(src_path, False))
             cached_dst_mtime, cached_dst_bs = dst.cache[dst_path]
             cached_src_mtime, cached_src_bs = src.cache[src_path]
             if dst_mtime > cached_dst_mtime: # modification has not yet been seen
-                sync_logger.info(_log['sync_conf'].format(src_path,dst_path))
-                dst.cache[dst_path] = (dst_mtime, dst.blockchecksums(dst_path))
+                _record(logging.INFO, 'sync_conf', src_path, dst_path)
+                dst.cache[dst_path] = (dst_mtime, dst.blockchecksums(dst_path, False))
                 cached_dst_mtime, cached_dst_bs = dst.cache[dst_path]
             if src_mtime > cached_src_mtime: # modification has not yet been seen
-                sync_logger.info(_log['sync_conf'].format(src_path,dst_path))
-                src.cache[src_path] = (src_mtime, src.blockchecksums(src_path))
+                _record(logging.INFO, 'sync_conf', src_path, dst_path)
+                src.cache[src_path] = (src_mtime, src.blockchecksums(src_path, False))
                 cached_src_mtime, cached_src_bs = src.cache[src_path]
-            if set(cached_src_bs) - set(cached_dst_bs): # files differ
+            if cached_src_bs != cached_dst_bs: # files differ
                 if cached_src_mtime >= cached_dst_mtime: # src newer
                     try:
-                        delta = src.delta(src_path, cached_dst_bs)
+                        delta = src.delta(src_path, dst.blockchecksums(dst_path))
                         dst.patch(dst_path, delta)
                         dst.cache[dst_path] = (dst.stat(dst_path).st_mtime,
-                                               dst.blockchecksums(dst_path))
+                                               dst.blockchecksums(dst_path, False))
                     except:
                         copy_file(src, src_path, dst, dst_path)
                 else:
                     try:
-                        delta = dst.delta(dst_path, cached_src_bs)
+                        delta = dst.delta(dst_path, src.blockchecksums(src_path))
                         src.patch(src_path, delta)
                         src.cache[src_path] = (src.stat(src_path).st_mtime,
-                                               src.blockchecksums(src_path))
+                                               src.blockchecksums(src_path, False))
                     except:
                         copy_file(dst, dst_path, src, src_path)
-                sync_logger.info(_log['sync_to'].format(src_path,dst_path))
+                _record(logging.INFO, 'sync_to', src_path, dst_path)
             else:
-                sync_logger.debug(_log['sync_eq'].format(src_path,dst_path))
+                _record(logging.DEBUG, 'sync_eq', src_path, dst_path)
 
 def copy_file(src, src_path, dst, dst_path):
     """
@@ -248,13 +617,17 @@ def copy_file(src, src_path, dst, dst_path):
     @type dst: L{MiGBox.FileSystem}
     @param dst_path: destination path.
     @type dst_path: str
+    @return: the file has been copied.
+    @rtype: bool
     """
 
     try:
         src.copy(src, src_path, dst, dst_path)
-        sync_logger.info(_log['copy'].format(src_path,dst_path))
+        _record(logging.INFO, 'copy', src_path, dst_path)
+        return True
     except:
-        sync_logger.debug(_log['copy'].format(src_path,dst_path))
+        _record(logging.DEBUG, 'copy', src_path, dst_path)
+        return False
 
 def move(src, src_path, dst_path):
     """
@@ -267,13 +640,35 @@ def move(src, src_path, dst_path):
     @type src_path: str
     @param dst_path: destination path.
     @type dst_path: str
+    @return: the file/directory has been moved.
+    @rtype: bool
     """
  
     try:
         src.rename(src_path, dst_path)
-        sync_logger.info(_log['move'].format(src_path,dst_path))
+        _record(logging.INFO, 'move', src_path, dst_path)
+        return True
+    except (OSError, IOError):
+        _record(logging.DEBUG, 'move', src_path, dst_path)
+        return False
+
+def exists(src, path):
+    """
+    Return whether C{path} exists on C{src}.
+
+    @param src: source file system abstraction.
+    @type src: L{MiGBox.FileSystem}
+    @param path: path.
+    @type path: str
+    @return: path exists.
+    @rtype: bool
+    """
+
+    try:
+        src.stat(path)
+        return True
     except (OSError, IOError):
-        sync_logger.debug(_log['move'].format(src_path,dst_path))
+        return False
 
 def remove_file(src, path):
     """
@@ -283,15 +678,18 @@ def remove_file(src, path):
     @type src: L{MiGBox.FileSystem}
     @param path: path.
     @type path: str
+    @return: the file has been removed.
+    @rtype: bool
     """
  
     try:
-        if path in src.cache:
-            del src.cache[path]
         src.remove(path)
-        sync_logger.info(_log['remove'].format(path))
+        src.cache.pop(path, None)
+        _record(logging.INFO, 'remove', path)
+        return True
     except (OSError, IOError):
-        sync_logger.debug(_log['remove'].format(path))
+        _record(logging.DEBUG, 'remove', path)
+        return False
 
 def remove_dir(src, path):
     """
@@ -305,9 +703,9 @@ def remove_dir(src, path):
  
     try:
         src.rmdir(path)
-        sync_logger.info(_log['remove'].format(path))
+        _record(logging.INFO, 'remove', path)
     except (OSError, IOError):
-        sync_logger.debug(_log['remove'].format(path))
+        _record(logging.DEBUG, 'remove', path)
 
 def remove_dirs(src, path):
     """
@@ -340,10 +738,14 @@ def make_dir(src, path):
     @type src: L{MiGBox.FileSystem}
     @param path: path.
     @type path: str
+    @return: the directory has been made.
+    @rtype: bool
     """
  
     try:
         src.mkdir(path)
-        sync_logger.info(_log['create'].format(path))
+        _record(logging.INFO, 'create', path)
+        return True
     except (OSError, IOError):
-        sync_logger.debug(_log['create'].format(path))
+        _record(logging.DEBUG, 'create', path)
+        return False
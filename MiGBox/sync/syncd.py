@@ -27,70 +27,85 @@ import threading
 import logging
 import paramiko
 
-from MiGBox.sync import EventQueue, EventHandler, sync_events, sync_all_files
+from MiGBox.sync import EventQueue, EventHandler, sync_events, rescan, plan_sync
+from MiGBox.sync.sync import LANES, SMALL, LARGE
 from MiGBox.fs import OSFileSystem, SFTPFileSystem
-from MiGBox.sftp import SFTPClient
+from MiGBox.sftp import SFTPClient, ResilientSFTPClient
+from MiGBox.metrics import serve
+from MiGBox import log, throttle
 
-from watchdog.events import FileSystemEvent
+from watchdog.events import DirModifiedEvent
 
 thread_lock = threading.Lock()
+# held while the large lane synchronizes an event
+large_lock = threading.Lock()
 sync_all_thread = None
 poll_thread = None
+# seconds between the rescans of all files
+RESCAN_INTERVAL = 60
 
 def poll_events(local, remote, stop):
-    thread_lock.acquire()
-    #print "poll"
-    events = remote.poll()
-    #print "poll done"
-    for event in events:
-        #print event
-        local.eventQueue.put(event)
-    thread_lock.release()
+    global poll_thread
+    logger = logging.getLogger("sync")
+    try:
+        #print "poll"
+        events = remote.poll()
+        #print "poll done"
+        # the queue schedules the events, the lanes keep synchronizing
+        for event in events:
+            #print event
+            local.eventQueue.put(event)
+        if getattr(remote.instance, "resync", False):
+            # events got lost while disconnected, both lanes wait
+            logger.info("Events lost, sync all files.")
+            with thread_lock, large_lock:
+                with throttle.priority(throttle.BACKGROUND):
+                    plan_sync(local, remote).execute()
+            remote.instance.resync = False
+    except Exception as e:
+        # keep polling, the connection may come back
+        logger.error("Poll failed: %s", e)
     if not stop.isSet():
         poll_thread = threading.Timer(3, poll_events, [local, remote, stop])
         poll_thread.start()
  
 def sync_all(local, remote, stop):
+    global sync_all_thread
     logger = logging.getLogger("sync")
-    local.eventQueue.join()
-    thread_lock.acquire()
+    # rescan once the queued events are synchronized
+    queue = local.eventQueue
+    with queue.all_tasks_done:
+        while queue.unfinished_tasks and not stop.isSet():
+            queue.all_tasks_done.wait(1)
+    if stop.isSet():
+        return
     #print "sync all"
-    logger.debug("Sync all files.<br />")
+    logger.debug("Sync all files.")
     try:
-        sync_all_files(local, remote, local.root)
+        # the files are synchronized by the sync threads after the edits
+        rescan(local, local.eventQueue, local.root)
     except Exception as e:
         print e
-    finally:
-        #print "sync all done"
-        thread_lock.release()
     if not stop.isSet():
-        sync_all_thread = threading.Timer(5, sync_all, [local, remote, stop])
+        sync_all_thread = threading.Timer(RESCAN_INTERVAL, sync_all, [local, remote, stop])
         sync_all_thread.start()
 
-def run(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
-        keypass=None, username=None, password=None, logfile=None, loglevel='INFO',
-        stopsync=threading.Event(), **kargs):
-    loglevel="DEBUG"
+def connect(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
+            keypass=None, username=None, password=None):
+    """
+    Connect the source and destination file system abstractions.
+
+    @param mode: synchronization mode, 'local' or 'remote'.
+    @type mode: str
+    @return: tuple as (local, remote) file system abstractions.
+    @rtype: tuple
+    """
+
     sync_logger = logging.getLogger("sync")
-    event_logger = logging.getLogger("event")
-    sync_logger.setLevel(getattr(logging, loglevel))
-    event_logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(levelname)s: %(asctime)s %(message)s')
-    ch = logging.StreamHandler()
-    ch.setLevel(getattr(logging, loglevel))
-    ch.setFormatter(formatter)
-    if logfile:
-        fh = logging.FileHandler(logfile, mode='w')
-        fh.setLevel(getattr(logging, loglevel))
-        fh.setFormatter(formatter)
-        sync_logger.addHandler(fh)
-    else:
-        sync_logger.addHandler(ch)
-    event_logger.addHandler(logging.FileHandler("events", mode="w"))
     paramiko_logger = logging.getLogger("paramiko.transport")
     paramiko_logger.addHandler(logging.NullHandler())
 
-    sync_logger.info("Connect source and destination ...<br />")
+    sync_logger.info("Connect source and destination ...")
 
     local = OSFileSystem(root=source)
     remote = None
@@ -101,26 +116,118 @@ def run(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
             client = SFTPClient.connect(sftp_host, sftp_port, hostkey, userkey, keypass,
                                         username, password)
         except:
-            sync_logger.error("Connection failed!<br />")
+            sync_logger.error("Connection failed!")
             local.observer.stop()
             local.observer.join()
             raise
-        remote = SFTPFileSystem(client)
+        remote = SFTPFileSystem(ResilientSFTPClient(client))
+        # checksums of both sides are compared, use the same algorithm
+        local.algorithm = client.algorithm
     if not remote:
-        sync_logger.error("Connection failed!<br />")
+        sync_logger.error("Connection failed!")
+        local.observer.stop()
+        local.observer.join()
         raise Exception("Connection failed.")
+    return local, remote
+
+def set_limits(network_rate=None, disk_rate=None, operations_rate=None):
+    """
+    Limit the network and disk bytes and the file system operations
+    of the synchronization, see L{MiGBox.throttle}.
+
+    @param network_rate: KiB per second, 0 or empty for unlimited.
+    @type network_rate: str
+    @param disk_rate: KiB per second, 0 or empty for unlimited.
+    @type disk_rate: str
+    @param operations_rate: operations per second, 0 or empty for unlimited.
+    @type operations_rate: str
+    """
+
+    throttle.set_limits(int(network_rate or 0) * 1024, int(disk_rate or 0) * 1024,
+                        int(operations_rate or 0))
+
+def disconnect(local, remote):
+    """
+    Stop observing and close the connection of L{connect}.
+    """
+
+    for fs in (local, remote):
+        if isinstance(fs, OSFileSystem):
+            fs.observer.stop()
+            fs.observer.join()
+        else:
+            # the wrapped client, a failed close does not reconnect
+            fs.instance.client.close()
+
+def plan(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
+         keypass=None, username=None, password=None, logfile=None, loglevel='INFO',
+         execute=False, workers=1, verbose=False, network_rate=None, disk_rate=None,
+         operations_rate=None, **kargs):
+    """
+    Print the sync plan of source and destination, see
+    L{MiGBox.sync.plan_sync}, and execute it if C{execute} is set.
+
+    @return: the sync plan.
+    @rtype: L{MiGBox.sync.SyncPlan}
+    """
+
+    listener = log.setup(logfile, loglevel)
+    set_limits(network_rate, disk_rate, operations_rate)
+    try:
+        local, remote = connect(mode, source, destination, sftp_host, sftp_port,
+                                hostkey, userkey, keypass, username, password)
+        try:
+            sync_plan = plan_sync(local, remote)
+            print sync_plan.summary(verbose)
+            if execute:
+                with throttle.priority(throttle.BACKGROUND):
+                    failed = sync_plan.execute(workers)
+                print "{0} of {1} actions failed.".format(len(failed), sync_plan.operations)
+        finally:
+            disconnect(local, remote)
+    finally:
+        listener.stop()
+    return sync_plan
+
+def run(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
+        keypass=None, username=None, password=None, logfile=None, loglevel='INFO',
+        stopsync=threading.Event(), metrics_host=None, metrics_port=None, workers=1,
+        network_rate=None, disk_rate=None, operations_rate=None, **kargs):
+    global sync_all_thread
+    # records are written by the listener's thread, not by the sync threads
+    listener = log.setup(logfile, loglevel)
+    set_limits(network_rate, disk_rate, operations_rate)
+    try:
+        local, remote = connect(mode, source, destination, sftp_host, sftp_port,
+                                hostkey, userkey, keypass, username, password)
+    except:
+        listener.stop()
+        raise
 
     sync_events_thread = threading.Thread(target=sync_events, args=[local, remote,
-                                          local.eventQueue, stopsync, thread_lock])
+                                          local.eventQueue, stopsync, thread_lock, SMALL])
     sync_events_thread.name = "SyncEvents"
+    # large files are synchronized in their own lane, see EventQueue
+    sync_large_thread = threading.Thread(target=sync_events, args=[local, remote,
+                                         local.eventQueue, stopsync, large_lock, LARGE])
+    sync_large_thread.name = "SyncLarge"
 
 
-    sync_all_files(local, remote, local.root)
-    sync_all_files(remote, local, remote.root)
+    with throttle.priority(throttle.BACKGROUND):
+        plan_sync(local, remote).execute(workers)
 
     poll_events(local, remote, stopsync)
 
     sync_events_thread.start()
+    sync_large_thread.start()
+
+    # files changed without events are synchronized by periodic rescans,
+    # after the edits
+    sync_all_thread = threading.Timer(RESCAN_INTERVAL, sync_all, [local, remote, stopsync])
+    sync_all_thread.start()
+
+    # metrics at http://metrics_host:metrics_port/metrics
+    metrics = serve(metrics_host or 'localhost', metrics_port) if metrics_port else None
 
     #print threading.enumerate()
     while not stopsync.isSet():
@@ -129,8 +236,11 @@ def run(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
     if mode == 'local':
         remote.observer.stop()
     local.observer.stop()
-    local.eventQueue.put(FileSystemEvent("SyncStopEvent", ""))
+    # wake up the sync threads, modified directories are not synchronized
+    for lane in LANES:
+        local.eventQueue.put(DirModifiedEvent(local.root), lane=lane)
     sync_events_thread.join()
+    sync_large_thread.join()
     if sync_all_thread:
         sync_all_thread.cancel()
         sync_all_thread.join()
@@ -138,3 +248,6 @@ def run(mode, source, destination, sftp_host, sftp_port, hostkey, userkey,
         poll_thread.cancel()
         poll_thread.join()
     local.observer.join()
+    if metrics:
+        metrics.stop()
+    listener.stop()
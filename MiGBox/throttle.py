@@ -0,0 +1,204 @@
+# MiGBox throttle module
+#
+# Copyright (C) 2013 Benjamin Ertl
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+MiGBox throttle module.
+Provides token buckets limiting the network and disk bytes and the file
+system operations per second of the synchronization.
+
+The file system abstractions consume the bytes they transfer, read and
+write from L{network} and L{disk}, and each request or call of a file
+system from L{operations}. Waiting threads of the L{INTERACTIVE}
+class, e.g. the synchronization of events, are served before the ones of
+the L{BACKGROUND} class, e.g. rescans::
+
+    with priority(BACKGROUND):
+        sync_all_files(local, remote)
+
+The limits can be changed at any time with L{set_limits}.
+"""
+
+import time
+import threading
+
+from contextlib import contextmanager
+
+from MiGBox.metrics import THROTTLE_SECONDS
+
+# priority classes, lower ones are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+_PRIORITY_NAMES = ('interactive', 'background')
+
+# smallest number of bytes consumed at once, if the rate is lower
+MIN_BURST = 65536
+
+_local = threading.local()
+
+def current_priority():
+    """
+    Return the priority class of the current thread.
+
+    @return: L{INTERACTIVE} unless set by L{priority}.
+    @rtype: int
+    """
+
+    return getattr(_local, 'priority', INTERACTIVE)
+
+@contextmanager
+def priority(level):
+    """
+    Set the priority class of the current thread within a C{with} block.
+
+    @param level: L{INTERACTIVE} or L{BACKGROUND}.
+    @type level: int
+    """
+
+    previous = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+class TokenBucket(object):
+    """
+    This class is a token bucket of bytes or operations, refilled at
+    C{rate} per second up to C{burst}.
+
+    Large amounts are consumed in parts of at most C{burst}, so that
+    threads of a higher priority class get their share between the parts.
+    A rate of 0 is unlimited.
+    """
+
+    def __init__(self, name, rate=0, burst=None, min_burst=MIN_BURST):
+        """
+        Create a new token bucket.
+
+        @param name: name of the limited resource, e.g. 'network'.
+        @type name: str
+        @param rate: bytes or operations per second, 0 for unlimited.
+        @type rate: int
+        @param burst: maximum consumed at once, by default
+                      a second of the rate.
+        @type burst: int
+        @param min_burst: smallest default burst, if the rate is lower.
+        @type min_burst: int
+        """
+
+        self.name = name
+        self.min_burst = min_burst
+        self.cond = threading.Condition()
+        # waiting threads by priority class
+        self.waiting = [0] * len(_PRIORITY_NAMES)
+        self.rate = 0
+        self.burst = min_burst
+        self.tokens = 0.0
+        self.last = time.time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate, waiting threads continue with the new one.
+
+        @param rate: bytes or operations per second, 0 for unlimited.
+        @type rate: int
+        @param burst: maximum consumed at once.
+        @type burst: int
+        """
+
+        with self.cond:
+            self._refill()
+            limited = self.rate
+            self.rate = max(0, int(rate or 0))
+            self.burst = int(burst or max(self.rate, self.min_burst))
+            # a new limit starts with a full bucket
+            self.tokens = min(self.tokens, self.burst) if limited else float(self.burst)
+            self.cond.notify_all()
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, n, level=None):
+        """
+        Wait until C{n} bytes may be transferred or C{n} operations done.
+
+        @param n: number of bytes or operations.
+        @type n: int
+        @param level: priority class, by default the one of the thread.
+        @type level: int
+        @return: seconds waited.
+        @rtype: float
+        """
+
+        if level is None:
+            level = current_priority()
+        waited = 0.0
+        while n > 0 and self.rate:
+            part = min(n, self.burst)
+            waited += self._take(part, level)
+            n -= part
+        if waited:
+            THROTTLE_SECONDS.inc((self.name, _PRIORITY_NAMES[level]), waited)
+        return waited
+
+    def _take(self, n, level):
+        start = time.time()
+        with self.cond:
+            self.waiting[level] += 1
+            try:
+                while self.rate:
+                    self._refill()
+                    # the burst may have been lowered since n was taken from it
+                    if self.tokens >= min(n, self.burst) and not any(self.waiting[:level]):
+                        self.tokens -= n
+                        break
+                    self.cond.wait(max(0.001, (min(n, self.burst) - self.tokens) / self.rate))
+            finally:
+                self.waiting[level] -= 1
+                self.cond.notify_all()
+        return time.time() - start
+
+# limits of the process
+network = TokenBucket('network')
+disk = TokenBucket('disk')
+# at most a second of operations at once, not MIN_BURST
+operations = TokenBucket('operations', min_burst=1)
+
+def set_limits(network_rate=None, disk_rate=None, operations_rate=None):
+    """
+    Change the limits of L{network}, L{disk} and L{operations}, a limit
+    of None is left unchanged, 0 is unlimited.
+
+    @param network_rate: network bytes per second.
+    @type network_rate: int
+    @param disk_rate: disk bytes per second.
+    @type disk_rate: int
+    @param operations_rate: file system operations per second.
+    @type operations_rate: int
+    """
+
+    if network_rate is not None:
+        network.set_rate(network_rate)
+    if disk_rate is not None:
+        disk.set_rate(disk_rate)
+    if operations_rate is not None:
+        operations.set_rate(operations_rate)
@@ -98,7 +98,11 @@ def start_cli(args, basedir):
     if _vars["Logging"]["logfile"] and not os.path.isfile(_vars["Logging"]["logfile"]):
         _vars["Logging"]["logfile"] = None
     print_vars(_vars)
-    cli.run(mode, **get_vars(_vars))
+    if args.plan:
+        cli.plan(mode, execute=args.execute, workers=args.workers, verbose=args.verbose,
+                 **get_vars(_vars))
+    else:
+        cli.run(mode, workers=args.workers, **get_vars(_vars))
 
 def start_gui(args, basedir):
     # load configuration file at default location
@@ -145,6 +149,14 @@ def _parseargs(basedir):
     cliparser.add_argument("-l", "--logfile", type=str, help="path to the log file")
     cliparser.add_argument("-ll", "--loglevel", type=str, choices=['INFO', 'DEBUG'],
                               help="log level for logging")
+    cliparser.add_argument("--plan", action="store_true",
+                           help="print the sync plan and its estimated cost and exit")
+    cliparser.add_argument("--execute", action="store_true",
+                           help="execute the sync plan printed with --plan")
+    cliparser.add_argument("-v", "--verbose", action="store_true",
+                           help="list every action of the sync plan")
+    cliparser.add_argument("-w", "--workers", type=int, default=1,
+                           help="number of threads transferring files of the sync plan")
 
     cliparser.set_defaults(func=start_cli)
 
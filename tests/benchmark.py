@@ -0,0 +1,884 @@
+#!/usr/bin/python
+"""
+Benchmarks for MiGBox.
+
+Checksums, deltas and patches, the synchronization of single files and
+of trees and the SFTP extension commands of a loopback server are run
+on deterministic synthetic corpora. The results are written as json
+and can be compared to the results of an earlier run as baseline.
+
+A benchmark that is slower than its baseline by more than the threshold,
+or whose delta got bigger, is reported as regression and the exit
+status is 1.
+
+With C{--sync}, the sync daemon and the SFTP server run end to end
+instead, see L{SyncBenchmark}, optionally over a connection with the
+latency and bandwidth of a wide area network.
+
+Usage, from the MiGBox directory::
+
+    python tests/benchmark.py -o baseline.json
+    python tests/benchmark.py -b baseline.json -o results.json
+    python tests/benchmark.py --sync --latency 50 --bandwidth 1024
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import platform
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+from Queue import Queue
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, ROOT)
+
+import paramiko
+
+from MiGBox.fs import OSFileSystem, SFTPFileSystem
+from MiGBox.sync import EventJournal
+from MiGBox.sync import delta as delta_module
+from MiGBox.sync.delta import blockchecksums, delta, patch, sparse_write, sparse_end, \
+                              LITERAL, ALGORITHM
+from MiGBox.sync.sync import sync_file, sync_all_files
+from MiGBox.sftp import SFTPClient
+from MiGBox.sftp.server import SFTPServer, Server
+from MiGBox.sftp.cache import SignatureCache
+from MiGBox.sftp.common import compress_delta
+
+# version of the result format
+VERSION = 1
+
+MB = 1048576
+
+KEYS = os.path.join(ROOT, "keys")
+
+# metrics compared to the baseline besides the time, they must not grow
+SIZES = ('instructions', 'literal', 'wire')
+
+def _random(rng, n):
+    # n random bytes of the generator rng
+    if not n:
+        return ''
+    return ('%0*x' % (2 * n, rng.getrandbits(8 * n))).decode('hex')
+
+def _write(path, data):
+    # write data to path, runs of zeros become holes
+    with open(path, 'wb') as f:
+        skipped = False
+        for i in xrange(0, len(data), 65536):
+            skipped = sparse_write(f, data[i:i+65536])
+        if skipped:
+            sparse_end(f)
+
+def corpus_random(rng, size):
+    # unrelated files
+    return _random(rng, size), _random(rng, size)
+
+def corpus_append(rng, size):
+    basis = _random(rng, size)
+    return basis, basis + _random(rng, size // 16)
+
+def corpus_insert(rng, size):
+    basis = _random(rng, size)
+    return basis, basis[:size // 2] + _random(rng, 4096) + basis[size // 2:]
+
+def corpus_edit(rng, size):
+    # a few changed bytes all over the file
+    basis = _random(rng, size)
+    new = bytearray(basis)
+    for i in xrange(16):
+        pos = rng.randrange(size)
+        new[pos] = (new[pos] + 1) & 255
+    return basis, str(new)
+
+def corpus_sparse(rng, size):
+    # data between long runs of zeros, written as holes
+    data = _random(rng, size // 4)
+    zeros = '\0' * size
+    basis = data + zeros + data + zeros
+    return basis, data[:-100] + _random(rng, 100) + zeros + zeros + data
+
+CORPORA = [('random', corpus_random), ('append', corpus_append), ('insert', corpus_insert),
+           ('edit', corpus_edit), ('sparse', corpus_sparse)]
+
+def make_tree(root, rng, files, size):
+    """
+    Create a tree of small files.
+
+    @param root: path of the tree.
+    @type root: str
+    @param rng: random generator.
+    @type rng: L{random.Random}
+    @param files: number of files.
+    @type files: int
+    @param size: maximum size of a file.
+    @type size: int
+    @return: paths of the files.
+    @rtype: list
+    """
+
+    paths = []
+    for i in xrange(files):
+        dir_ = os.path.join(root, "dir%d" % (i % 10), "sub%d" % (i % 3))
+        if not os.path.isdir(dir_):
+            os.makedirs(dir_)
+        path = os.path.join(dir_, "file%d" % i)
+        with open(path, 'wb') as f:
+            f.write(_random(rng, rng.randrange(size)))
+        paths.append(path)
+    return paths
+
+def _age(path, seconds=3600):
+    # make a file older, so the other side of a synchronization is newer
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+def _local(root):
+    # local file system, its observer is not needed here
+    fs = OSFileSystem(root=root)
+    fs.observer.stop()
+    fs.observer.join()
+    return fs
+
+def measure(func, setup=None, repeat=3):
+    """
+    Run C{func} C{repeat} times, each time after C{setup}.
+
+    @param func: function to measure.
+    @type func: function
+    @param setup: function run before each run, not measured.
+    @type setup: function
+    @param repeat: number of runs.
+    @type repeat: int
+    @return: tuple as (times, result of the last run).
+    @rtype: tuple
+    """
+
+    times = []
+    result = None
+    for i in xrange(repeat):
+        if setup:
+            setup()
+        t = time.time()
+        result = func()
+        times.append(time.time() - t)
+    return times, result
+
+class LoopbackServer(object):
+    """
+    MiGBox SFTP server on the loopback interface, running in this process
+    with the keys of the repository.
+    """
+
+    def __init__(self, root, workers=4):
+        self.root = root
+        self.cache = SignatureCache()
+        self.pool = ThreadPool(workers)
+        self.journal = EventJournal()
+        self.hostkey = paramiko.RSAKey.from_private_key_file(
+            os.path.join(KEYS, "server_rsa_key"))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error:
+                return
+            server = Server(self.root, os.path.join(KEYS, "user_rsa_key.pub"), os.urandom(16),
+                            self.journal, self.cache, self.pool)
+            self.transports.append(SFTPServer.start_transport(conn, self.hostkey, server))
+
+    def connect(self):
+        """
+        Connect a new client.
+
+        @return: client.
+        @rtype: L{MiGBox.sftp.SFTPClient}
+        """
+
+        return SFTPClient.connect('127.0.0.1', self.port, os.path.join(KEYS, "server_rsa_key.pub"),
+                                  os.path.join(KEYS, "user_rsa_key"))
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+        self.pool.close()
+
+class Benchmark(object):
+    """
+    Runs the benchmarks in a temporary directory and collects the results.
+    """
+
+    def __init__(self, size=8*MB, files=1000, repeat=3, seed=0, only=None):
+        """
+        @param size: size of the corpus files.
+        @type size: int
+        @param files: number of files of the tree.
+        @type files: int
+        @param repeat: runs of each benchmark, the fastest one counts.
+        @type repeat: int
+        @param seed: seed of the corpora.
+        @type seed: int
+        @param only: run benchmarks with names containing this only.
+        @type only: str
+        """
+
+        self.size = size
+        self.files = files
+        self.repeat = repeat
+        self.seed = seed
+        self.only = only
+        self.results = []
+
+    def add(self, name, func, setup=None, repeat=None, **metrics):
+        """
+        Measure a benchmark and add its result.
+
+        @param name: name of the benchmark.
+        @type name: str
+        @param func: function to measure.
+        @type func: function
+        @param setup: function run before each run, not measured.
+        @type setup: function
+        @param repeat: number of runs, default of the benchmark if None.
+        @type repeat: int
+        @param metrics: further metrics of the result.
+        @type metrics: dict
+        @return: result of the function.
+        """
+
+        if self.only and self.only not in name:
+            return None
+        times, result = measure(func, setup, repeat or self.repeat)
+        entry = {'name': name, 'time': min(times), 'times': times}
+        entry.update(metrics)
+        self.results.append(entry)
+        print "%-32s %10.4f s" % (name, entry['time'])
+        return result
+
+    def add_delta(self, name, d):
+        # sizes of a delta for the last benchmark
+        if self.results and self.results[-1]['name'] == name:
+            self.results[-1].update(instructions=len(d),
+                                    literal=sum(len(i[1]) for i in d if i[0] == LITERAL),
+                                    wire=len(json.dumps(compress_delta(d, ''))))
+
+    def run(self):
+        """
+        Run all benchmarks.
+
+        @return: results.
+        @rtype: dict
+        """
+
+        tmp = tempfile.mkdtemp(prefix="migbox-bench-")
+        try:
+            local = os.path.join(tmp, "local")
+            remote = os.path.join(tmp, "remote")
+            os.mkdir(local)
+            os.mkdir(remote)
+            server = LoopbackServer(remote)
+            try:
+                client = server.connect()
+                self.run_files(local, remote, server, client)
+                self.run_trees(local, remote, server, client)
+                client.close()
+            finally:
+                server.close()
+        finally:
+            shutil.rmtree(tmp, True)
+        return {'version': VERSION, 'python': platform.python_version(),
+                'platform': platform.platform(), 'numpy': delta_module.numpy is not None,
+                'algorithm': ALGORITHM, 'size': self.size, 'files': self.files,
+                'seed': self.seed, 'results': self.results}
+
+    def run_files(self, local, remote, server, client):
+        rng = random.Random(self.seed)
+        basis = os.path.join(local, "basis")
+        new = os.path.join(local, "new")
+        fs = _local(local)
+        sftp = SFTPFileSystem(client, root=".")
+        # compare checksums of the same algorithm, like the synchronization
+        fs.algorithm = client.algorithm
+        for corpus, make in CORPORA:
+            old_data, new_data = make(rng, self.size)
+            _write(basis, old_data)
+            _write(new, new_data)
+
+            chk = self.add("blockchecksums/%s" % corpus, lambda: blockchecksums(basis))
+            self.add("blockchecksums-weak/%s" % corpus,
+                     lambda: blockchecksums(basis, strong=False))
+            chk = chk or blockchecksums(basis)
+            name = "delta/%s" % corpus
+            d = self.add(name, lambda: delta(new, chk))
+            d = d or delta(new, chk)
+            self.add_delta(name, d)
+            self.add("patch/%s" % corpus, lambda: os.remove(patch(basis, d)))
+
+            # local file to local and remote file
+            dst = os.path.join(local, "dst")
+            def setup():
+                _write(dst, old_data)
+                _age(dst)
+                fs.cache.clear()
+            self.add("sync_file/%s" % corpus, lambda: sync_file(fs, new, fs, dst), setup)
+            def setup():
+                _write(os.path.join(remote, "basis"), old_data)
+                _age(os.path.join(remote, "basis"))
+                server.cache.clear()
+                sftp.cache.clear()
+                fs.cache.clear()
+            self.add("sync_file-sftp/%s" % corpus,
+                     lambda: sync_file(fs, new, sftp, "basis"), setup)
+
+            # extension commands
+            _write(os.path.join(remote, "basis"), old_data)
+            _write(os.path.join(remote, "new"), new_data)
+            self.add("sftp-checksums/%s" % corpus, lambda: client.checksums("basis"),
+                     server.cache.clear)
+            name = "sftp-delta/%s" % corpus
+            d = self.add(name, lambda: client.delta("new", chk), server.cache.clear)
+            if d is not None:
+                self.add_delta(name, d)
+            d = delta(new, blockchecksums(os.path.join(remote, "basis"),
+                                          algorithm=client.algorithm))
+            self.add("sftp-patch/%s" % corpus, lambda: client.patch("basis", d),
+                     lambda: _write(os.path.join(remote, "basis"), old_data))
+            self.add("sftp-read/%s" % corpus,
+                     lambda: sum(len(c) for c in client.read_chunks("new", 0, len(new_data))))
+            def write():
+                with client.chunk_writer("written", 0) as f:
+                    for i in xrange(0, len(new_data), MB):
+                        f.write(new_data[i:i+MB])
+            self.add("sftp-write/%s" % corpus, write)
+        self.add("sftp-hello", lambda: [client.hello() for i in xrange(100)])
+        self.add("sftp-poll", lambda: [client.poll() for i in xrange(100)])
+
+    def run_trees(self, local, remote, server, client):
+        rng = random.Random(self.seed)
+        src = os.path.join(local, "tree")
+        os.mkdir(src)
+        paths = make_tree(src, rng, self.files, 8192)
+        src_fs = _local(src)
+        src_fs.algorithm = client.algorithm
+        dst_fs = SFTPFileSystem(client, root="tree")
+        def setup():
+            shutil.rmtree(os.path.join(remote, "tree"), True)
+            os.mkdir(os.path.join(remote, "tree"))
+            src_fs.cache.clear()
+            dst_fs.cache.clear()
+            server.cache.clear()
+        self.add("sync_all_files/initial", lambda: sync_all_files(src_fs, dst_fs), setup)
+        # a tenth of the files changed
+        changed = paths[::10]
+        for path in changed:
+            with open(path, 'ab') as f:
+                f.write(_random(rng, 100))
+        self.add("sync_all_files/update", lambda: sync_all_files(src_fs, dst_fs))
+        self.add("sync_all_files/unchanged", lambda: sync_all_files(src_fs, dst_fs))
+
+class ShapingProxy(object):
+    """
+    TCP proxy on the loopback interface, forwarding to a local port.
+
+    The data of each direction is delayed by the latency and limited to
+    the bandwidth, to model a wide area network. The proxy counts the
+    bytes of each direction and the round trips, i.e. how often the
+    client sent data after it received data.
+    """
+
+    def __init__(self, port, latency=0.0, bandwidth=0):
+        """
+        @param port: port to forward to.
+        @type port: int
+        @param latency: one way latency in seconds.
+        @type latency: float
+        @param bandwidth: bandwidth of each direction in bytes per second,
+                          0 for no limit.
+        @type bandwidth: int
+        """
+
+        self.target = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # bytes sent by the client and by the server
+        self.bytes = [0, 0]
+        self.round_trips = 0
+        self.last = None
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error:
+                return
+            upstream = socket.create_connection(('127.0.0.1', self.target))
+            for src, dst, direction in ((conn, upstream, 0), (upstream, conn, 1)):
+                queue = Queue()
+                for target, largs in ((self._read, (src, queue, direction)),
+                                      (self._write, (dst, queue))):
+                    thread = threading.Thread(target=target, args=largs)
+                    thread.daemon = True
+                    thread.start()
+
+    def _read(self, src, queue, direction):
+        # read data and queue it with the time it is due at the other side
+        free = 0.0
+        while True:
+            try:
+                data = src.recv(65536)
+            except socket.error:
+                data = ''
+            now = time.time()
+            if not data:
+                queue.put((now + self.latency, None))
+                return
+            with self.lock:
+                self.bytes[direction] += len(data)
+                if direction == 0 and self.last == 1:
+                    self.round_trips += 1
+                self.last = direction
+            if self.bandwidth:
+                # the data is sent after the data before it
+                free = max(free, now) + float(len(data)) / self.bandwidth
+                now = free
+            queue.put((now + self.latency, data))
+
+    def _write(self, dst, queue):
+        while True:
+            due, data = queue.get()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if data is None:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except socket.error:
+                return
+
+    def counters(self):
+        """
+        @return: tuple as (bytes from the client, bytes from the server, round trips).
+        @rtype: tuple
+        """
+
+        with self.lock:
+            return self.bytes[0], self.bytes[1], self.round_trips
+
+    def close(self):
+        self.socket.close()
+
+def _cpu(pid):
+    # cpu time of a process in seconds, None if unknown
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return float(int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def digests(root, cache):
+    """
+    Return the md5 digests of the files of a tree.
+
+    @param root: path of the tree.
+    @type root: str
+    @param cache: digests by (path, size, mtime) of earlier calls.
+    @type cache: dict
+    @return: digests by relative paths.
+    @rtype: dict
+    """
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+                key = (path, st.st_size, st.st_mtime)
+                if key not in cache:
+                    with open(path, 'rb') as f:
+                        cache[key] = hashlib.md5(f.read()).hexdigest()
+            except (IOError, OSError):
+                # removed in the meantime
+                continue
+            files[os.path.relpath(path, root)] = cache[key]
+    return files
+
+_SERVER = """
+import sys
+from MiGBox.sftp.server import run
+run(*sys.argv[1:6], processes=sys.argv[6])
+"""
+
+_DAEMON = """
+import sys, threading
+from MiGBox.sync import syncd
+stop = threading.Event()
+def wait():
+    sys.stdin.readline()
+    stop.set()
+thread = threading.Thread(target=wait)
+thread.daemon = True
+thread.start()
+syncd.run('remote', sys.argv[1], '.', '127.0.0.1', int(sys.argv[2]), sys.argv[3], sys.argv[4],
+          logfile=sys.argv[5], stopsync=stop)
+"""
+
+class SyncBenchmark(object):
+    """
+    Runs the sync daemon in remote mode against the SFTP server, both
+    in their own processes, and measures how fast mutations of the
+    trees converge.
+
+    The keys are generated, the client connects through a
+    L{ShapingProxy}. For each workload, the time to convergence, the
+    bytes of each direction, the round trips and the cpu time of the
+    daemon and the server are reported.
+
+    The trees have converged when both have the expected files and keep
+    them for L{SETTLE} seconds, longer than the daemon polls for events.
+    The workloads stop at the first one that does not converge.
+    """
+
+    # seconds the trees have to stay converged
+    SETTLE = 5
+
+    def __init__(self, size=8*MB, files=1000, seed=0, latency=0.0, bandwidth=0,
+                 processes=0, timeout=120, only=None):
+        """
+        @param size: size of the large file.
+        @type size: int
+        @param files: number of files of the tree.
+        @type files: int
+        @param seed: seed of the trees.
+        @type seed: int
+        @param latency: one way latency of the connection in seconds.
+        @type latency: float
+        @param bandwidth: bandwidth of the connection in bytes per second.
+        @type bandwidth: int
+        @param processes: processes of the server.
+        @type processes: int
+        @param timeout: seconds to wait for the convergence of a workload.
+        @type timeout: int
+        @param only: run workloads with names containing this only.
+        @type only: str
+        """
+
+        self.size = size
+        self.files = files
+        self.seed = seed
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.processes = processes
+        self.timeout = timeout
+        self.only = only
+        self.results = []
+        # expected digests by relative paths
+        self.expected = {}
+        self.cache = {}
+
+    def expect(self, root, path):
+        """
+        Expect the current content of a file at both trees.
+
+        @param root: path of the tree of the file.
+        @type root: str
+        @param path: path of the file.
+        @type path: str
+        """
+
+        with open(path, 'rb') as f:
+            self.expected[os.path.relpath(path, root)] = hashlib.md5(f.read()).hexdigest()
+
+    def _keys(self, tmp):
+        # generate the keys of the server and the user
+        paths = []
+        for name in ("server_rsa_key", "user_rsa_key"):
+            key = paramiko.RSAKey.generate(2048)
+            path = os.path.join(tmp, name)
+            key.write_private_key_file(path)
+            with open(path + ".pub", 'w') as f:
+                f.write("ssh-rsa %s migbox-benchmark\n" % key.get_base64())
+            paths.append(path)
+        return paths
+
+    def _spawn(self, code, largs, cwd):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT] + filter(None, [env.get('PYTHONPATH')]))
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.Popen([sys.executable, '-c', code] + [str(a) for a in largs],
+                                    stdin=subprocess.PIPE, stdout=devnull, cwd=cwd, env=env)
+
+    def _stop(self, process):
+        try:
+            process.stdin.write("exit\n")
+            process.stdin.close()
+        except IOError:
+            pass
+        for i in xrange(100):
+            if process.poll() is not None:
+                return
+            time.sleep(0.1)
+        process.kill()
+        process.wait()
+
+    def measure(self, name, mutate=None):
+        """
+        Apply a mutation and wait for the trees to converge.
+
+        @param name: name of the workload.
+        @type name: str
+        @param mutate: function mutating the trees and the expected
+                       files, None to measure the initial synchronization.
+        @type mutate: function
+        @return: trees converged.
+        @rtype: bool
+        """
+
+        if self.only and self.only not in name:
+            # mutate anyway, later workloads depend on it
+            if mutate:
+                mutate()
+            return self._wait(time.time()) is not None
+        up, down, round_trips = self.proxy.counters()
+        cpu = _cpu(self.daemon.pid), _cpu(self.server.pid)
+        t = time.time()
+        if mutate:
+            mutate()
+        done = self._wait(t)
+        elapsed = (done or time.time()) - t
+        up_, down_, round_trips_ = self.proxy.counters()
+        entry = {'name': "sync/%s" % name, 'time': elapsed, 'times': [elapsed],
+                 'converged': done is not None, 'up': up_ - up, 'down': down_ - down,
+                 'round_trips': round_trips_ - round_trips}
+        for key, pid, before in (('cpu_client', self.daemon.pid, cpu[0]),
+                                 ('cpu_server', self.server.pid, cpu[1])):
+            after = _cpu(pid)
+            entry[key] = after - before if None not in (before, after) else None
+        self.results.append(entry)
+        print "%-24s %8.2f s %10d up %10d down %6d round trips%s" % (
+            entry['name'], elapsed, entry['up'], entry['down'], entry['round_trips'],
+            "" if entry['converged'] else " NOT CONVERGED")
+        return entry['converged']
+
+    def _wait(self, start):
+        # time the trees converged at, None if they did not until the timeout
+        since = None
+        while time.time() < start + self.timeout:
+            now = time.time()
+            if digests(self.local, self.cache) == self.expected and \
+               digests(self.remote, self.cache) == self.expected:
+                if since is None:
+                    since = now
+                elif now - since >= self.SETTLE:
+                    return since
+            else:
+                since = None
+            time.sleep(0.2)
+        return None
+
+    def run(self):
+        """
+        Run all workloads.
+
+        @return: results.
+        @rtype: dict
+        """
+
+        rng = random.Random(self.seed)
+        tmp = tempfile.mkdtemp(prefix="migbox-sync-")
+        self.local = local = os.path.join(tmp, "local")
+        self.remote = remote = os.path.join(tmp, "remote")
+        os.mkdir(local)
+        os.mkdir(remote)
+        self.server = self.daemon = self.proxy = None
+        try:
+            hostkey, userkey = self._keys(tmp)
+            paths = make_tree(local, rng, self.files, 8192)
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+            s.close()
+            self.server = self._spawn(_SERVER, ['127.0.0.1', port, hostkey, userkey + ".pub",
+                                                remote, self.processes], tmp)
+            for i in xrange(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except socket.error:
+                    time.sleep(0.1)
+            self.proxy = ShapingProxy(port, self.latency, self.bandwidth)
+            self.daemon = self._spawn(_DAEMON, [local, self.proxy.port, hostkey + ".pub",
+                                                userkey, os.path.join(tmp, "sync.log")], tmp)
+            for path in paths:
+                self.expect(local, path)
+            workloads = [("initial", None)]
+
+            def create():
+                for i in xrange(self.files // 10):
+                    path = os.path.join(local, "dir0", "new%d" % i)
+                    with open(path, 'wb') as f:
+                        f.write(_random(rng, rng.randrange(8192)))
+                    self.expect(local, path)
+            workloads.append(("create", create))
+
+            def modify():
+                for path in paths[::10]:
+                    with open(path, 'ab') as f:
+                        f.write(_random(rng, 100))
+                    self.expect(local, path)
+            workloads.append(("modify", modify))
+
+            large = os.path.join(local, "large")
+
+            def create_large():
+                _write(large, _random(rng, self.size))
+                self.expect(local, large)
+            workloads.append(("large-create", create_large))
+
+            def edit():
+                with open(large, 'r+b') as f:
+                    f.seek(self.size // 2)
+                    f.write(_random(rng, 4096))
+                self.expect(local, large)
+            workloads.append(("large-edit", edit))
+
+            def delete():
+                for path in paths[::10]:
+                    os.remove(path)
+                    del self.expected[os.path.relpath(path, local)]
+            workloads.append(("delete", delete))
+
+            def create_remote():
+                for i in xrange(self.files // 10):
+                    path = os.path.join(remote, "dir1", "remote%d" % i)
+                    with open(path, 'wb') as f:
+                        f.write(_random(rng, rng.randrange(8192)))
+                    self.expect(remote, path)
+            workloads.append(("remote-create", create_remote))
+
+            for name, mutate in workloads:
+                if not self.measure(name, mutate):
+                    # later workloads would measure this one too
+                    break
+        finally:
+            for process in (self.daemon, self.server):
+                if process:
+                    self._stop(process)
+            if self.proxy:
+                self.proxy.close()
+            shutil.rmtree(tmp, True)
+        return {'version': VERSION, 'python': platform.python_version(),
+                'platform': platform.platform(), 'numpy': delta_module.numpy is not None,
+                'algorithm': ALGORITHM, 'size': self.size, 'files': self.files,
+                'seed': self.seed, 'latency': self.latency, 'bandwidth': self.bandwidth,
+                'results': self.results}
+
+def compare(results, baseline, threshold):
+    """
+    Compare results to a baseline.
+
+    @param results: results of L{Benchmark.run}.
+    @type results: dict
+    @param baseline: results of an earlier run.
+    @type baseline: dict
+    @param threshold: relative slowdown of a benchmark still accepted.
+    @type threshold: float
+    @return: regressions as list of tuples as (name, metric, baseline, result).
+    @rtype: list
+    """
+
+    for key in ('python', 'numpy', 'algorithm', 'size', 'files', 'seed', 'latency', 'bandwidth'):
+        if baseline.get(key) != results.get(key):
+            print "warning: %s differs from the baseline, %r != %r" % (key, results.get(key),
+                                                                       baseline.get(key))
+    regressions = []
+    old = dict((entry['name'], entry) for entry in baseline['results'])
+    for entry in results['results']:
+        base = old.get(entry['name'])
+        if not base:
+            continue
+        if entry['time'] > base['time'] * (1 + threshold):
+            regressions.append((entry['name'], 'time', base['time'], entry['time']))
+        for key in SIZES:
+            if key in entry and key in base and entry[key] > base[key]:
+                regressions.append((entry['name'], key, base[key], entry[key]))
+    return regressions
+
+def main():
+    parser = ArgumentParser(description="MiGBox benchmarks.")
+    parser.add_argument("-o", "--output", help="path to write the results to")
+    parser.add_argument("-b", "--baseline", help="path to the results to compare to")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+                        help="relative slowdown still accepted (default 0.25)")
+    parser.add_argument("-s", "--size", type=int, default=8, help="size of the files in MB")
+    parser.add_argument("-f", "--files", type=int, default=1000,
+                        help="number of files of the tree")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs of each benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpora")
+    parser.add_argument("-k", "--only", help="run benchmarks with names containing this only")
+    parser.add_argument("--sync", action="store_true",
+                        help="run the sync daemon against the server instead")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="one way latency of the connection in ms, with --sync")
+    parser.add_argument("--bandwidth", type=int, default=0,
+                        help="bandwidth of the connection in KB/s, with --sync")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="processes of the server, with --sync")
+    parser.add_argument("--timeout", type=int, default=120,
+                        help="seconds to wait for the convergence of a workload, with --sync")
+    args = parser.parse_args()
+
+    if args.sync:
+        results = SyncBenchmark(args.size * MB, args.files, args.seed, args.latency / 1000.0,
+                                args.bandwidth * 1024, args.processes, args.timeout,
+                                args.only).run()
+    else:
+        results = Benchmark(args.size * MB, args.files, args.repeat, args.seed, args.only).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, key, old, new in regressions:
+            print "REGRESSION %-32s %-12s %r -> %r" % (name, key, old, new)
+        if regressions:
+            sys.exit(1)
+        print "no regressions"
+
+if __name__ == '__main__':
+    main()
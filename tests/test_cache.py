@@ -0,0 +1,45 @@
+import unittest
+
+import os
+
+from MiGBox.sftp.cache import SignatureCache
+
+class SignatureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        with open('.tmp', 'wb') as f:
+            f.write('hello')
+
+    def tearDown(self):
+        os.remove('.tmp')
+
+    def test_get(self):
+        cache = SignatureCache()
+        calls = []
+        compute = lambda: calls.append(1) or 'value'
+
+        self.assertEqual(cache.get('.tmp', compute, 'kind'), 'value')
+        self.assertEqual(cache.get('.tmp', compute, 'kind'), 'value')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_get_modified(self):
+        cache = SignatureCache()
+        cache.get('.tmp', lambda: 'old', 'kind')
+
+        with open('.tmp', 'ab') as f:
+            f.write(' world')
+
+        self.assertEqual(cache.get('.tmp', lambda: 'new', 'kind'), 'new')
+
+    def test_evict(self):
+        cache = SignatureCache(maxsize=8)
+        cache.get('.tmp', lambda: 'aaaaa', 'a')
+        cache.get('.tmp', lambda: 'bbbbb', 'b')
+
+        self.assertEqual(len(cache.entries), 1)
+        self.assertEqual(cache.size, 5)
+        self.assertEqual(cache.get('.tmp', lambda: 'b', 'b'), 'bbbbb')
+
+if __name__ == '__main__':
+    unittest.main()
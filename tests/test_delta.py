@@ -6,7 +6,12 @@ import hashlib
 import base64
 import filecmp
 
-from MiGBox.sync.delta import weakchecksum, strongchecksum, blockchecksums, delta, patch
+from multiprocessing import Pool
+
+from MiGBox.sync import delta as delta_module
+from MiGBox.sync.delta import weakchecksum, strongchecksum, blockchecksums, delta, patch, \
+                              encode_signature, decode_signature, COPY, LITERAL, ZERO
+from MiGBox.sftp.common import compress_delta, decompress_delta
 
 class DeltaTest(unittest.TestCase):
 
@@ -20,28 +25,88 @@ class DeltaTest(unittest.TestCase):
         data = 'hello'
         md5 = hashlib.md5()
         md5.update(data)
-        c1 = md5.hexdigest()
-        c2 = strongchecksum(data)
+        c1 = md5.digest()
+        c2 = strongchecksum(data, 'md5')
         self.failUnlessEqual(c1, c2)
+        c3 = strongchecksum(data, 'md5', 8)
+        self.failUnlessEqual(c1[:8], c3)
 
     def test_blockchecksums(self):
         data = 'hello'
         md5 = hashlib.md5()
         md5.update(data)
         c1 = zlib.adler32(data) & 0xffffffff
-        c2 = md5.hexdigest()
+        c2 = md5.digest()[:8]
 
-        h1 = { unicode(c1 >> 16): [(0, c1, c2)] }
+        h1 = { 'algorithm': 'md5', 'digest_size': 8, 'blocksize': 64,
+               'blocks': [(0, c1, c2)], 'zeros': [] }
 
         with open('.tmp','wb') as f:
             f.write(data)
 
-        h2 = blockchecksums('.tmp')
+        h2 = blockchecksums('.tmp', algorithm='md5')
 
         os.remove('.tmp')
 
         self.failUnlessEqual(h1, h2)
 
+    def test_blockchecksums_parallel(self):
+        with open('.tmp','wb') as f:
+            f.write(os.urandom(10000))
+
+        rangesize = delta_module.RANGESIZE
+        delta_module.RANGESIZE = 1000
+        pool = Pool(2)
+        try:
+            h1 = blockchecksums('.tmp')
+            h2 = blockchecksums('.tmp', pool=pool)
+        finally:
+            delta_module.RANGESIZE = rangesize
+            pool.close()
+            pool.join()
+            os.remove('.tmp')
+
+        self.failUnlessEqual(h1, h2)
+        self.failUnlessEqual(157, len(h2['blocks']))
+
+    def test_signature(self):
+        with open('.tmp','wb') as f:
+            f.write(os.urandom(1000))
+
+        h1 = blockchecksums('.tmp')
+        os.remove('.tmp')
+
+        h2 = decode_signature(encode_signature(h1))
+        self.failUnlessEqual(h1, h2)
+
+        # plain table of md5 hexdigests
+        h3 = decode_signature('{"1": [[64, 65537, "%s"]], "2": [[0, 131073, "%s"]]}'
+                              % ('ab' * 16, 'cd' * 16))
+        self.failUnlessEqual('md5', h3['algorithm'])
+        self.failUnlessEqual(16, h3['digest_size'])
+        self.failUnlessEqual([(0, 131073, '\xcd' * 16), (64, 65537, '\xab' * 16)],
+                             h3['blocks'])
+
+    def test_blockchecksums_weak(self):
+        data = 'a' * 100
+        # same weak checksums: +1, -2, +1 keeps both adler32 sums
+        changed = data[:10] + 'b_b' + data[13:]
+
+        with open('.tmp1', 'wb') as f:
+            f.write(data)
+        with open('.tmp2', 'wb') as f:
+            f.write(changed)
+
+        h1 = blockchecksums('.tmp1', strong=False)
+        h2 = blockchecksums('.tmp2', strong=False)
+
+        os.remove('.tmp1')
+        os.remove('.tmp2')
+
+        self.failUnlessEqual(h1['blocks'], h2['blocks'])
+        self.assertTrue(all(strong is None for _, _, strong in h1['blocks']))
+        self.assertNotEqual(h1, h2)
+
     def test_delta_equal(self):
         data = 'hello'
 
@@ -52,7 +117,7 @@ class DeltaTest(unittest.TestCase):
 
         os.remove('.tmp')
 
-        self.failUnlessEqual([(0, '')], d)
+        self.failUnlessEqual([(COPY, 0, 5)], d)
 
     def test_delta_new(self):
         data = 'hello'
@@ -68,7 +133,7 @@ class DeltaTest(unittest.TestCase):
         os.remove('.tmp1')
         os.remove('.tmp2')
 
-        self.failUnlessEqual([(0, base64.b64encode(data))], d)
+        self.failUnlessEqual([(LITERAL, data)], d)
 
     def test_delta_patch(self):
         data = 'hello'
@@ -89,5 +154,162 @@ class DeltaTest(unittest.TestCase):
         os.remove('.tmp2')
         os.remove(patchname)
 
+    def test_delta_parallel(self):
+        old = os.urandom(10000)
+        new = old[:3000] + 'changed' + old[3000:6000] + old[6100:]
+
+        with open('.tmp1', 'wb') as f:
+            f.write(new)
+        with open('.tmp2', 'wb') as f:
+            f.write(old)
+
+        rangesize = delta_module.RANGESIZE
+        delta_module.RANGESIZE = 1000
+        pool = Pool(2)
+        try:
+            d1 = delta('.tmp1', blockchecksums('.tmp2'))
+            d2 = delta('.tmp1', blockchecksums('.tmp2'), pool=pool)
+        finally:
+            delta_module.RANGESIZE = rangesize
+            pool.close()
+            pool.join()
+            os.remove('.tmp1')
+            os.remove('.tmp2')
+
+        self.failUnlessEqual(d1, d2)
+
+    @unittest.skipIf(delta_module.numpy is None, "numpy is not available")
+    def test_delta_numpy(self):
+        old = os.urandom(10000)
+        new = 'x' + old[:3000] + 'changed' + old[3000:6000] + old[6100:]
+
+        with open('.tmp1', 'wb') as f:
+            f.write(new)
+        with open('.tmp2', 'wb') as f:
+            f.write(old)
+
+        numpy = delta_module.numpy
+        try:
+            h1 = blockchecksums('.tmp2')
+            d1 = delta('.tmp1', h1)
+            delta_module.numpy = None
+            h2 = blockchecksums('.tmp2')
+            d2 = delta('.tmp1', h2)
+        finally:
+            delta_module.numpy = numpy
+            os.remove('.tmp1')
+            os.remove('.tmp2')
+
+        self.failUnlessEqual(h1, h2)
+        self.failUnlessEqual(d1, d2)
+
+    def test_delta_copy_ranges(self):
+        old = os.urandom(1000)
+        new = old[:500] + 'changed' + old[500:]
+
+        with open('.tmp1', 'wb') as f:
+            f.write(new)
+        with open('.tmp2', 'wb') as f:
+            f.write(old)
+
+        d = delta('.tmp1', blockchecksums('.tmp2'))
+        patchname = patch('.tmp2', d)
+
+        self.assertTrue(filecmp.cmp('.tmp1', patchname))
+        # matching blocks are copied as one range before and after the change
+        copies = [entry for entry in d if entry[0] == COPY]
+        self.failUnlessEqual([(COPY, 0, 448), (COPY, 512, 488)], copies)
+
+        os.remove('.tmp1')
+        os.remove('.tmp2')
+        os.remove(patchname)
+
+    def test_blockchecksums_zeros(self):
+        with open('.tmp', 'wb') as f:
+            f.write('a' * 64)
+            # hole, if the file system supports it
+            f.seek(256, os.SEEK_CUR)
+            f.write('\0' * 64 + 'b' * 100)
+
+        numpy = delta_module.numpy
+        try:
+            h1 = blockchecksums('.tmp')
+            delta_module.numpy = None
+            h2 = blockchecksums('.tmp')
+        finally:
+            delta_module.numpy = numpy
+            os.remove('.tmp')
+
+        self.failUnlessEqual([(64, 320)], h1['zeros'])
+        self.failUnlessEqual([0, 384, 448], [off for off, _, _ in h1['blocks']])
+        self.failUnlessEqual(h1, h2)
+
+    def test_delta_zeros(self):
+        old = os.urandom(1000)
+
+        with open('.tmp1', 'wb') as f:
+            f.write(old[:500])
+            f.seek(200000, os.SEEK_CUR)
+            f.write(old[500:])
+        with open('.tmp2', 'wb') as f:
+            f.write(old)
+
+        d = delta('.tmp1', blockchecksums('.tmp2'))
+        patchname = patch('.tmp2', d)
+
+        self.assertTrue(filecmp.cmp('.tmp1', patchname))
+        # the zeros are not sent
+        self.assertTrue(sum(len(e[1]) for e in d if e[0] == LITERAL) < 200)
+        self.assertTrue(sum(e[1] for e in d if e[0] == ZERO) > 199900)
+        self.failUnlessEqual(d, decompress_delta(compress_delta(d, '')))
+
+        os.remove('.tmp1')
+        os.remove('.tmp2')
+        os.remove(patchname)
+
+    def test_patch_blocks(self):
+        with open('.tmp', 'wb') as f:
+            f.write('a' * 64 + 'b' * 64)
+
+        # delta of older versions, single blocks and base64 literals
+        d = decompress_delta([(64, ''), (0, base64.b64encode('c')), (0, '')])
+        patchname = patch('.tmp', d)
+        with open(patchname, 'rb') as f:
+            self.failUnlessEqual('b' * 64 + 'c' + 'a' * 64, f.read())
+
+        os.remove('.tmp')
+        os.remove(patchname)
+
+    def test_compress_delta(self):
+        d = [(COPY, 0, 128), (LITERAL, 'a' * 1000), (COPY, 128, 64)]
+        for codec in ('', 'zlib'):
+            self.failUnlessEqual(d, decompress_delta(compress_delta(d, codec)))
+
+    def test_delta_repeated_blocks(self):
+        data = 'a' * 256
+
+        with open('.tmp1', 'wb') as f:
+            f.write(data + 'b')
+        with open('.tmp2', 'wb') as f:
+            f.write(data)
+
+        d = delta('.tmp1', blockchecksums('.tmp2'))
+        patchname = patch('.tmp2', d)
+
+        self.assertTrue(filecmp.cmp('.tmp1', patchname))
+
+        os.remove('.tmp1')
+        os.remove('.tmp2')
+        os.remove(patchname)
+
+    def test_patch_cleanup(self):
+        with open('.tmp', 'wb') as f:
+            f.write('hello')
+
+        self.assertRaises(ValueError, patch, '.tmp', [('X', 0)])
+        self.assertFalse(os.path.exists('.tmp.patched'))
+
+        os.remove('.tmp')
+
 if __name__ == '__main__':
     unittest.main()
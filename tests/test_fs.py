@@ -1,7 +1,9 @@
 import unittest
 
 import os
+import json
 import shutil
+import hashlib
 
 from MiGBox.fs import FileSystem, OSFileSystem, SFTPFileSystem
 
@@ -98,6 +100,37 @@ class FileSystemTest(unittest.TestCase):
         self.assertTrue(os.path.exists(".testdir/copyfile"))
         self.assertTrue(os.path.exists(".testdir/file"))
 
+    def test_transfer_resume(self):
+        fs = self.fs
+
+        data = os.urandom(1000)
+        with open(".testdir/resumefile", "wb") as f:
+            f.write(data)
+        st = os.stat(".testdir/resumefile")
+        # an interrupted transfer with a checkpoint after 600 bytes
+        with open(".testdir/resumed.part", "wb") as f:
+            f.write(data[:700])
+        with open(".testdir/resumed.part.chk", "wb") as f:
+            f.write(json.dumps({"size": st.st_size, "mtime": st.st_mtime, "offset": 600,
+                                "md5": hashlib.md5(data[:600]).hexdigest()}))
+
+        fs.transfer(fs, ".testdir/resumefile", fs, ".testdir/resumed")
+
+        with open(".testdir/resumed", "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(".testdir/resumed.part"))
+        self.assertFalse(os.path.exists(".testdir/resumed.part.chk"))
+
+    def test_digest(self):
+        fs = self.fs
+
+        data = os.urandom(1000)
+        with open(".testdir/digestfile", "wb") as f:
+            f.write(data)
+
+        self.assertEqual(fs.digest(".testdir/digestfile", 600), hashlib.md5(data[:600]).hexdigest())
+        self.assertRaises(IOError, fs.digest, ".testdir/digestfile", 1001)
+
     def test_open(self):
         fs = self.fs
 
@@ -0,0 +1,131 @@
+import unittest
+
+import os
+import json
+import logging
+
+from Queue import Queue
+
+from MiGBox.log import JSONFormatter, RateLimitFilter, QueueHandler, setup, parse, to_html, \
+                       LogTail
+
+def record(message, level=logging.INFO, **fields):
+    record = logging.LogRecord("sync", level, __file__, 0, message, (), None)
+    record.__dict__.update(fields)
+    return record
+
+class LogTest(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists('.tmp'):
+            os.remove('.tmp')
+
+    def test_json(self):
+        entry = json.loads(JSONFormatter().format(record("SYNC a ==> b", action='sync_to',
+                                                         paths=('a', 'b'))))
+
+        self.assertEqual(entry['message'], "SYNC a ==> b")
+        self.assertEqual(entry['level'], "INFO")
+        self.assertEqual(entry['action'], "sync_to")
+        self.assertEqual(entry['paths'], ["a", "b"])
+
+    def test_rate_limit(self):
+        limit = RateLimitFilter(rate=2)
+        passed = [limit.filter(record("debug", logging.DEBUG)) for i in xrange(5)]
+        info = record("info")
+
+        self.assertEqual(passed, [True, True, False, False, False])
+        self.assertTrue(limit.filter(info))
+        self.assertEqual(info.suppressed, 3)
+
+    def test_queue_full(self):
+        queue = Queue(1)
+        handler = QueueHandler(queue)
+        for i in xrange(3):
+            handler.handle(record("message"))
+        queue.get()
+        handler.handle(record("next"))
+
+        self.assertEqual(queue.get().dropped, 2)
+
+    def test_setup(self):
+        listener = setup('.tmp', 'INFO', loggers=("test",))
+        logger = logging.getLogger("test")
+        logger.info("COPY %s ==> %s", "a", "b", extra={'action': 'copy'})
+        logger.debug("not written")
+        listener.stop()
+        logger.removeHandler(logger.handlers[0])
+
+        with open('.tmp') as f:
+            entries = [parse(line) for line in f]
+        self.assertEqual([(e['message'], e['action']) for e in entries],
+                         [("COPY a ==> b", "copy")])
+
+    def test_html(self):
+        html = to_html({'time': 0, 'level': 'ERROR', 'message': '<a> & b'})
+
+        self.assertIn("&lt;a&gt; &amp; b", html)
+        self.assertFalse(html.endswith("<br />"))
+        self.assertEqual(parse("New log file ...<br />"), None)
+
+    def test_tail(self):
+        def write(mode, *messages):
+            with open('.tmp', mode) as f:
+                f.write("".join(json.dumps({'message': m}) + "\n" for m in messages))
+
+        write('w', "a", "b")
+        tail = LogTail('.tmp')
+        entries, reset = tail.read()
+        self.assertEqual(([e['message'] for e in entries], reset), (["a", "b"], True))
+
+        with open('.tmp', 'a') as f:
+            f.write(json.dumps({'message': "c"}) + "\n" + '{"mess')
+        entries, reset = tail.read()
+        self.assertEqual(([e['message'] for e in entries], reset), (["c"], False))
+        with open('.tmp', 'a') as f:
+            f.write('age": "d"}\n')
+        self.assertEqual([e['message'] for e in tail.read()[0]], ["d"])
+        self.assertEqual(tail.read(), ([], False))
+
+        # rotated file
+        os.remove('.tmp')
+        write('w', "e")
+        entries, reset = tail.read()
+        self.assertEqual(([e['message'] for e in entries], reset), (["e"], True))
+
+    def test_tail_size(self):
+        with open('.tmp', 'w') as f:
+            for i in xrange(100):
+                f.write(json.dumps({'message': str(i)}) + "\n")
+        entries, reset = LogTail('.tmp', tail_size=50).read()
+
+        self.assertTrue(reset)
+        self.assertTrue(0 < len(entries) < 100)
+        self.assertEqual(entries[-1]['message'], "99")
+
+    def test_tail_growing(self):
+        with open('.tmp', 'w') as f:
+            for i in xrange(100):
+                f.write(json.dumps({'message': str(i)}) + "\n")
+        fstat = os.fstat
+
+        def append(fd):
+            # a record is written between the stat and the read
+            st = fstat(fd)
+            with open('.tmp', 'a') as f:
+                f.write(json.dumps({'message': "100"}) + "\n")
+            return st
+        tail = LogTail('.tmp', tail_size=50)
+        os.fstat = append
+        try:
+            entries = tail.read()[0]
+        finally:
+            os.fstat = fstat
+        with open('.tmp', 'a') as f:
+            f.write(json.dumps({'message': "101"}) + "\n")
+
+        self.assertEqual(entries[-1]['message'], "100")
+        self.assertEqual([e['message'] for e in tail.read()[0]], ["101"])
+
+if __name__ == '__main__':
+    unittest.main()
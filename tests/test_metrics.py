@@ -0,0 +1,101 @@
+import unittest
+import urllib2
+
+from MiGBox.metrics import Registry, timed, expose, serve, OPERATION_SECONDS, \
+                           OPERATION_ERRORS, EVENT_QUEUE_DEPTH
+from MiGBox.sync import EventQueue
+from watchdog.events import FileCreatedEvent
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("requests_total", "Requests.", ("kind",))
+        counter.inc(('a',))
+        counter.inc(('a',), 2)
+        counter.inc(('b',))
+
+        self.assertEqual(counter.samples(), [(('a',), 3), (('b',), 1)])
+        self.assertRaises(ValueError, counter.inc)
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("depth", "Depth.")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertEqual(gauge.get(), 1)
+        gauge.set(5)
+        self.assertEqual(gauge.get(), 5)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("seconds", "Seconds.", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.get(), {'buckets': [(0.1, 2), (1, 3)], 'count': 4,
+                                           'sum': 2.65})
+
+    def test_register(self):
+        self.registry.counter("requests_total", "Requests.")
+
+        self.assertRaises(ValueError, self.registry.gauge, "requests_total", "Requests.")
+        self.assertEqual(self.registry.snapshot(), {"requests_total": {}})
+
+    def test_expose(self):
+        counter = self.registry.counter("requests_total", "Requests.", ("command",))
+        counter.inc(('say "hi"',))
+        histogram = self.registry.histogram("seconds", "Seconds.", buckets=(0.5,))
+        histogram.observe(0.25)
+
+        self.assertEqual(expose(self.registry).splitlines(), [
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{command="say \\"hi\\""} 1',
+            '# HELP seconds Seconds.',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="0.5"} 1',
+            'seconds_bucket{le="+Inf"} 1',
+            'seconds_sum 0.25',
+            'seconds_count 1'])
+
+    def test_serve(self):
+        self.registry.gauge("depth", "Depth.").set(3)
+        server = serve('localhost', 0, self.registry)
+        try:
+            url = "http://localhost:%d/metrics" % server.server_address[1]
+            self.assertIn("depth 3\n", urllib2.urlopen(url).read())
+        finally:
+            server.stop()
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_timed(self):
+        class FileSystem(object):
+            @timed('stat')
+            def stat(self, fail):
+                if fail:
+                    raise OSError()
+
+        labels = ('stat', 'FileSystem')
+        OPERATION_SECONDS.clear()
+        OPERATION_ERRORS.clear()
+        FileSystem().stat(False)
+        self.assertRaises(OSError, FileSystem().stat, True)
+
+        self.assertEqual(OPERATION_SECONDS.get(labels)['count'], 2)
+        self.assertEqual(OPERATION_ERRORS.get(labels), 1)
+
+    def test_event_queue(self):
+        queue = EventQueue()
+        depth = EVENT_QUEUE_DEPTH.get() or 0
+        queue.put(FileCreatedEvent('a'))
+
+        self.assertEqual(EVENT_QUEUE_DEPTH.get(), depth + 1)
+        self.assertTrue(hasattr(queue.get(), 'arrival'))
+        self.assertEqual(EVENT_QUEUE_DEPTH.get(), depth)
+
+if __name__ == '__main__':
+    unittest.main()
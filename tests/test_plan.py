@@ -0,0 +1,156 @@
+import unittest
+
+import os
+import time
+import errno
+import shutil
+
+from MiGBox.fs import OSFileSystem
+from MiGBox.sync import plan_sync
+from MiGBox.sync.plan import COPY, DELTA, DELETE, MKDIR, MOVE, RMDIR
+
+def write(path, data, mtime=None):
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+
+class SyncPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        for root in (".plansrc", ".plandst"):
+            os.mkdir(root)
+        self.src = OSFileSystem(root=".plansrc")
+        self.dst = OSFileSystem(root=".plandst")
+
+    def tearDown(self):
+        for fs in (self.src, self.dst):
+            fs.observer.stop()
+            fs.observer.join()
+        shutil.rmtree(".plansrc")
+        shutil.rmtree(".plandst")
+
+    def kinds(self, plan):
+        return [(a.kind, a.src_path, a.dst_path) for a in plan.actions]
+
+    def test_plan(self):
+        os.mkdir(".plansrc/dir")
+        write(".plansrc/dir/new", "new")
+        write(".plansrc/same", "same")
+        write(".plandst/same", "same")
+        write(".plansrc/changed", "old", time.time() - 10)
+        write(".plandst/changed", "newer")
+        write(".plandst/remote", "remote")
+
+        plan = plan_sync(self.src, self.dst)
+
+        self.assertEqual(self.kinds(plan), [
+            (MKDIR, ".plansrc/dir", ".plandst/dir"),
+            (COPY, ".plansrc/dir/new", ".plandst/dir/new"),
+            (COPY, ".plandst/remote", ".plansrc/remote"),
+            (DELTA, ".plandst/changed", ".plansrc/changed")])
+        self.assertEqual((plan.operations, plan.bytes), (4, 3 + 6 + 5))
+        # planning does not change the files
+        self.assertFalse(os.path.exists(".plandst/dir"))
+
+    def test_execute(self):
+        os.mkdir(".plansrc/dir")
+        write(".plansrc/dir/a", "a" * 1000)
+        write(".plandst/b", "b")
+
+        failed = plan_sync(self.src, self.dst).execute(workers=2)
+
+        self.assertEqual(failed, [])
+        self.assertEqual(open(".plandst/dir/a").read(), "a" * 1000)
+        self.assertEqual(open(".plansrc/b").read(), "b")
+        self.assertEqual(plan_sync(self.src, self.dst).actions, [])
+
+    def test_delete_and_move(self):
+        write(".plansrc/a", "a" * 100)
+        write(".plansrc/b", "b" * 100)
+        plan_sync(self.src, self.dst).execute()
+        os.remove(".plansrc/a")
+        os.rename(".plansrc/b", ".plansrc/c")
+
+        plan = plan_sync(self.src, self.dst)
+
+        self.assertEqual(self.kinds(plan), [
+            (MOVE, ".plansrc/c", ".plandst/c"),
+            (DELETE, ".plansrc/a", ".plandst/a")])
+        self.assertEqual(plan.bytes, 0)
+        plan.execute()
+        self.assertEqual(sorted(os.listdir(".plandst")), ["c"])
+
+    def test_delete_dir(self):
+        for path in (".plansrc/a", ".plansrc/a/b", ".plansrc/c"):
+            os.mkdir(path)
+        write(".plansrc/a/b/f", "f" * 100)
+        write(".plansrc/c/g", "g" * 100)
+        plan_sync(self.src, self.dst).execute()
+        shutil.rmtree(".plansrc/a")
+        shutil.rmtree(".plansrc/c")
+        # c is made again for a new file
+        write(".plandst/c/h", "h")
+
+        plan = plan_sync(self.src, self.dst)
+
+        self.assertEqual(self.kinds(plan), [
+            (MKDIR, ".plandst/c", ".plansrc/c"),
+            (DELETE, ".plansrc/a/b/f", ".plandst/a/b/f"),
+            (DELETE, ".plansrc/c/g", ".plandst/c/g"),
+            (RMDIR, ".plansrc/a", ".plandst/a"),
+            (RMDIR, ".plansrc/a/b", ".plandst/a/b"),
+            (COPY, ".plandst/c/h", ".plansrc/c/h")])
+        self.assertEqual(plan.execute(), [])
+        self.assertEqual(os.listdir(".plandst"), ["c"])
+        self.assertEqual(os.listdir(".plandst/c"), ["h"])
+        self.assertEqual(os.listdir(".plansrc/c"), ["h"])
+        self.assertEqual(plan_sync(self.src, self.dst).actions, [])
+
+    def test_move_to_new_dir(self):
+        write(".plansrc/f", "f" * 100)
+        plan_sync(self.src, self.dst).execute()
+        os.mkdir(".plansrc/newdir")
+        os.rename(".plansrc/f", ".plansrc/newdir/f")
+
+        plan = plan_sync(self.src, self.dst)
+
+        self.assertEqual(self.kinds(plan), [
+            (MKDIR, ".plansrc/newdir", ".plandst/newdir"),
+            (MOVE, ".plansrc/newdir/f", ".plandst/newdir/f")])
+        self.assertEqual(plan.execute(), [])
+        self.assertEqual(os.listdir(".plandst"), ["newdir"])
+        self.assertEqual(open(".plandst/newdir/f").read(), "f" * 100)
+        self.assertEqual(plan_sync(self.src, self.dst).actions, [])
+
+    def test_move_failed(self):
+        write(".plansrc/f", "f" * 100)
+        plan_sync(self.src, self.dst).execute()
+        os.rename(".plansrc/f", ".plansrc/g")
+        plan = plan_sync(self.src, self.dst)
+        os.remove(".plandst/f")
+
+        self.assertEqual([a.kind for a in plan.execute()], [MOVE])
+        # the checksums of the file that was not moved are kept
+        self.assertTrue(".plansrc/f" in self.src.cache)
+        self.assertFalse(".plandst/g" in self.dst.cache)
+
+    def test_delete_failed(self):
+        os.mkdir(".plansrc/d")
+        write(".plansrc/d/f", "f" * 100)
+        plan_sync(self.src, self.dst).execute()
+        os.remove(".plansrc/d/f")
+        plan = plan_sync(self.src, self.dst)
+
+        def remove(path):
+            raise OSError(errno.EACCES, "Permission denied", path)
+        self.dst.remove = remove
+        self.assertEqual([a.kind for a in plan.execute()], [DELETE])
+        del self.dst.remove
+
+        # the file is deleted again, not copied back
+        self.assertEqual(self.kinds(plan_sync(self.src, self.dst)), [
+            (DELETE, ".plansrc/d/f", ".plandst/d/f")])
+
+if __name__ == '__main__':
+    unittest.main()
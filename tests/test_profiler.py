@@ -0,0 +1,94 @@
+import unittest
+
+import os
+import time
+import pstats
+import threading
+
+from multiprocessing import Pool
+
+from MiGBox.sftp.profiler import SamplingProfiler, PoolProfiler, profile_process
+
+def request(stop):
+    while not stop.isSet():
+        work()
+
+def work():
+    sum(xrange(1000))
+
+def idle():
+    pass
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        work()
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=request, args=(self.stop,))
+        self.thread.start()
+        self.profiler = SamplingProfiler({request.__code__: lambda frame: 'test'},
+                                         interval=0.001)
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+        for suffix in ('.prof', '.folded'):
+            if os.path.exists('.tmp' + suffix):
+                os.remove('.tmp' + suffix)
+
+    def test_sample(self):
+        self.profiler.start()
+        time.sleep(0.2)
+        self.profiler.stop()
+
+        self.assertFalse(self.profiler.active)
+        lines = self.profiler.collapsed().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith('test;request (test_profiler.py:'))
+
+    def test_dump(self):
+        self.profiler.start()
+        time.sleep(0.2)
+        self.profiler.stop()
+        prof, folded = self.profiler.dump('.tmp')
+
+        stats = pstats.Stats(prof).stats
+        self.assertIn(('~', 0, '<request test>'), stats)
+        self.assertIn((request.__code__.co_filename, request.__code__.co_firstlineno,
+                       'request'), stats)
+        self.assertTrue(os.path.getsize(folded))
+
+    def test_idle(self):
+        # threads not handling a request are not sampled
+        profiler = SamplingProfiler({idle.__code__: lambda frame: 'idle'}, interval=0.001)
+        profiler.start()
+        time.sleep(0.05)
+        profiler.stop()
+
+        self.assertEqual(profiler.collapsed(), '')
+
+    def test_processes(self):
+        processes = PoolProfiler({busy: 'busy'}, interval=0.001)
+        pool = Pool(1, profile_process, processes.initargs)
+        try:
+            profiler = SamplingProfiler({idle.__code__: lambda frame: 'idle'}, interval=0.001,
+                                        processes=processes)
+            profiler.start()
+            pool.apply(busy, (0.2,))
+            profiler.stop()
+        finally:
+            pool.close()
+            pool.join()
+
+        lines = profiler.collapsed().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith('busy;busy (test_profiler.py:'))
+
+if __name__ == '__main__':
+    unittest.main()
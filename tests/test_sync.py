@@ -0,0 +1,196 @@
+import unittest
+
+import os
+import time
+import shutil
+import threading
+
+from Queue import Empty
+
+from watchdog.events import FileModifiedEvent, FileMovedEvent, FileDeletedEvent, \
+                            DirMovedEvent, DirDeletedEvent, DirModifiedEvent
+
+from MiGBox.fs import OSFileSystem
+from MiGBox.sync import EventJournal, EventQueue, sync_events
+from MiGBox.sync.sync import SMALL, LARGE, RESCAN, SMALL_SIZE, LARGE_SIZE, MAX_WAIT
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def modified(path, size=0):
+    event = FileModifiedEvent(path)
+    event.size = size
+    return event
+
+class EventJournalTest(unittest.TestCase):
+
+    def test_since(self):
+        journal = EventJournal()
+        journal.put('a')
+        journal.put('b')
+
+        self.assertEqual(journal.since(0), (2, True, ['a', 'b']))
+        self.assertEqual(journal.since(1), (2, True, ['b']))
+        self.assertEqual(journal.since(2), (2, True, []))
+
+    def test_since_dropped(self):
+        journal = EventJournal(maxlen=2)
+        for event in 'abc':
+            journal.put(event)
+
+        self.assertEqual(journal.since(0), (3, False, []))
+        self.assertEqual(journal.since(1), (3, True, ['b', 'c']))
+
+    def test_since_unknown_cursor(self):
+        journal = EventJournal()
+        journal.put('a')
+
+        self.assertEqual(journal.since(5), (1, False, []))
+
+    def test_since_other_journal(self):
+        journal = EventJournal()
+        journal.put('a')
+
+        # cursor 0 is a valid cursor of this journal, not of another one
+        self.assertEqual(journal.since(0, journal.id), (1, True, ['a']))
+        self.assertEqual(journal.since(0, EventJournal().id), (1, False, []))
+
+class EventQueueTest(unittest.TestCase):
+
+    def paths(self, queue, lane=None):
+        return [queue.get(lane=lane).src_path for i in xrange(queue._qsize(lane))]
+
+    def test_lanes(self):
+        queue = EventQueue()
+        queue.put(modified('large', LARGE_SIZE))
+        queue.put(modified('small', 1))
+
+        self.assertEqual(queue.get(lane=LARGE).src_path, 'large')
+        self.assertEqual(queue.get(lane=SMALL).src_path, 'small')
+        self.assertRaises(Empty, queue.get, False, lane=LARGE)
+
+    def test_priorities(self):
+        queue = EventQueue()
+        queue.put(modified('rescan'), origin=RESCAN)
+        queue.put(modified('medium', SMALL_SIZE))
+        queue.put(modified('edit'))
+
+        self.assertEqual(self.paths(queue), ['edit', 'medium', 'rescan'])
+
+    def test_same_path(self):
+        queue = EventQueue()
+        queue.put(modified('a', SMALL_SIZE))
+        queue.put(FileMovedEvent('a', 'b'))
+        queue.put(modified('c'))
+
+        # the move waits for the earlier event of its path
+        self.assertEqual(self.paths(queue), ['c', 'a', 'a'])
+
+    def test_running_path(self):
+        queue = EventQueue()
+        queue.put(modified('a', LARGE_SIZE))
+        self.assertEqual(queue.get(lane=LARGE).src_path, 'a')
+        queue.put(modified('a'))
+
+        # a is synchronized by the large lane until it takes the next event
+        self.assertEqual(queue.get(lane=LARGE).src_path, 'a')
+
+    def test_directory(self):
+        queue = EventQueue()
+        queue.put(modified('d/large', LARGE_SIZE))
+        queue.put(modified('d/small'))
+        queue.put(DirDeletedEvent('d'))
+        queue.put(modified('dx/large', LARGE_SIZE))
+        queue.put(DirDeletedEvent('dx/e'))
+
+        # the deleted directory waits for the large file below it
+        self.assertEqual(queue.get(lane=LARGE).src_path, 'd/large')
+        # and for the small one, queued and synchronized
+        self.assertRaises(Empty, queue.get, lane=LARGE, timeout=0.1)
+        self.assertEqual(queue.get(lane=SMALL).src_path, 'd/small')
+        self.assertRaises(Empty, queue.get, lane=LARGE, timeout=0.1)
+        taken = []
+        thread = threading.Thread(target=lambda: taken.append(queue.get(lane=LARGE).src_path))
+        thread.start()
+        self.assertEqual(queue.get(lane=SMALL).src_path, 'dx/e')
+        thread.join(1)
+
+        self.assertEqual(taken, ['d'])
+        self.assertEqual(self.paths(queue, LARGE), ['dx/large'])
+
+    def test_directory_running(self):
+        queue = EventQueue()
+        queue.put(modified('d/a/large', LARGE_SIZE))
+        self.assertEqual(queue.get(lane=LARGE).src_path, 'd/a/large')
+        queue.put(modified('e'))
+        queue.put(DirMovedEvent('d', 'f'))
+
+        self.assertEqual(queue.get(lane=LARGE).src_path, 'd')
+        self.assertEqual(self.paths(queue, SMALL), ['e'])
+
+    def test_max_wait(self):
+        queue = EventQueue()
+        queue.put(modified('rescan'), origin=RESCAN)
+        queue.put(modified('edit'))
+        queue.arrivals[0][2].arrival -= MAX_WAIT + 1
+
+        self.assertEqual(self.paths(queue), ['rescan', 'edit'])
+
+    def test_timeout(self):
+        queue = EventQueue()
+        start = time.time()
+
+        self.assertRaises(Empty, queue.get, timeout=0.1)
+        self.assertAlmostEqual(time.time() - start, 0.1, delta=0.1)
+
+class SyncEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        for root in (".eventsrc", ".eventdst"):
+            os.mkdir(root)
+        self.src = OSFileSystem(root=".eventsrc")
+        self.dst = OSFileSystem(root=".eventdst")
+
+    def tearDown(self):
+        for fs in (self.src, self.dst):
+            fs.observer.stop()
+            fs.observer.join()
+        shutil.rmtree(".eventsrc")
+        shutil.rmtree(".eventdst")
+
+    def sync(self, *events):
+        queue = EventQueue()
+        stop = threading.Event()
+        thread = threading.Thread(target=sync_events, args=[self.src, self.dst, queue, stop])
+        thread.start()
+        for event in events:
+            queue.put(event)
+        queue.join()
+        stop.set()
+        # wake up the sync thread, modified directories are not synchronized
+        queue.put(DirModifiedEvent(self.src.root))
+        thread.join()
+
+    def test_deleted_recreated(self):
+        write(".eventsrc/f", "new")
+        write(".eventdst/f", "old")
+
+        # e.g. a file replaced by a patch's rename
+        self.sync(FileDeletedEvent(".eventsrc/f"))
+
+        self.assertEqual(open(".eventdst/f").read(), "old")
+
+    def test_moved_source_exists(self):
+        write(".eventsrc/a", "a")
+        write(".eventsrc/b", "b")
+        write(".eventdst/a", "a")
+
+        # the observer matched b by the inode of a
+        self.sync(FileMovedEvent(".eventsrc/a", ".eventsrc/b"))
+
+        self.assertEqual(open(".eventdst/a").read(), "a")
+        self.assertEqual(open(".eventdst/b").read(), "b")
+
+if __name__ == '__main__':
+    unittest.main()
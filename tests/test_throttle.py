@@ -0,0 +1,170 @@
+import unittest
+
+import os
+import time
+import shutil
+import threading
+
+from benchmark import LoopbackServer
+
+from MiGBox import throttle
+from MiGBox.fs import OSFileSystem
+from MiGBox.sync.delta import BUFSIZE
+from MiGBox.throttle import TokenBucket, priority, current_priority, INTERACTIVE, BACKGROUND
+
+class Bucket(TokenBucket):
+    # token bucket recording the consumed bytes or operations
+
+    def __init__(self, name, rate=0, burst=None):
+        TokenBucket.__init__(self, name, rate, burst)
+        self.parts = []
+
+    def consume(self, n, level=None):
+        self.parts.append(n)
+        return TokenBucket.consume(self, n, level)
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        bucket = TokenBucket('test')
+
+        self.assertEqual(bucket.consume(1 << 30), 0.0)
+
+    def test_rate(self):
+        bucket = TokenBucket('test', rate=100000, burst=10000)
+        start = time.time()
+        bucket.consume(10000)
+        bucket.consume(20000)
+
+        # the burst is free, the rest takes 0.2 seconds
+        self.assertAlmostEqual(time.time() - start, 0.2, delta=0.1)
+
+    def test_min_burst(self):
+        bucket = TokenBucket('test', rate=10, min_burst=1)
+
+        # a second of the rate, not MIN_BURST operations at once
+        self.assertEqual(bucket.burst, 10)
+        self.assertEqual(TokenBucket('test', rate=10).burst, throttle.MIN_BURST)
+
+    def test_set_rate(self):
+        bucket = TokenBucket('test', rate=1000, burst=1000)
+        bucket.consume(1000)
+        thread = threading.Thread(target=bucket.consume, args=(100000,))
+        thread.start()
+        time.sleep(0.05)
+        bucket.set_rate(0)
+        thread.join(1)
+
+        self.assertFalse(thread.isAlive())
+
+    def test_priority(self):
+        bucket = TokenBucket('test', rate=100000, burst=10000)
+        bucket.consume(10000)
+        done = []
+
+        def consume(level):
+            bucket.consume(10000, level)
+            done.append(level)
+
+        background = threading.Thread(target=consume, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.02)
+        interactive = threading.Thread(target=consume, args=(INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+
+        self.assertEqual(done, [INTERACTIVE, BACKGROUND])
+
+    def test_priority_context(self):
+        with priority(BACKGROUND):
+            self.assertEqual(current_priority(), BACKGROUND)
+        self.assertEqual(current_priority(), INTERACTIVE)
+
+class ThrottledTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buckets = throttle.network, throttle.disk, throttle.operations
+        os.mkdir(".throttledir")
+        with open(".throttledir/f", "wb") as f:
+            f.write(os.urandom(3 * BUFSIZE))
+
+    def tearDown(self):
+        throttle.network, throttle.disk, throttle.operations = self.buckets
+        shutil.rmtree(".throttledir")
+
+    def test_disk(self):
+        throttle.disk = Bucket('disk', rate=8 * BUFSIZE, burst=BUFSIZE)
+        fs = OSFileSystem(root=".throttledir")
+        try:
+            start = time.time()
+            fs.blockchecksums(".throttledir/f", False)
+            elapsed = time.time() - start
+        finally:
+            fs.observer.stop()
+            fs.observer.join()
+
+        # the file is read in parts, each waits for the limit
+        self.assertEqual(sum(throttle.disk.parts), 3 * BUFSIZE)
+        self.assertTrue(len(throttle.disk.parts) > 1)
+        self.assertTrue(max(throttle.disk.parts) <= BUFSIZE)
+        # the first part is free, the rest takes 0.25 seconds
+        self.assertTrue(elapsed >= 0.2)
+
+    def test_network(self):
+        server = LoopbackServer(os.path.abspath(".throttledir"))
+        client = server.connect()
+        throttle.network = Bucket('network', rate=262144, burst=32768)
+        try:
+            start = time.time()
+            with client.open("f", "rb") as f:
+                data = f.read(131072)
+            elapsed = time.time() - start
+        finally:
+            client.close()
+            server.close()
+
+        self.assertEqual(len(data), 131072)
+        # every response waits for the limit, the first one is free
+        self.assertTrue(len(throttle.network.parts) > 1)
+        self.assertTrue(sum(throttle.network.parts) >= 131072)
+        self.assertTrue(elapsed >= 0.3)
+
+    def test_operations(self):
+        throttle.operations = Bucket('operations', rate=20, burst=1)
+        fs = OSFileSystem(root=".throttledir")
+        try:
+            start = time.time()
+            fs.listdir(".throttledir")
+            for i in range(4):
+                fs.stat(".throttledir/f")
+            fs.rename(".throttledir/f", ".throttledir/g")
+            elapsed = time.time() - start
+        finally:
+            fs.observer.stop()
+            fs.observer.join()
+
+        # the first operation is free, the other 5 take 0.25 seconds
+        self.assertEqual(throttle.operations.parts, [1] * 6)
+        self.assertTrue(elapsed >= 0.2)
+
+    def test_client_operations(self):
+        server = LoopbackServer(os.path.abspath(".throttledir"))
+        client = server.connect()
+        throttle.operations = Bucket('operations', rate=20, burst=1)
+        try:
+            start = time.time()
+            for i in range(4):
+                client.stat("f")
+            client.rename("f", "g")
+            elapsed = time.time() - start
+        finally:
+            client.close()
+            server.close()
+
+        # every request waits for the limit, the first one is free
+        self.assertEqual(throttle.operations.parts, [1] * 5)
+        self.assertTrue(elapsed >= 0.15)
+
+if __name__ == '__main__':
+    unittest.main()